@@ -0,0 +1,86 @@
+"""Benchmark of analytic gradients in the flow law parameter fits.
+
+Fits the bam, hivdi, metroman, sad and sic4dvar flow laws of random reaches
+with finite-difference gradients (the default) and with analytic gradients
+(params_dict['flp_gradients']), and reports flow law evaluations, runtime
+and the final objective of each mode.
+
+    python benchmarks/bench_flp_gradients.py [number of reaches]
+"""
+
+# Standard imports
+from pathlib import Path
+import sys
+import time
+import warnings
+
+# Third-party imports
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Local imports
+from moi.Integrate import Integrate
+
+FITS = {
+    'neobam': ('bam', lambda r: {'n': np.array([0.03 * r.lognormal(0., .3)]), 'a0': np.array([r.uniform(200., 400.)])}),
+    'hivdi': ('hivdi', lambda r: {'alpha': np.array([r.uniform(20., 40.)]), 'beta': np.array([r.uniform(-.5, .5)]), 'a0': np.array([r.uniform(200., 400.)])}),
+    'metroman': ('metroman', lambda r: {'na': np.array([0.03 * r.lognormal(0., .3)]), 'x1': np.array([r.uniform(-1., 0.)]), 'a0': np.array([r.uniform(200., 400.)])}),
+    'sad': ('sad', lambda r: {'n': np.array([0.03 * r.lognormal(0., .3)]), 'a0': np.array([r.uniform(200., 400.)])}),
+    'sic4dvar': ('sic4dvar', lambda r: {'n': np.array([0.03 * r.lognormal(0., .3)]), 'a0': np.array([r.uniform(200., 400.)])})
+}
+
+def random_reach(rng, nt=30):
+    """Return obs for one reach, and integrator targets close to its flows."""
+
+    obs = {
+        'nt': nt,
+        'w': rng.uniform(80., 120., nt),
+        'S': rng.uniform(1e-4, 3e-4, nt),
+        'dA': rng.normal(0., 30., nt)
+    }
+    qbar = rng.uniform(200., 800.)
+    return obs, {'qbar': qbar, 'q33': qbar * rng.uniform(.5, .8)}
+
+class Counter:
+    """Count calls of a flow law while it is installed on Integrate."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.func = getattr(Integrate, name)
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.func(*args)
+
+def main(nreach):
+    rng = np.random.default_rng(0)
+    reaches = [random_reach(rng) for i in range(nreach)]
+    print(f"{'alg':>9} {'mode':>9} {'flow law calls':>15} {'time (s)':>9} {'median objective':>17}")
+    for alg, (law, prior) in FITS.items():
+        objfun = getattr(Integrate, law + '_objfun')
+        flpes = [dict(prior(rng), integrator=targets) for obs, targets in reaches]
+        for jac in (False, True):
+            counter = Counter(law + '_flowlaw')
+            setattr(Integrate, law + '_flowlaw', staticmethod(counter))
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    start = time.perf_counter()
+                    fits = [getattr(Integrate, 'fit_' + alg)(str(i), obs, flpe, jac)
+                            for i, ((obs, targets), flpe) in enumerate(zip(reaches, flpes))]
+                    elapsed = time.perf_counter() - start
+            finally:
+                setattr(Integrate, law + '_flowlaw', staticmethod(counter.func))
+
+            objective = []
+            for fit, (obs, targets) in zip(fits, reaches):
+                params = [fit[key] for key in fit if key != 'q']
+                args = (targets['qbar'],) if law == 'sic4dvar' else (targets['qbar'], targets['q33'])
+                objective.append(objfun(np.array(params), obs, *args))
+            mode = 'analytic' if jac else 'finite'
+            print(f"{alg:>9} {mode:>9} {counter.calls:>15} {elapsed:>9.2f} {np.median(objective):>17.3g}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
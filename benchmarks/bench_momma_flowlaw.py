@@ -0,0 +1,58 @@
+"""Micro-benchmark of the MOMMA flow law.
+
+Compares Integrate.momma_flowlaw with the per-time-step loop it replaced,
+for typical numbers of SWOT observations per reach.
+
+    python benchmarks/bench_momma_flowlaw.py
+"""
+
+# Standard imports
+from pathlib import Path
+import sys
+import timeit
+
+# Third-party imports
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Local imports
+from moi.Integrate import Integrate
+
+def momma_flowlaw_loop(params, obs, aux_var):
+    """MOMMA flow law one time step at a time, as before vectorization."""
+
+    B, H = params
+    nb = 0.11 * aux_var**0.18
+    if H <= B + 0.1:
+        return np.inf
+    q = np.empty((obs['nt'],))
+    for t in range(obs['nt']):
+        log_factor = np.log10((H - B) / (obs['h'][t] - B))
+        if obs['h'][t] <= H:
+            n = nb * (1 + log_factor)
+        else:
+            n = nb * (1 - log_factor)
+        q[t] = (((obs['h'][t] - B) * (2 / 3))**(5 / 3) * obs['w'][t] * obs['S'][t]**(1 / 2)) / n
+    return np.reshape(q, (1, obs['nt']))
+
+def main():
+    rng = np.random.default_rng(0)
+    params = (10., 13.)
+    print(f"{'nt':>6} {'loop (us)':>12} {'vectorized (us)':>16} {'speedup':>8}")
+    for nt in [10, 30, 100, 300, 1000]:
+        obs = {
+            'nt': nt,
+            'h': rng.uniform(10.5, 14., nt),
+            'w': rng.uniform(80., 120., nt),
+            'S': rng.uniform(1e-5, 3e-4, nt)
+        }
+        np.testing.assert_allclose(Integrate.momma_flowlaw(params, obs, 2e-4), momma_flowlaw_loop(params, obs, 2e-4), rtol=1e-15)
+
+        number = max(10, 20000 // nt)
+        loop = min(timeit.repeat(lambda: momma_flowlaw_loop(params, obs, 2e-4), number=number, repeat=5)) / number
+        vec = min(timeit.repeat(lambda: Integrate.momma_flowlaw(params, obs, 2e-4), number=number, repeat=5)) / number
+        print(f"{nt:>6} {loop*1e6:>12.1f} {vec*1e6:>16.1f} {loop/vec:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Memory benchmark of the columnar reach store.
+
+Builds the alg_dict of a synthetic basin as nested dicts (the layout read by
+Input.extract_alg) and as ReachStores (params_dict['reach_store']), and
+reports the memory allocated by each layout, measured with tracemalloc, and
+the time to read every reach's time series.
+
+    python benchmarks/bench_reach_store.py [number of reaches]
+"""
+
+# Standard imports
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+
+# Third-party imports
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Local imports
+from moi.ReachStore import to_reach_stores
+
+ALGS = ['neobam', 'hivdi', 'metroman', 'momma', 'sad', 'sic4dvar']
+
+def synthetic_alg_dict(rng, nreach, nt=30, observed=0.6):
+    """Return an alg_dict holding FLPE results and integrator outputs."""
+
+    alg_dict = {}
+    for alg in ALGS:
+        alg_dict[alg] = {}
+        for i in range(nreach):
+            reach = str(10000000000 + 10 * i + 1)
+            if rng.uniform() < observed:
+                alg_dict[alg][reach] = {
+                    's1-flpe-exists': True,
+                    'q': rng.lognormal(5., 1., (1, nt)),
+                    'n': np.array([0.03]),
+                    'a0': np.array([300.]),
+                    'qbar': rng.uniform(100., 500.),
+                    'q33': rng.uniform(50., 200.),
+                    'integrator': {
+                        'qbar': rng.uniform(100., 500.),
+                        'q33': rng.uniform(50., 200.),
+                        'sbQ_rel': rng.uniform(.1, 1.),
+                        'q': rng.lognormal(5., 1., (1, nt)),
+                        'n': np.array([0.03]),
+                        'a0': np.array([300.])
+                    }
+                }
+            else:
+                alg_dict[alg][reach] = {
+                    's1-flpe-exists': False,
+                    'qbar': np.nan,
+                    'integrator': {'qbar': rng.uniform(100., 500.), 'q33': rng.uniform(50., 200.), 'sbQ_rel': np.nan}
+                }
+    return alg_dict
+
+def measure(build):
+    """Return the result of build() and the bytes it left allocated."""
+
+    tracemalloc.start()
+    result = build()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, allocated
+
+def read_time(alg_dict):
+    """Return the time to read every reach's integrator time series."""
+
+    start = time.perf_counter()
+    for reaches in alg_dict.values():
+        for reach in reaches.keys():
+            if reaches[reach]['s1-flpe-exists']:
+                reaches[reach]['integrator']['q'].sum()
+    return time.perf_counter() - start
+
+def main(nreach):
+    rng = np.random.default_rng(0)
+    nested, nested_bytes = measure(lambda: synthetic_alg_dict(rng, nreach))
+    stores, store_bytes = measure(lambda: to_reach_stores(nested))
+    column_bytes = sum(store.nbytes() for store in stores.values())
+    print(f"{'layout':>12} {'allocated (MB)':>15} {'columns (MB)':>13} {'read (s)':>9}")
+    print(f"{'dicts':>12} {nested_bytes / 1e6:>15.2f} {'':>13} {read_time(nested):>9.3f}")
+    print(f"{'ReachStore':>12} {store_bytes / 1e6:>15.2f} {column_bytes / 1e6:>13.2f} {read_time(stores):>9.3f}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,285 @@
+# Third-party imports
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+class LowRankAdjustment:
+    """Adjusts prior discharge to mass conservation without forming covQ.
+
+    The prior covariance used by the integrator is
+
+        covQ = rho * s s^T + (1-rho) * diag(s^2)
+
+    i.e. a diagonal matrix plus a rank-one term. The adjustment only needs
+    products with covQ and solves with G covQ G^T = A + u u^T, where
+    A = (1-rho) G diag(s^2) G^T is sparse and u = sqrt(rho) G s. Solves use a
+    sparse LU factorization of A and the Sherman-Morrison-Woodbury identity,
+    so memory grows with n + nnz(G) instead of n^2.
+
+    Several priors that share G (e.g. one per FLPE algorithm) can be adjusted
+    together by passing s with shape (k, n). The k systems are then solved
+    with one factorization of the block diagonal matrix diag(A_1, ..., A_k),
+    and every method takes and returns arrays with a leading axis of size k.
+
+    Attributes
+    ----------
+    G: scipy.sparse.csr_array
+        m x n mass conservation matrix
+    k: int
+        number of priors adjusted together
+    rho: float
+        correlation coefficient between reaches
+    s: numpy.ndarray
+        prior standard deviations (sigQ**(norm/2)), shape (n,) or (k, n)
+
+    Methods
+    -------
+    adjust(Qbar)
+        return the mass-conserving adjustment of Qbar
+    cov_matvec(y)
+        return covQ @ y
+    diagonal()
+        return the diagonal of covQ
+    posterior_std(chunk)
+        return the standard deviations of the adjusted discharge
+    solve(b)
+        return (G covQ G^T)^-1 b
+    toarray()
+        return covQ as a dense n x n array
+    """
+
+    def __init__(self, G, s, rho):
+        """
+        Parameters
+        ----------
+        G: scipy.sparse array
+            m x n mass conservation matrix
+        s: numpy.ndarray
+            prior standard deviations (sigQ**(norm/2)), shape (n,) or (k, n)
+        rho: float
+            correlation coefficient between reaches
+        """
+
+        self.G = sparse.csr_array(G)
+        self.s = np.asarray(s, dtype=np.float64)
+        self.rho = rho
+        self.m, self.n = self.G.shape
+        self.batched = self.s.ndim == 2
+        self.k = self.s.shape[0] if self.batched else 1
+        self.lu = None
+
+    def factorize(self):
+        """Factorize A and precompute the Woodbury correction.
+
+        Raises RuntimeError if A is singular, e.g. when G has linearly
+        dependent rows.
+        """
+
+        if self.lu is not None or self.m == 0:
+            return
+
+        s = self.__stack(self.s)
+        d = (1 - self.rho) * s**2
+        Gk = sparse.kron(sparse.eye_array(self.k), self.G, format='csr')
+        A = (Gk @ sparse.diags_array(d.reshape(-1)) @ Gk.T).tocsc()
+        self.lu = splu(A)
+
+        self.u = np.sqrt(self.rho) * (self.G @ s.T).T
+        self.Ainv_u = self.lu.solve(self.u.reshape(-1)).reshape(self.k, self.m)
+        self.denom = 1. + np.sum(self.u * self.Ainv_u, axis=1)
+
+    def solve(self, b):
+        """Return (G covQ G^T)^-1 b for b of shape (m,) or (m, r).
+
+        For k priors b has shape (k, m) or (k, m, r).
+        """
+
+        self.factorize()
+        b = self.__stack(b)
+        z = self.lu.solve(b.reshape(self.k * self.m, -1)).reshape(b.shape)
+        if z.ndim == 2:
+            z -= self.Ainv_u * (np.sum(self.u * z, axis=1) / self.denom)[:, None]
+        else:
+            z -= self.Ainv_u[:, :, None] * (np.einsum('km,kmr->kr', self.u, z) / self.denom[:, None])[:, None, :]
+        return self.__unstack(z)
+
+    def cov_matvec(self, y):
+        """Return covQ @ y for y of shape (n,), or (k, n) for k priors."""
+
+        return (1 - self.rho) * self.s**2 * y + self.rho * self.s * np.sum(self.s * y, axis=-1, keepdims=True)
+
+    def adjust(self, Qbar):
+        """Return Qbar - covQ G^T (G covQ G^T)^-1 G Qbar."""
+
+        if self.m == 0:
+            return np.array(Qbar, dtype=np.float64)
+
+        lam = self.__stack(self.solve((self.G @ np.transpose(Qbar)).T))
+        return Qbar - self.cov_matvec(self.__unstack((self.G.T @ lam.T).T))
+
+    def diagonal(self):
+        """Return the diagonal of covQ."""
+
+        return self.s**2
+
+    def posterior_std(self, chunk=512):
+        """Return sqrt(diag(covQ - covQ G^T (G covQ G^T)^-1 G covQ)).
+
+        Only the diagonal of the posterior covariance is computed. Columns of
+        G covQ are formed and solved against the shared factorization in
+        blocks of chunk reaches, so no n x n array is allocated.
+        """
+
+        var = self.__stack(self.diagonal())
+        if self.m == 0:
+            return self.__unstack(np.sqrt(var))
+
+        self.factorize()
+        s = self.__stack(self.s)
+        Gs = (self.G @ s.T).T
+        Gcsc = self.G.tocsc()
+        chunk = max(1, chunk // self.k)
+        for start in range(0, self.n, chunk):
+            stop = min(start + chunk, self.n)
+            Gcols = Gcsc[:, start:stop].toarray()
+            X = (1 - self.rho) * Gcols[None, :, :] * s[:, None, start:stop]**2 + \
+                self.rho * Gs[:, :, None] * s[:, None, start:stop]
+            Y = self.__stack(self.solve(self.__unstack(X)))
+            var[:, start:stop] -= np.sum(X * Y, axis=1)
+
+        return self.__unstack(np.sqrt(var))
+
+    def toarray(self):
+        """Return covQ as a dense n x n array, or (k, n, n) for k priors."""
+
+        s = self.__stack(self.s)
+        covQ = s[:, :, None] * s[:, None, :] * (self.rho * np.ones((self.n, self.n)) + (np.eye(self.n) - self.rho * np.eye(self.n)))
+        return self.__unstack(covQ)
+
+    def __stack(self, x):
+        """Add a leading axis of size one when adjusting a single prior."""
+
+        return x if self.batched else x[None, ...]
+
+    def __unstack(self, x):
+        """Remove the leading axis added by __stack."""
+
+        return x if self.batched else x[0]
+
+class NonnegativeAdjustment:
+    """Adjusts prior discharge to mass conservation with discharge >= 0.
+
+    Solves the weighted least squares problem used by the 'nonlinear'
+    integrator method
+
+        min sum(((Q - Qbar) / sigQ)**2)   s.t.   G Q = 0,   Q >= 0
+
+    through its dual. For multipliers lam on the mass conservation
+    constraints the bounds separate by reach, and the minimizing discharge is
+
+        Q(lam) = max(0, Qbar - D G^T lam),   D = diag(sigQ^2)
+
+    so only G Q(lam) = 0 has to be solved, an m-dimensional piecewise linear
+    system. It is solved with a semismooth Newton method: every iteration
+    factorizes the sparse m x m matrix G_F D_F G_F^T over the reaches F with
+    positive discharge and backtracks on the dual objective. Junctions whose
+    reaches are all at zero make that matrix singular, so a small multiple of
+    the identity is added to it; this only changes the step, not the solution.
+
+    Newton is warm started from the multipliers of the linear adjustment
+    (the same problem without Q >= 0), so when the linear solution is
+    already nonnegative it is returned after one factorization.
+
+    Attributes
+    ----------
+    G: scipy.sparse.csr_array
+        m x n mass conservation matrix
+    d: numpy.ndarray
+        prior variances sigQ**2
+    maxiter: int
+        maximum number of Newton iterations
+    niter: int
+        number of Newton iterations used by the last call to adjust
+
+    Methods
+    -------
+    adjust(Qbar)
+        return the nonnegative mass-conserving adjustment of Qbar
+    """
+
+    def __init__(self, G, sigQ, maxiter=100, tol=1e-10):
+        """
+        Parameters
+        ----------
+        G: scipy.sparse array
+            m x n mass conservation matrix
+        sigQ: numpy.ndarray
+            prior standard deviations, shape (n,)
+        maxiter: int
+            maximum number of Newton iterations
+        tol: float
+            tolerance on |G Q|, relative to the largest |Qbar|
+        """
+
+        self.G = sparse.csr_array(G)
+        self.d = np.asarray(sigQ, dtype=np.float64).reshape(-1)**2
+        self.m, self.n = self.G.shape
+        self.maxiter = maxiter
+        self.tol = tol
+        self.niter = 0
+
+    def adjust(self, Qbar):
+        """Return (Q, converged) for the prior Qbar.
+
+        Q is always nonnegative. If |G Q| has not dropped below tol after
+        maxiter iterations, converged is False.
+        """
+
+        Qbar = np.asarray(Qbar, dtype=np.float64).reshape(-1)
+        self.niter = 0
+        if self.m == 0:
+            return np.maximum(Qbar, 0.), True
+
+        tol = self.tol * max(np.max(np.abs(Qbar)), 1.)
+        # warm start: multipliers of the linear adjustment, Q(lam) = max(0, Qlinear)
+        lam = self.__newton_step(np.ones(self.n, dtype=bool), self.G @ Qbar)
+        Q, g = self.__dual(lam, Qbar)
+        while True:
+            r = self.G @ Q
+            if np.max(np.abs(r)) <= tol:
+                return Q, True
+            if self.niter >= self.maxiter:
+                return Q, False
+
+            free = Q > 0
+            step = self.__newton_step(free, r)
+
+            # backtrack on the dual objective, which is concave in lam. close to
+            #   the solution its increase is below round off, so also accept
+            #   steps that reduce the residual
+            t = 1.
+            slope = r @ step
+            rnorm = np.linalg.norm(r)
+            while True:
+                Qt, gt = self.__dual(lam + t * step, Qbar)
+                if gt >= g + 1e-4 * t * slope or np.linalg.norm(self.G @ Qt) <= (1 - 1e-4 * t) * rnorm or t < 1e-10:
+                    break
+                t *= 0.5
+            lam = lam + t * step
+            Q, g = Qt, gt
+
+    def __dual(self, lam, Qbar):
+        """Return Q(lam) and the dual objective at lam."""
+
+        z = self.G.T @ lam
+        Q = np.maximum(Qbar - self.d * z, 0.)
+        return Q, 0.5 * np.sum((Q - Qbar)**2 / self.d) + z @ Q
+
+    def __newton_step(self, free, r):
+        """Return (G_F D_F G_F^T + delta I)^-1 r."""
+
+        self.niter += 1
+        Gf = self.G @ sparse.diags_array(np.where(free, self.d, 0.))
+        A = (Gf @ self.G.T).tocsc()
+        delta = 1e-10 * max(np.max(np.abs(A.diagonal())), 1.)
+        return splu((A + delta * sparse.eye_array(self.m, format='csc')).tocsc()).solve(r)
@@ -1,4 +1,5 @@
 # Standard imports
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from pathlib import Path
 import warnings
@@ -9,6 +10,305 @@ import sys
 from netCDF4 import Dataset,chartostring
 import numpy as np
 
+# Local imports
+from moi.ObsBuffer import ObsBuffer
+
+# SWORD reach fields used by MOI
+SWORD_FIELDS=['reach_id','facc','n_rch_up','n_rch_down','rch_id_up','rch_id_dn','swot_obs','swot_orbits']
+
+# SWOT reach variables read into obs_dict, by obs_dict key
+SWOT_FIELDS={
+    'h': 'wse',
+    'w': 'width',
+    'S': 'slope2',
+    'dA': 'd_x_area',
+    't': 'time',
+    'reach_q': 'reach_q',
+    'xovr_cal_q': 'xovr_cal_q'
+}
+
+# default bound on concurrent reach file readers, to limit the load on EFS
+IO_WORKERS_MAX=8
+
+# links followed from the basin when subsetting SWORD; dam removal looks
+# up to three reaches downstream
+SWORD_HOPS=3
+
+def index_reach_ids(reach_ids):
+    """Return a dict mapping each SWORD reach id (int) to its row.
+
+    Built once so that reach lookups are O(1) instead of a scan of the
+    continent-wide reach_id array. If an id is repeated, the first row wins.
+    """
+
+    reach_ids=np.ma.getdata(reach_ids).tolist()
+    return {reach_ids[k]: k for k in range(len(reach_ids)-1,-1,-1)}
+
+def find_rows(ids, reaches):
+    """Return the first row of ids matching each reach, or -1 if it is absent.
+
+    Parameters
+    ----------
+    ids: numpy.ndarray
+        array of reach identifiers (int)
+    reaches: list
+        list of reach identifiers (str) to find
+    """
+
+    ids=np.ma.getdata(ids)
+    targets=np.array([np.int64(reach) for reach in reaches],dtype=np.int64)
+    rows=np.full(len(targets),-1,dtype=np.int64)
+    if len(ids) == 0:
+        return rows
+
+    # a stable sort keeps the first of repeated ids leftmost
+    order=np.argsort(ids,kind='stable')
+    pos=order[np.minimum(np.searchsorted(ids[order],targets),len(ids)-1)]
+    match=ids[pos]==targets
+    rows[match]=pos[match]
+    return rows
+
+def basin_rows(reach_ids, basin_id):
+    """Return the rows of reach_ids whose leading digits are basin_id.
+
+    Equivalent to comparing str(reach_id)[0:len(str(basin_id))] with
+    str(basin_id), but done with integer arithmetic on the whole array.
+    """
+
+    ids=np.ma.getdata(reach_ids).astype(np.int64)
+    basin_id=int(basin_id)
+    level=len(str(basin_id))
+
+    # number of digits of each reach id, then drop all but the leading ones
+    ndigits=np.searchsorted(10**np.arange(19,dtype=np.int64),ids,side='right')
+    shift=np.maximum(ndigits-level,0)
+    return np.flatnonzero(ids//10**shift == basin_id)
+
+def observed_mask(basin_dict):
+    """Return a boolean array that is True where reach_ids_all is observed.
+
+    A reach is observed if it is in reach_ids. The mask computed by
+    get_all_sword_reach_in_basin is stored as basin_dict['observed'] and is
+    reused here; otherwise it is computed with one set lookup per reach.
+    """
+
+    reach_ids_all=basin_dict['reach_ids_all']
+    if 'observed' in basin_dict and len(basin_dict['observed']) == len(reach_ids_all):
+        return basin_dict['observed']
+
+    reach_ids=set(basin_dict['reach_ids'])
+    return np.fromiter((reach in reach_ids for reach in reach_ids_all),dtype=bool,count=len(reach_ids_all))
+
+def sword_source(swordfile):
+    """Return the attributes that identify a SWORD file in its subset caches.
+
+    The path, size and modification time are recorded, so that a SWORD file
+    replaced under the same name invalidates the caches made from it.
+    """
+
+    stat=os.stat(swordfile)
+    return {
+        'source_sword': str(swordfile),
+        'source_size': str(stat.st_size),
+        'source_mtime_ns': str(stat.st_mtime_ns)
+    }
+
+def read_rows(variable, rows):
+    """Read the given reaches (last dimension) of a SWORD variable.
+
+    rows must be sorted. Each run of consecutive rows is read as a single
+    hyperslab, so a basin stored contiguously costs one read per variable.
+    """
+
+    if len(rows) == 0:
+        return variable[...,0:0]
+
+    runs=np.split(rows,np.flatnonzero(np.diff(rows)!=1)+1)
+    return np.ma.concatenate([variable[...,run[0]:run[-1]+1] for run in runs],axis=-1)
+
+def read_swot(swot_dir, reach):
+    """Read and filter the SWOT observations of a reach.
+
+    Observations with a fill value in h, w, S or dA, or with a bad reach_q
+    or xovr_cal_q flag, are removed with a single boolean mask; their
+    indices are kept in iDelete, as returned by np.where, so that outputs
+    can be expanded back to the full time series. Slopes are limited to a
+    minimum value. Returns None if the reach has no SWOT file.
+
+    Parameters
+    ----------
+    swot_dir: Path
+        path to SWOT data
+    reach: str
+        Unique reach identifier
+    """
+
+    swotfile=swot_dir.joinpath(reach+'_SWOT.nc')
+    try:
+        swot_dataset = Dataset(swotfile)
+    except:
+        return None
+
+    obs={}
+    nt = swot_dataset.dimensions['nt'].size
+    obs['nt']=nt
+    for key,field in SWOT_FIELDS.items():
+        obs[key]=swot_dataset["reach/" + field][0:nt].filled(np.nan)
+    swot_dataset.close()
+
+    #select observations that are NOT equal to the fill value
+    delete=np.isnan(obs['h']) | np.isnan(obs['w']) | np.isnan(obs['S']) | np.isnan(obs['dA']) | \
+           (obs['reach_q'] > 1) | (obs['xovr_cal_q'] > 1)
+    keep=~delete
+    for key in ['h','w','S','dA','t']:
+        obs[key]=obs[key][keep]
+
+    obs['iDelete']=np.where(delete)
+
+    Smin=1.7e-5
+    np.putmask(obs['S'],obs['S']<Smin,Smin) #limit slopes to a minimum value
+
+    obs['nt'] -= np.shape(obs['iDelete'])[1]
+    return obs
+
+def get_gb_data(gb, group, pre, logged):
+    """Return neoBAM data as a numpy array.
+    
+    Parameters
+    ----------
+    gb: netCDF4.Dataset
+        NetCDF file dataset to extract discharge time series
+    group: str
+        string name of group to access chains
+    pre: str
+        string prefix of variable name
+    logged: bool
+        boolean indicating if result is logged
+    """
+
+    q = gb[group][pre][:].filled(np.nan)
+    # chain2 = gb[group][f"{pre}2"][:].filled(np.nan)
+    # chain3 = gb[group][f"{pre}3"][:].filled(np.nan)
+
+    # chains = np.vstack((chain1, chain2, chain3))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        if logged:
+            return np.exp(np.nanmean(q, axis=0))
+        else:
+            return np.nanmean(q, axis=0)
+
+def read_neobam(gb):
+    """Return neoBAM results from an open result file."""
+
+    return {
+        "q": np.array(get_gb_data(gb,"q", "q", False)),
+        "n": np.array(get_gb_data(gb,"logn", "mean", True)),
+        "a0": 1.0    # TODO temp value until work out neoBAM A0
+    }
+
+def read_hivdi(hv):
+    """Return HiVDI results from an open result file."""
+
+    return {
+        "q" : hv["reach"]["Q"][:].filled(np.nan),
+        "alpha" : hv["reach"]["alpha"][:].filled(np.nan),  
+        "beta" : hv["reach"]["beta"][:].filled(np.nan),  
+        "a0" : hv["reach"]["A0"][:].filled(np.nan)
+    }
+
+def read_momma(mo):
+    """Return MOMMA results from an open result file."""
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return {
+            "q" : mo["Q"][:].filled(np.nan),
+            "B" : mo["zero_flow_stage"][:].filled(np.nan),
+            "H" : mo["bankfull_stage"][:].filled(np.nan),                                  
+            "Save" : np.nanmean(mo["slope"][:].filled(np.nan))
+        }
+
+def read_sad(sd):
+    """Return SAD results from an open result file."""
+
+    return {
+        "q" : sd["Qa"][:].filled(np.nan),
+        "n" : sd["n"][:].filled(np.nan),
+        "a0" : sd["A0"][:].filled(np.nan)
+    }
+
+def read_metroman(mm):
+    """Return MetroMan results from an open result file."""
+
+    return {
+        "q" : mm["average"]["allq"][:].filled(np.nan),
+        "na" : mm["average"]["nahat"][:].filled(np.nan),
+        "x1" : mm["average"]["x1hat"][:].filled(np.nan),
+        "a0" : mm["average"]["A0hat"][:].filled(np.nan)
+    }
+
+def read_sic4dvar(sv):
+    """Return SIC4DVar results from an open result file."""
+
+    return {
+        #"q31": sv["Qalgo31"][:].filled(np.nan),#unclear which of these to use
+        "q_mm": sv["Q_mm"][:].filled(np.nan),
+        "q": sv["Q_da"][:].filled(np.nan),
+        # "q5": sv["Qalgo5"][:].filled(np.nan),
+        "n": sv["n"][:].filled(np.nan),
+        "a0": sv["A0"][:].filled(np.nan)
+    }
+
+# FLPE result directory (and file suffix) and reader for each algorithm
+FLPE_FILES={
+    "neobam": ("geobam", read_neobam),
+    "hivdi": ("hivdi", read_hivdi),
+    "momma": ("momma", read_momma),
+    "sad": ("sad", read_sad),
+    "metroman": ("metroman", read_metroman),
+    "sic4dvar": ("sic4dvar", read_sic4dvar)
+}
+
+# fields set to nan when an algorithm has no results for a reach
+FLPE_MISSING={
+    "neobam": ["q","n","a0"],
+    "hivdi": ["q","alpha","beta"],
+    "momma": ["q","B","H","Save"],
+    "sad": ["q","n","a0"],
+    "metroman": ["q","na","x1","a0"],
+    "sic4dvar": ["q_mm","q","n","a0"]
+}
+
+def read_flpe(alg_dir, r_id):
+    """Read the results of every FLPE algorithm for a reach.
+
+    Returns a dict of the data read for each algorithm, or None for an
+    algorithm whose result file does not exist. Defined at module level so
+    that it can run in a worker process.
+
+    Parameters
+    ----------
+    alg_dir: Path
+        path to reach-level FLPE algorithm data
+    r_id: str
+        Unique reach identifier
+    """
+
+    results={}
+    for alg,(name,reader) in FLPE_FILES.items():
+        flpe_file = alg_dir / name / f"{r_id}_{name}.nc"
+        if flpe_file.exists():
+            flpe = Dataset(flpe_file, 'r', format="NETCDF4")
+            try:
+                results[alg]=reader(flpe)
+            finally:
+                flpe.close()
+        else:
+            results[alg]=None
+    return results
+
 class Input:
     """Extracts and stores reach-level FLPE algorithm data.
     
@@ -20,6 +320,8 @@ class Input:
         path to reach-level FLPE algorithm data
     basin_dict: dict
         dict of reach_ids and SoS file needed to process entire basin of data
+    obs_buffer: ObsBuffer
+        contiguous storage of the arrays in obs_dict, set by extract_swot
     sos_dict: dict
         dictionary of SoS data
     sos_dir: Path
@@ -30,11 +332,17 @@ class Input:
         extracts and stores reach-level FLPE algorithm data
     extract_sos()
         extracts and stores SoS data
+    extract_sword()
+        extracts and stores SWORD data for the basin
+    extract_swot()
+        extracts and stores SWOT observations
+    map_reaches(func, *iterables)
+        map func over reaches, concurrently if workers > 1
     __get_ids(self, basin_json):
         Extract reach identifiers and store in basin_dict
     """
 
-    def __init__(self, alg_dir, sos_dir, swot_dir, sword_dir,basin_data,branch,verbose):
+    def __init__(self, alg_dir, sos_dir, swot_dir, sword_dir,basin_data,branch,verbose,sword_cache_dir=None,workers=1):
         """
         Parameters
         ----------
@@ -48,6 +356,10 @@ class Input:
             dict of reach_ids and SoS file needed to process entire basin of data
         Branch: str
             either constrained or unconstrained
+        sword_cache_dir: Path
+            directory of per-basin SWORD subset files; None disables caching
+        workers: int
+            maximum number of concurrent reach file readers; 1 reads serially
         """
 
         self.alg_dict = {
@@ -66,9 +378,15 @@ class Input:
         self.swot_dir = swot_dir
         self.branch = branch
         self.VerboseFlag = verbose
+        self.sword_cache_dir = sword_cache_dir
+        self.workers = workers
+        self.obs_buffer = None
 
     def extract_sos(self):
         """Extracts and stores SoS data in sos_dict.
+
+        Each SoS variable is read once. Basin reaches are matched to SoS rows
+        in bulk, and gage lookups use per-agency reach id maps built once.
         
         Parameters
         ----------
@@ -96,14 +414,22 @@ class Input:
 
         gage_agencies=agencystr.split(';')
 
+        # find index in the sos data array for every reach at once
+        reaches=self.basin_dict['reach_ids_all']
+        rows=find_rows(sosreachids,reaches)
+        if self.branch == 'constrained':
+            found=rows[rows>=0]
+            sources=dict(zip(found.tolist(),chartostring(overwritten_source[found,:]).tolist()))
+
+        gage_index={}
+        gage_reads={}
         n_not_found=0
-        for reach in self.basin_dict['reach_ids_all']:
+        for reach,k in zip(reaches,rows.tolist()):
             try:
                 # initialize reach dictionary
                 self.sos_dict[reach]={}
-                # find index in the sos data array
-                k=np.argwhere(sosreachids==np.int64(reach))
-                k=k[0,0]
+                if k < 0:
+                    raise LookupError(f'{reach} not in SoS')
                 # assign key data elements
                 self.sos_dict[reach]['Qbar']=sosQbars[k]
                 self.sos_dict[reach]['q33']=sosfdc[k,13] #probability = .66
@@ -112,7 +438,7 @@ class Input:
                 # assign data elements for constrained data
                 if self.branch == 'constrained':
                     self.sos_dict[reach]['overwritten_indices']=overwritten_indices[k]
-                    source_str=str(chartostring(overwritten_source[k,:]))
+                    source_str=str(sources[k])
                     self.sos_dict[reach]['overwritten_source']=source_str.strip('x')
 
 
@@ -122,16 +448,11 @@ class Input:
 
                          # extract agency gage data for each reach in the domain
                          agency=self.sos_dict[reach]['overwritten_source']
-                         num_name='num_'+ agency   +'_reaches'
-                         num_reaches=sos_dataset[agency].dimensions[num_name].size
+                         if agency not in gage_index:
+                             gage_index[agency]=self.__index_gages(sos_dataset,agency)
 
                          # determine which index in the sos corresponds to this gage
-                         igage=np.nan
-                         for i in range(num_reaches):
-                             gage_reach=str(sos_dataset[agency][agency + '_reach_id'][i])
-                             
-                             if gage_reach==reach:
-                                 igage=i
+                         igage=gage_index[agency]['index'].get(reach,np.nan)
 
                          if not np.isnan(igage):
                              #cal_status:
@@ -139,26 +460,14 @@ class Input:
                              #  validation: 0
                              #  calibration: 1
                              #  historical: 2
-                             self.sos_dict[reach]['cal_status']=sos_dataset[agency]['CAL'][igage]
-
-                         """
-                         if reach=='73120000131':
-                             print('Input - got to reach 73120000131')
-                             print(self.sos_dict[reach]['overwritten_source'])
-                             print('cal_status=',cal_status)
-                             sys.exit('stopping at dev point')
-                         """
+                             self.sos_dict[reach]['cal_status']=gage_index[agency]['CAL'][igage]
 
                          if not np.isnan(igage) and self.sos_dict[reach]['cal_status']==1:
                              self.sos_dict[reach]['gage']={}
                              self.sos_dict[reach]['gage']['source']=agency
                              self.sos_dict[reach]['gage']['t']=[]
                              self.sos_dict[reach]['gage']['Q']=[]
-
-                             self.sos_dict[reach]['gage']['t']=sos_dataset[agency][agency+'_qt'][igage,:]
-                             self.sos_dict[reach]['gage']['Q']=sos_dataset[agency][agency+'_q'][igage,:]
-                             #print('for reach',reach,'c/v=',sos_dataset[agency]['CAL'][igage])
-                             #sys.exit('stopping at dev point')
+                             gage_reads.setdefault(agency,[]).append((reach,igage))
                          
                 else:
                     self.sos_dict[reach]['overwritten_indices']=np.nan
@@ -167,19 +476,73 @@ class Input:
                 print(f'reach data not found for {reach}')
                 n_not_found+=1
 
+        # read the gage time series of calibration reaches with one read per agency
+        for agency,gages in gage_reads.items():
+            igages=np.unique([igage for reach,igage in gages])
+            try:
+                t=sos_dataset[agency][agency+'_qt'][igages,:]
+                Q=sos_dataset[agency][agency+'_q'][igages,:]
+            except Exception as e:
+                for reach,igage in gages:
+                    print(f'reach data not found for {reach}')
+                    n_not_found+=1
+                continue
+            for reach,igage in gages:
+                j=np.searchsorted(igages,igage)
+                self.sos_dict[reach]['gage']['t']=t[j,:]
+                self.sos_dict[reach]['gage']['Q']=Q[j,:]
 
         sos_dataset.close()
 
         #print('A total of ',n_not_found,' data not found')
 
+    def __index_gages(self, sos_dataset, agency):
+        """Return a map of gage reach id to gage index, and the CAL flags, for agency.
+
+        If a reach id appears more than once, the last gage is used.
+        """
+
+        gage_reach_ids=sos_dataset[agency][agency + '_reach_id'][:]
+        return {
+            "index": {str(gage_reach): i for i,gage_reach in enumerate(gage_reach_ids)},
+            "CAL": sos_dataset[agency]['CAL'][:]
+        }
 
     def extract_sword(self):
         """Extracts and stores SWORD data in sword_dict.
+
+        Only the reaches in the basin, and the reaches up to SWORD_HOPS links
+        upstream or downstream of them, are read. If sword_cache_dir is set,
+        the subset is read from (or written to) a per-basin cache file. A
+        cache written from another SWORD file, or from a SWORD file since
+        replaced, is rebuilt.
         
         Parameters
         ----------
         """
         swordfile=self.sword_dir.joinpath(self.sword_dir, self.basin_dict['sword'])
+
+        cachefile=None
+        if self.sword_cache_dir and 'basin_id' in self.basin_dict:
+            cachefile=Path(self.sword_cache_dir).joinpath(
+                Path(self.basin_dict['sword']).stem + '_' + str(self.basin_dict['basin_id']) + '.nc')
+            # taken before reading, so a SWORD file replaced during the read invalidates the cache
+            source=sword_source(swordfile)
+
+        if cachefile and cachefile.exists() and self.__sword_cache_current(cachefile,source):
+            if self.VerboseFlag:
+                print('reading SWORD subset from cache',cachefile)
+            self.__read_sword(cachefile,subset=False)
+        else:
+            self.__read_sword(swordfile,subset='basin_id' in self.basin_dict)
+            if cachefile:
+                self.__write_sword_cache(cachefile,swordfile,source)
+
+        self.sword_dict['reach_index']=index_reach_ids(self.sword_dict['reach_id'])
+
+    def __read_sword(self, swordfile, subset):
+        """Read the SWORD reach fields, only for the basin's reaches if subset."""
+
         sword_dataset=Dataset(swordfile)
 
         self.sword_dict={} #organized by field rather than by reaches
@@ -190,102 +553,135 @@ class Input:
             self.sword_dict[field]=sword_dataset['reaches'].dimensions[field].size    
 
         # grab data    
-        reachfields=['reach_id','facc','n_rch_up','n_rch_down','rch_id_up','rch_id_dn','swot_obs','swot_orbits']
-        for field in reachfields:
-            self.sword_dict[field]=sword_dataset['reaches/' + field][:]
+        if subset:
+            rows=self.__sword_subset_rows(sword_dataset)
+            self.sword_dict['num_reaches']=len(rows)
+            for field in SWORD_FIELDS:
+                self.sword_dict[field]=read_rows(sword_dataset['reaches/' + field],rows)
+        else:
+            for field in SWORD_FIELDS:
+                self.sword_dict[field]=sword_dataset['reaches/' + field][:]
  
         sword_dataset.close()
 
-    def extract_swot(self):
- 
-        self.obs_dict={}
-
-        for reach in self.basin_dict['reach_ids']:
-             reach = str(reach)
-             swotfile=self.swot_dir.joinpath(reach+'_SWOT.nc')
-             try:
-                swot_dataset = Dataset(swotfile)
-                # if self.VerboseFlag:
-                #    print(f'swot file found for {reach}')
-             except:
-                if self.VerboseFlag:
-                    print(f'swot file not found for {reach}')
-                continue
-
-             self.obs_dict[reach]={}
-             nt = swot_dataset.dimensions['nt'].size
-             self.obs_dict[reach]['nt']=nt
-             self.obs_dict[reach]['h']=swot_dataset["reach/wse"][0:nt].filled(np.nan)
-             self.obs_dict[reach]['w']=swot_dataset["reach/width"][0:nt].filled(np.nan)
-             self.obs_dict[reach]['S']=swot_dataset["reach/slope2"][0:nt].filled(np.nan)
-             self.obs_dict[reach]['dA']=swot_dataset["reach/d_x_area"][0:nt].filled(np.nan)
-             self.obs_dict[reach]['t']=swot_dataset["reach/time"][0:nt].filled(np.nan)
+    def __sword_subset_rows(self, sword_dataset):
+        """Return the sorted SWORD rows of the basin and of its neighbors.
 
+        Neighbors are followed SWORD_HOPS links along rch_id_up and rch_id_dn
+        so that junctions and dam removal can look up reaches just outside
+        the basin.
+        """
 
-             self.obs_dict[reach]['reach_q']=swot_dataset["reach/reach_q"][0:nt].filled(np.nan)
-             self.obs_dict[reach]['xovr_cal_q']=swot_dataset["reach/xovr_cal_q"][0:nt].filled(np.nan)
+        reach_ids=sword_dataset['reaches/reach_id'][:]
+        rows=basin_rows(reach_ids,self.basin_dict['basin_id'])
 
-             #print(self.obs_dict[reach]['xovr_cal_q']>0)
-             #print(self.obs_dict[reach]['reach_q']>0)
-             #print(np.isnan(self.obs_dict[reach]['dA']))
+        frontier=rows
+        for hop in range(SWORD_HOPS):
+            neighbors=np.concatenate((
+                np.ma.getdata(read_rows(sword_dataset['reaches/rch_id_up'],frontier)).ravel(),
+                np.ma.getdata(read_rows(sword_dataset['reaches/rch_id_dn'],frontier)).ravel()))
+            neighbors=np.unique(neighbors[neighbors>0])
+            found=find_rows(reach_ids,neighbors.tolist())
+            frontier=np.setdiff1d(found[found>=0],rows)
+            if len(frontier) == 0:
+                break
+            rows=np.union1d(rows,frontier)
 
-             swot_dataset.close()
+        return rows
 
-             #select observations that are NOT equal to the fill value
-             iDelete=np.where(np.isnan(self.obs_dict[reach]['h']) | \
-                              np.isnan(self.obs_dict[reach]['w']) | \
-                              np.isnan(self.obs_dict[reach]['S']) | \
-                              np.isnan(self.obs_dict[reach]['dA'])| \
-                              (self.obs_dict[reach]['reach_q'] > 1) | \
-                              (self.obs_dict[reach]['xovr_cal_q'] > 1) )
+    def __sword_cache_current(self, cachefile, source):
+        """Return True if cachefile was written from the SWORD file described by source."""
 
-             self.obs_dict[reach]['h']=np.delete(self.obs_dict[reach]['h'],iDelete,0)
-             self.obs_dict[reach]['w']=np.delete(self.obs_dict[reach]['w'],iDelete,0)
-             self.obs_dict[reach]['S']=np.delete(self.obs_dict[reach]['S'],iDelete,0)
-             self.obs_dict[reach]['dA']=np.delete(self.obs_dict[reach]['dA'],iDelete,0)
-             self.obs_dict[reach]['t']=np.delete(self.obs_dict[reach]['t'],iDelete,0)
+        try:
+            cache_dataset=Dataset(cachefile)
+        except OSError:
+            return False
+        cached={name: getattr(cache_dataset,name,None) for name in source}
+        cache_dataset.close()
+
+        if cached != source:
+            if self.VerboseFlag:
+                print('SWORD subset cache',cachefile,'is out of date, rebuilding it')
+            return False
+        return True
+
+    def __write_sword_cache(self, cachefile, swordfile, source):
+        """Write sword_dict to cachefile with the same layout as SWORD.
+
+        The attributes of source identify the SWORD file the subset was read
+        from. The file is written under a temporary name and then renamed, so
+        a job never reads a partially written cache.
+        """
 
+        tmpfile=cachefile.with_name(cachefile.name + '.' + str(os.getpid()) + '.tmp')
+        try:
+            cachefile.parent.mkdir(parents=True,exist_ok=True)
+            sword_dataset=Dataset(swordfile)
+            cache_dataset=Dataset(tmpfile,'w',format="NETCDF4")
+            cache_dataset.setncatts(source)
+            cache_dataset.basin_id=str(self.basin_dict['basin_id'])
+            reaches=cache_dataset.createGroup('reaches')
+            for field in ['orbits','num_domains','num_reaches']:
+                reaches.createDimension(field,self.sword_dict[field])
+            for field in SWORD_FIELDS:
+                var=sword_dataset['reaches/' + field]
+                cache_var=reaches.createVariable(field,var.dtype,var.dimensions,zlib=True,
+                    fill_value=getattr(var,'_FillValue',None))
+                cache_var[:]=self.sword_dict[field]
+            cache_dataset.close()
+            sword_dataset.close()
+            os.replace(tmpfile,cachefile)
+        except Exception as e:
+            warnings.warn(f'could not write SWORD cache {cachefile}: {e}')
+            if tmpfile.exists():
+                tmpfile.unlink()
 
-             self.obs_dict[reach]['iDelete']=iDelete
+    def extract_swot(self):
+        """Extracts and stores SWOT observations in obs_dict.
 
-             Smin=1.7e-5
-             self.obs_dict[reach]['S'][self.obs_dict[reach]['S']<Smin]=\
-                np.putmask(self.obs_dict[reach]['S'],self.obs_dict[reach]['S']<Smin,Smin)
+        Reach files are read by map_reaches, concurrently if workers > 1.
+        The time series of all reaches are then moved into self.obs_buffer,
+        and the arrays in obs_dict become views onto it.
+        """
+ 
+        self.obs_dict={}
 
-             #Obs.S[Obs.S<Smin]=putmask(Obs.S,Obs.S<Smin,Smin) #limit slopes to a minimum value
+        reaches=[str(reach) for reach in self.basin_dict['reach_ids']]
+        records=self.map_reaches(read_swot,[self.swot_dir]*len(reaches),reaches)
+        for reach,record in zip(reaches,records):
+             if record is None:
+                if self.VerboseFlag:
+                    print(f'swot file not found for {reach}')
+                continue
 
-             #sys.exit('stopping at dev point')
+             self.obs_dict[reach]=record
 
-             shape_iDelete=np.shape(iDelete)
-             nDelete=shape_iDelete[1]
-             self.obs_dict[reach]['nt'] -= nDelete
         if self.obs_dict == {}:
             raise LookupError('No reaches in basin processed')
 
+        self.obs_buffer=ObsBuffer(self.obs_dict)
+        self.obs_buffer.attach(self.obs_dict)
+
     def extract_alg(self):
-        """Extracts and stores reach-level FLPE algorithm data in alg_dict."""
+        """Extracts and stores reach-level FLPE algorithm data in alg_dict.
+
+        The result files of observed reaches are read by a pool of
+        self.workers workers (see map_reaches); missing files fall back to
+        the SoS Qbar and q33.
+        """
 
-        reach_ids = self.basin_dict["reach_ids"]
         reach_ids_all = self.basin_dict["reach_ids_all"]
+        observed = observed_mask(self.basin_dict)
+
+        # read FLPE results for observed reaches, in reach order
+        observed_ids = [r_id for r_id,is_observed in zip(reach_ids_all,observed) if is_observed]
+        results = self.map_reaches(read_flpe, [self.alg_dir]*len(observed_ids), observed_ids)
  
         #for r_id in reach_ids:
-        for r_id in reach_ids_all:
-            if r_id in reach_ids:
+        for r_id,is_observed in zip(reach_ids_all,observed):
+            if is_observed:
                 # for observed reaches in the domain
-                gb_file = self.alg_dir / "geobam" / f"{r_id}_geobam.nc"
-                hv_file = self.alg_dir / "hivdi" / f"{r_id}_hivdi.nc"
-                mo_file = self.alg_dir / "momma" / f"{r_id}_momma.nc"
-                sd_file = self.alg_dir / "sad" / f"{r_id}_sad.nc"
-                sv_file = self.alg_dir / "sic4dvar" / f"{r_id}_sic4dvar.nc"
-                #more robust os agnostic approach to finding files
-                mm_file = self.alg_dir / "metroman" / f"{r_id}_metroman.nc"
-
-                if not mm_file:
-                    mm_file=Path('dir/that/does/not/exist')  #this sets mm_file.exists() to false
-                else: 
-                    mm_file = Path(mm_file) 
-
-                self.__extract_valid(r_id, gb_file, hv_file, mo_file, sd_file, mm_file, sv_file)
+                self.__extract_valid(r_id, next(results))
 
             else:
                 #for unobserved reaches
@@ -296,240 +692,42 @@ class Input:
                         "qbar": np.nan
                         }
 
-    def __extract_valid(self, r_id, gb_file, hv_file, mo_file, sd_file, mm_file, sv_file):
-        """ Extract valid data from the output of each reach-level FLPE alg.
-        Parameters
-        ----------
-        r_id: str
-            Unique reach identifier
-        gb_file: Path
-            Path to neoBAM results file
-        hv_file: Path
-            Path to HiVDI results file
-        mo_file: Path
-            Path to MOMMA results file
-        sd_file: Path
-            Path to SAD results file
-        mm_file: Path
-            Path to MetroMan results file
-        sv_file: Path
-            Path to SIC4DVar results file
-        """
+    def map_reaches(self, func, *iterables):
+        """Return an iterator of func applied to iterables, in order.
 
-        # neobam
-        if gb_file.exists():
-            #print('reading',gb_file)
-            gb = Dataset(gb_file, 'r', format="NETCDF4")
-            self.alg_dict["neobam"][r_id] = {
-                "s1-flpe-exists": True,
-                "q": np.array(self.__get_gb_data(gb,"q", "q", False)),
-                "n": np.array(self.__get_gb_data(gb,"logn", "mean", True)),
-                "a0": 1.0    # TODO temp value until work out neoBAM A0
-            }
-            gb.close()
-
-        else:
-            self.alg_dict["neobam"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q" : np.nan,
-                "n" : np.nan,
-                "a0" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-
-        # hivdi
-        if hv_file.exists():
-            hv = Dataset(hv_file, 'r', format="NETCDF4")
-            self.alg_dict["hivdi"][r_id] = {
-                "s1-flpe-exists": True,
-                "q" : hv["reach"]["Q"][:].filled(np.nan),
-                "alpha" : hv["reach"]["alpha"][:].filled(np.nan),  
-                "beta" : hv["reach"]["beta"][:].filled(np.nan),  
-                "a0" : hv["reach"]["A0"][:].filled(np.nan)
-            }
-            hv.close()
-        else:
-            self.alg_dict["hivdi"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q" : np.nan,
-                "alpha" : np.nan,
-                "beta" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-
-        # momma
-        if mo_file.exists():
-            mo = Dataset(mo_file, 'r', format="NETCDF4")
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", category=RuntimeWarning)
-                self.alg_dict["momma"][r_id] = {
-                    "s1-flpe-exists": True,
-                    "q" : mo["Q"][:].filled(np.nan),
-                    "B" : mo["zero_flow_stage"][:].filled(np.nan),
-                    "H" : mo["bankfull_stage"][:].filled(np.nan),                                  
-                    "Save" : np.nanmean(mo["slope"][:].filled(np.nan))
-                }
-            mo.close()
-        else:
-            self.alg_dict["momma"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q" : np.nan,
-                "B" : np.nan,
-                "H" : np.nan,
-                "Save" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-
-        # sad
-        if sd_file.exists():
-            sd = Dataset(sd_file, 'r', format="NETCDF4")
-            self.alg_dict["sad"][r_id] = {
-                "s1-flpe-exists": True,
-                "q" : sd["Qa"][:].filled(np.nan),
-                "n" : sd["n"][:].filled(np.nan),
-                "a0" : sd["A0"][:].filled(np.nan)
-            }
-            sd.close()
-        else:
-            self.alg_dict["sad"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q" : np.nan,
-                "n" : np.nan,
-                "a0" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-
-        # metroman    
-        if mm_file.exists():
-            mm = Dataset(mm_file, 'r', format="NETCDF4")
-            # index = np.where(mm["reach_id"][:] == int(r_id))
-            self.alg_dict["metroman"][r_id] = {
-                 "s1-flpe-exists": True,
-                 "q" : mm["average"]["allq"][:].filled(np.nan),
-                 "na" : mm["average"]["nahat"][:].filled(np.nan),
-                 "x1" : mm["average"]["x1hat"][:].filled(np.nan),
-                 "a0" : mm["average"]["A0hat"][:].filled(np.nan)
-            }
-            mm.close()
-            #print('MetroMan file found. ')
-        else:
-            self.alg_dict["metroman"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q" : np.nan,
-                "na" : np.nan,
-                "x1" : np.nan,
-                "a0" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-            #print('MetroMan file not found. Using prior')
-
-        # sic4dvar
-        if sv_file.exists():
-            sv = Dataset(sv_file, 'r', format="NETCDF4")
-            self.alg_dict["sic4dvar"][r_id] = {
-                #"q31": sv["Qalgo31"][:].filled(np.nan),#unclear which of these to use
-                "s1-flpe-exists": True,
-                "q_mm": sv["Q_mm"][:].filled(np.nan),
-                "q": sv["Q_da"][:].filled(np.nan),
-                # "q5": sv["Qalgo5"][:].filled(np.nan),
-                "n": sv["n"][:].filled(np.nan),
-                "a0": sv["A0"][:].filled(np.nan)
-            }
-            sv.close()
-        else:
-            self.alg_dict["sic4dvar"][r_id] = { 
-                "s1-flpe-exists" : False ,
-                "q_mm": np.nan,
-                "q": np.nan,
-                "n" : np.nan,
-                "a0" : np.nan,
-                "qbar" : self.sos_dict[str(r_id)]['Qbar'],
-                "q33" : self.sos_dict[str(r_id)]['q33']
-            }
-
-    def __indicate_no_data(self, r_id):
-        """Indicate no data is available for the reach.
-        TODO: Metroman results
-        Parameters
-        ----------
-        r_id: str
-            Unique reach identifier
+        With more than one worker the calls run in a pool of at most
+        self.workers processes, which bounds the number of files open at
+        once on the shared file system. Processes rather than threads are
+        used because the netCDF/HDF5 libraries are not thread-safe.
         """
 
-        self.alg_dict["neobam"][r_id] = {
-            "q": np.nan,
-            "n": np.nan,
-            "a0": np.nan
-        }
+        if self.workers <= 1:
+            return map(func, *iterables)
+        return self.__map_pool(func, *iterables)
 
-        # hivdi
-        self.alg_dict["hivdi"][r_id] = {
-            "q" : np.nan,
-            "alpha" : np.nan,  
-            "beta" : np.nan,  
-            "a0" : np.nan
-        }
+    def __map_pool(self, func, *iterables):
+        """Generator for map_reaches; the pool is shut down when it is exhausted."""
 
-        # momma
-        self.alg_dict["momma"][r_id] = {
-            "q" : np.nan,
-            "B" : np.nan,
-            "H" : np.nan,
-            "Save" : np.nan
-        }
-
-        # sad
-        self.alg_dict["sad"][r_id] = {
-            "q" : np.nan,
-            "n" : np.nan,
-            "a0" : np.nan
-        }
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(func, *iterables, chunksize=8)
 
-        # metroman    
-        self.alg_dict["metroman"][r_id] = {
-             "q" : np.nan,
-             "na" : np.nan,
-             "x1" : np.nan,
-             "a0" : np.nan
-        }
-
-        # sic4dvar
-        self.alg_dict["sic4dvar"][r_id] = {
-            "q_mm": np.nan,
-            "q": np.nan,
-            "n": np.nan,
-            "a0": np.nan
-        }
-
-    def __get_gb_data(self, gb,group, pre, logged):
-        """Return neoBAM data as a numpy array.
-        
+    def __extract_valid(self, r_id, results):
+        """ Store the output of each reach-level FLPE alg, or the SoS prior if missing.
         Parameters
         ----------
-        gb: netCDF4.Dataset
-            NetCDF file dataset to extract discharge time series
-        group: str
-            string name of group to access chains
-        pre: str
-            string prefix of variable name
-        logged: bool
-            boolean indicating if result is logged
+        r_id: str
+            Unique reach identifier
+        results: dict
+            data read by read_flpe for each algorithm, None if the file is missing
         """
 
-        q = gb[group][pre][:].filled(np.nan)
-        # chain2 = gb[group][f"{pre}2"][:].filled(np.nan)
-        # chain3 = gb[group][f"{pre}3"][:].filled(np.nan)
-
-        # chains = np.vstack((chain1, chain2, chain3))
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            if logged:
-                return np.exp(np.nanmean(q, axis=0))
+        for alg,result in results.items():
+            if result is not None:
+                self.alg_dict[alg][r_id] = {"s1-flpe-exists": True}
+                self.alg_dict[alg][r_id].update(result)
             else:
-                return np.nanmean(q, axis=0)
+                self.alg_dict[alg][r_id] = {"s1-flpe-exists": False}
+                for field in FLPE_MISSING[alg]:
+                    self.alg_dict[alg][r_id][field] = np.nan
+                self.alg_dict[alg][r_id]["qbar"] = self.sos_dict[str(r_id)]['Qbar']
+                self.alg_dict[alg][r_id]["q33"] = self.sos_dict[str(r_id)]['q33']
@@ -1,4 +1,5 @@
 #Standard imports
+from concurrent.futures import ProcessPoolExecutor
 import warnings
 import sys
 import datetime
@@ -10,6 +11,151 @@ from scipy import optimize
 from scipy.linalg import solve
 from numpy import random
 
+# Local imports
+from moi.Adjustment import LowRankAdjustment, NonnegativeAdjustment
+from moi.ObsBuffer import ObsBuffer
+from moi.Topology import Topology
+
+# algorithms with a flow law, in the order their FLPs are fit, and their names
+FLP_NAMES={
+     'neobam': 'GeoBAM',
+     'hivdi': 'HiVDI',
+     'metroman': 'MetroMan',
+     'momma': 'MOMMA',
+     'sad': 'SAD',
+     'sic4dvar': 'SIC4DVar'
+}
+
+# flow law parameters stored in the integrator results of each algorithm
+FLP_PARAMS={
+     'neobam': ['n','a0'],
+     'hivdi': ['alpha','beta','Abar'],
+     'metroman': ['na','x1','a0'],
+     'momma': ['B','H','Save'],
+     'sad': ['n','a0'],
+     'sic4dvar': ['n','a0']
+}
+
+# flow law of each algorithm
+FLOW_LAWS={
+     'neobam': 'bam',
+     'hivdi': 'hivdi',
+     'metroman': 'metroman',
+     'momma': 'momma',
+     'sad': 'sad',
+     'sic4dvar': 'sic4dvar'
+}
+
+def residual_change(previous,residuals):
+     """Return the largest relative change in the residuals between two iterations.
+
+     For each algorithm the change is |r_new - r_old| / |r_new| over the reaches
+     with finite residuals. Returns inf if the reaches with finite residuals
+     differ, as they do after the first iteration.
+     """
+
+     change=0.
+     for alg in residuals:
+          finite=np.isfinite(residuals[alg])
+          if not np.array_equal(finite,np.isfinite(previous[alg])):
+               return np.inf
+          diff=np.linalg.norm(residuals[alg][finite]-previous[alg][finite])
+          if diff > 0.:
+               change=max(change,diff/np.linalg.norm(residuals[alg][finite]))
+     return change
+
+def quantile_index(n,p):
+     """Return the order statistics (lo, hi) and weight for the p quantile of n values.
+
+     Follows the default 'linear' method of np.quantile, including its
+     floating point arithmetic, so that nanquantile matches np.nanquantile.
+     """
+
+     virtual=(n-1)*p
+     if virtual >= n-1:
+          return n-1,n-1,0.
+     lo=int(np.floor(virtual))
+     return lo,lo+1,virtual-lo
+
+def nanquantile(q,p):
+     """Return np.nanquantile(q,p) for a scalar p, using np.partition.
+
+     Only the two order statistics that are interpolated are placed, on the
+     non-nan values, which avoids the overhead of np.nanquantile in
+     objective functions that are evaluated many times.
+     """
+
+     q=np.ravel(q)
+     values=q[~np.isnan(q)]
+     if len(values) == 0:
+          return np.float64(np.nan)
+     lo,hi,gamma=quantile_index(len(values),p)
+     values=np.partition(values,(lo,hi))
+     diff=values[hi]-values[lo]
+     if gamma >= 0.5:
+          return values[hi]-diff*(1-gamma)
+     return values[lo]+diff*gamma
+
+def segment_ids(offsets):
+     """Return the segment of each value of a ragged array with the given offsets."""
+
+     return np.repeat(np.arange(len(offsets)-1),np.diff(offsets))
+
+def segment_nanmean(values,offsets):
+     """Return np.nanmean of each segment values[offsets[i]:offsets[i+1]]."""
+
+     values=np.ravel(values)
+     segment=segment_ids(offsets)
+     valid=~np.isnan(values)
+     count=np.bincount(segment[valid],minlength=len(offsets)-1)
+     total=np.bincount(segment[valid],weights=values[valid],minlength=len(offsets)-1)
+     with np.errstate(invalid='ignore',divide='ignore'):
+          return total/count
+
+def segment_nanquantile(values,offsets,p):
+     """Return nanquantile of each segment values[offsets[i]:offsets[i+1]].
+
+     The values are sorted within segments once, with nans last, and each
+     segment's quantile is interpolated as in nanquantile, so the results
+     match nanquantile on each segment exactly.
+     """
+
+     values=np.ravel(values)
+     if len(values) == 0:
+          return np.full(len(offsets)-1,np.nan)
+     segment=segment_ids(offsets)
+     valid=~np.isnan(values)
+     ordered=values[np.lexsort((values,~valid,segment))]
+     n=np.bincount(segment[valid],minlength=len(offsets)-1)
+
+     virtual=(n-1)*p
+     last=virtual >= n-1
+     lo=np.where(last,n-1,np.floor(virtual)).astype(np.int64)
+     hi=np.where(last,n-1,lo+1)
+     gamma=np.where(last,0.,virtual-lo)
+
+     # segments without values index anywhere in range; they are set to nan below
+     start=offsets[:-1]
+     lo_value=ordered[np.clip(start+lo,0,len(values)-1)]
+     hi_value=ordered[np.clip(start+hi,0,len(values)-1)]
+     with np.errstate(invalid='ignore'):
+          diff=hi_value-lo_value
+          quantile=np.where(gamma >= 0.5,hi_value-diff*(1-gamma),lo_value+diff*gamma)
+     quantile[n == 0]=np.nan
+     return quantile
+
+def fit_flps(payload):
+     """Fit the flow law of one (algorithm, reach) pair.
+
+     payload is (alg, reach, obs, flpe, jac), where obs is the reach's
+     obs_dict entry, flpe its alg_dict entry and jac selects analytic
+     gradients. Defined at module level so that it can run in a worker
+     process.
+     """
+
+     alg,reach,obs,flpe,jac=payload
+     return getattr(Integrate,'fit_'+alg)(reach,obs,flpe,jac)
+
 class Integrate:
      """Integrates reach-level FLPE algorithm data.
      Attributes
@@ -32,7 +178,7 @@ class Integrate:
          integrate and store reach-level data
      """
 
-     def __init__(self, alg_dict, basin_dict, sos_dict, sword_dict, obs_dict,params_dict,Branch,VerboseFlag):
+     def __init__(self, alg_dict, basin_dict, sos_dict, sword_dict, obs_dict,params_dict,Branch,VerboseFlag,obs_buffer=None):
           """
           Parameters
           ----------
@@ -51,12 +197,22 @@ class Integrate:
           Branch: string
                constrained or unconstrained
           VerboseFlag: logical
+          obs_buffer: ObsBuffer
+               the observations of obs_dict in one buffer (Input.obs_buffer);
+               None builds it from obs_dict when first needed
           """
 
           self.alg_dict = alg_dict
           self.basin_dict = basin_dict
           self.obs_dict = obs_dict
+          self.obs_buffer = obs_buffer
           self.sword_dict = sword_dict
+          self.sword_index = sword_dict['reach_index']
+          self.observed_reaches = set(basin_dict['reach_ids'])
+          self.deferred_uncertainty = {}
+          self.convergence = {}
+          self.reach_columns = {}
+          self.sword_rows = None
           self.integ_dict = {
                "pre_q_mean": np.array([]),
                "q_mean": np.array([]),
@@ -73,6 +229,7 @@ class Integrate:
           self.sos_dict = sos_dict
           self.Branch=Branch
           self.VerboseFlag = VerboseFlag
+          self.topology = None
           print('getting pre mean q')
           self.get_pre_mean_q()
 
@@ -91,7 +248,7 @@ class Integrate:
                             
                             if self.alg_dict[alg][reach]['s1-flpe-exists']:
                                 self.alg_dict[alg][reach]['qbar']=np.nanmean(self.alg_dict[alg][reach]['q'])
-                                self.alg_dict[alg][reach]['q33']=np.nanquantile(self.alg_dict[alg][reach]['q'],.33)
+                                self.alg_dict[alg][reach]['q33']=nanquantile(self.alg_dict[alg][reach]['q'],.33)
                             
                             if np.isnan(self.alg_dict[alg][reach]['qbar']):
                                 self.alg_dict[alg][reach]['qbar']=self.sos_dict[str(reach)]['Qbar']
@@ -138,7 +295,7 @@ class Integrate:
                      if gagedQs:
                          try:
                              Qbar=np.nanmean(gagedQs)
-                             Q33=np.nanquantile(gagedQs,.33)
+                             Q33=nanquantile(gagedQs,.33)
                              self.sos_dict[str(reach)]['gage']['Qbar']=Qbar
                              self.sos_dict[str(reach)]['gage']['q33']=Q33
                          except:
@@ -169,32 +326,34 @@ class Integrate:
 
      def ChecksPriorToAddingJunction(self,junction_to_check):
         #check to see if this one already exists
-         AlreadyExists=False
-         for junction in self.junctions:
-             if junction['upflows']==junction_to_check['upflows'] and junction['downflows']==junction_to_check['downflows']: 
-                 AlreadyExists=True    
+         AlreadyExists=self.junction_key(junction_to_check) in self.junction_keys
     
          #check to see if all reaches we've identified area in the basin 
          AllReachesInReachFile=True
          for r in junction_to_check['upflows']:
-             if str(r) not in self.basin_dict['reach_ids_all']:
+             if str(r) not in self.reach_ids_all_set:
                  AllReachesInReachFile=False
          for r in junction_to_check['downflows']:
-             if str(r) not in self.basin_dict['reach_ids_all']:
+             if str(r) not in self.reach_ids_all_set:
                  AllReachesInReachFile=False            
             
          return AlreadyExists,AllReachesInReachFile
 
+     def junction_key(self,junction):
+         return tuple(junction['upflows']),tuple(junction['downflows'])
+
      def CreateJunctionList(self):
          # create list of junctions
          self.junctions=list()
+         self.junction_keys=set()
+         self.reach_ids_all_set=set(self.basin_dict['reach_ids_all'])
+         self.topology=None
 
          self.junctions_valid=True
 
          for reach in self.basin_dict['reach_ids_all']:
              reach=np.int64(reach)
-             k=np.argwhere(self.sword_dict['reach_id'] == reach)
-             k=k[0,0]
+             k=self.sword_index[reach]
     
              # extract reach dictionary for reach k
              sword_data_reach=self.pull_sword_attributes_for_reach(k) 
@@ -219,8 +378,7 @@ class Integrate:
                     self.junctions_valid=False
                     continue
 
-                 kup=np.argwhere(self.sword_dict['reach_id'] == junction_up['upflows'][0])
-                 kup=kup[0,0]
+                 kup=self.sword_index[junction_up['upflows'][0]]
                  sword_data_reach_up=self.pull_sword_attributes_for_reach(kup)
                  for j in range(sword_data_reach_up['n_rch_down']):
                      junction_up['downflows'].append(sword_data_reach_up['rch_id_dn'][j] )
@@ -230,6 +388,7 @@ class Integrate:
                  if not AlreadyExists and AllReachesInReachFile:
                  #if not AlreadyExists:
                      self.junctions.append(junction_up)
+                     self.junction_keys.add(self.junction_key(junction_up))
 
              #2 try adding the downstream junction
              junction_dn=dict()
@@ -251,8 +410,7 @@ class Integrate:
                     self.junctions_valid=False
                     continue
 
-                 kdn=np.argwhere(self.sword_dict['reach_id'] == junction_dn['downflows'][0])
-                 kdn=kdn[0,0]
+                 kdn=self.sword_index[junction_dn['downflows'][0]]
                  sword_data_reach_dn=self.pull_sword_attributes_for_reach(kdn)
                  for j in range(sword_data_reach_dn['n_rch_up']):
                      junction_dn['upflows'].append(sword_data_reach_dn['rch_id_up'][j] )
@@ -269,11 +427,11 @@ class Integrate:
                  if not AlreadyExists and AllReachesInReachFile:
                  #if not AlreadyExists:
                      self.junctions.append(junction_dn) 
+                     self.junction_keys.add(self.junction_key(junction_dn))
 
      def RemoveDamReaches(self):
          for reachid in self.basin_dict['reach_ids']:
-             k=np.argwhere(self.sword_dict['reach_id']==int(reachid))
-             k=k[0,0]
+             k=self.sword_index[int(reachid)]
     
              if self.sword_dict['n_rch_down'][k] == 1:
                  # 0. find the reach downstream of the target reach
@@ -282,14 +440,12 @@ class Integrate:
                  # if the reach downstream of the target reach is a dam...
                  if rid_down[-1] == '4':
             
-                     k_down=np.argwhere(self.sword_dict['reach_id']==int(rid_down))
-                     k_down=k_down[0,0]
+                     k_down=self.sword_index[int(rid_down)]
             
                      # 1. find the reach downstream of the reach downstream of the target reach
                      if self.sword_dict['n_rch_down'][k_down] == 1:
                          rid_down_down=str(self.sword_dict['rch_id_dn'][0,k_down])
-                         k_down_down=np.argwhere(self.sword_dict['reach_id']==int(rid_down_down))
-                         k_down_down=k_down_down[0,0]             
+                         k_down_down=self.sword_index[int(rid_down_down)]
                                 
                          if rid_down_down[-1] == '1':
 #                             if self.VerboseFlag:
@@ -307,8 +463,7 @@ class Integrate:
                     
                                  #1b. find the reach downstream of the reach downstream of the reach downstream of the target reach
                                  rid_down_down_down=str(self.sword_dict['rch_id_dn'][0,k_down_down])
-                                 k_down_down_down=np.argwhere(self.sword_dict['reach_id']==int(rid_down_down_down))
-                                 k_down_down_down=k_down_down_down[0,0]        
+                                 k_down_down_down=self.sword_index[int(rid_down_down_down)]
                         
                                  if rid_down_down_down[-1]=='1':
                                      #2b. point the target reach at the reach downstream of the reach downstream of the reach downstream of the target reach
@@ -322,23 +477,78 @@ class Integrate:
          # Qbar - prior value of Q e.g. stage 1 McFLI
          # sigmaQ - vector of Q uncertainty
          n=np.size(Q,0)
-         C=np.diag( np.reshape(sigmaQ**-1,[n,]) )
-         d=Qbar*sigmaQ**(-1)
-         res=C@Q-d
+         w=np.reshape(sigmaQ**-1,[n,])
+         res=w*Q-Qbar*sigmaQ**(-1)
          y=np.linalg.norm(res,2)
          return y
 
 
-     def bam_objfun(self,params,obs,qbar_target,q33_target): 
-          qbam=self.bam_flowlaw(params,obs)
+     @staticmethod
+     def nanquantile_grad(q,dq,p):
+          """Return the gradient of np.nanquantile(q,p) given dq, the gradients of q.
+
+          With linear interpolation the quantile is a weighted sum of two
+          order statistics, so its gradient is the same weighted sum of their
+          gradients (exact wherever the ordering of q does not change).
+          """
+
+          valid=np.flatnonzero(~np.isnan(q))
+          if len(valid) == 0:
+               return np.zeros(np.shape(dq)[0])
+          lo,hi,gamma=quantile_index(len(valid),p)
+          order=valid[np.argpartition(q[valid],(lo,hi))]
+          return (1-gamma)*dq[:,order[lo]] + gamma*dq[:,order[hi]]
+
+     @staticmethod
+     def flowlaw_objfun_grad(q,dq,qbar_target,q33_target,absolute=False):
+          """Return the mean/q33 misfit of a flow law and its gradient.
+
+          The misfit is computed exactly as in the *_objfun functions: squared
+          errors, or absolute errors if absolute is True. dq holds the
+          gradient of q with respect to each parameter, one row per parameter.
+          """
+
+          q=np.reshape(q,(-1,))
+          valid=~np.isnan(q)
+          dqbar=np.mean(dq[:,valid],axis=1) if np.any(valid) else np.zeros(np.shape(dq)[0])
+
+          qbar=np.nanmean(q)
+          if absolute:
+               y=abs(qbar-qbar_target)
+               grad=np.sign(qbar-qbar_target)*dqbar
+          else:
+               y=(qbar-qbar_target)**2
+               grad=2*(qbar-qbar_target)*dqbar
+          if not np.isnan(q33_target):
+               q33_alg=nanquantile(q,.33)
+               dq33=Integrate.nanquantile_grad(q,dq,.33)
+               if absolute:
+                    y+=abs(q33_alg-q33_target)
+                    grad=grad+np.sign(q33_alg-q33_target)*dq33
+               else:
+                    y+=(q33_alg-q33_target)**2 
+                    grad=grad+2*(q33_alg-q33_target)*dq33
+          return y,grad
+
+     @staticmethod
+     def bam_objfun(params,obs,qbar_target,q33_target): 
+          qbam=Integrate.bam_flowlaw(params,obs)
           qbam_bar=np.nanmean(qbam)
           y=(qbam_bar-qbar_target)**2
           if not np.isnan(q33_target):
-             qbam_33=np.nanquantile(qbam,.33)
+             qbam_33=nanquantile(qbam,.33)
              y+=(qbam_33-q33_target)**2 
           return y
 
-     def bam_flowlaw(self,params,obs):
+     @staticmethod
+     def bam_objfun_grad(params,obs,qbar_target,q33_target): 
+          """bam_objfun and its gradient with respect to (n, Abar)."""
+          qbam=Integrate.bam_flowlaw(params,obs)[0]
+          dq=np.vstack((-qbam/params[0], 5/3*qbam/(obs['dA']+params[1])))
+          return Integrate.flowlaw_objfun_grad(qbam,dq,qbar_target,q33_target)
+
+     @staticmethod
+     def bam_flowlaw(params,obs):
           d_x_area=obs['dA']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -350,16 +560,26 @@ class Integrate:
           qbam=np.reshape(qbam,(1,len(d_x_area)))
           return qbam
 
-     def hivdi_objfun(self,params,obs,qbar_target,q33_target): 
-          q=self.hivdi_flowlaw(params,obs)
+     @staticmethod
+     def hivdi_objfun(params,obs,qbar_target,q33_target): 
+          q=Integrate.hivdi_flowlaw(params,obs)
           qbar=np.nanmean(q)
           y=(qbar-qbar_target)**2
           if not np.isnan(q33_target):
-             q33_alg=np.nanquantile(q,.33)
+             q33_alg=nanquantile(q,.33)
              y+=(q33_alg-q33_target)**2 
           return y
 
-     def hivdi_flowlaw(self,params,obs):
+     @staticmethod
+     def hivdi_objfun_grad(params,obs,qbar_target,q33_target): 
+          """hivdi_objfun and its gradient with respect to (alpha, beta, Abar)."""
+          q=Integrate.hivdi_flowlaw(params,obs)[0]
+          A=obs['dA']+params[2]
+          dq=np.vstack((q/params[0], q*np.log(A/obs['w']), (5/3+params[1])*q/A))
+          return Integrate.flowlaw_objfun_grad(q,dq,qbar_target,q33_target)
+
+     @staticmethod
+     def hivdi_flowlaw(params,obs):
           d_x_area=obs['dA']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -375,18 +595,28 @@ class Integrate:
           qhivdi=np.reshape(qhivdi,(1,len(d_x_area)))
           return qhivdi
 
-     def metroman_objfun(self,params,obs,qbar_target,q33_target): 
-          q=self.metroman_flowlaw(params,obs)
+     @staticmethod
+     def metroman_objfun(params,obs,qbar_target,q33_target): 
+          q=Integrate.metroman_flowlaw(params,obs)
           qbar=np.nanmean(q)
           #y=(qbar-qbar_target)**2
           y=abs(qbar-qbar_target)
           if not np.isnan(q33_target):
-             q33_alg=np.nanquantile(q,.33)
+             q33_alg=nanquantile(q,.33)
              #y+=(q33_alg-q33_target)**2 
              y+=abs(q33_alg-q33_target)
           return y
 
-     def metroman_flowlaw(self,params,obs):
+     @staticmethod
+     def metroman_objfun_grad(params,obs,qbar_target,q33_target): 
+          """metroman_objfun and its gradient with respect to (ninf, p, Abar)."""
+          q=Integrate.metroman_flowlaw(params,obs)[0]
+          A=obs['dA']+params[2]
+          dq=np.vstack((-q/params[0], -q*np.log(A/obs['w']), (5/3-params[1])*q/A))
+          return Integrate.flowlaw_objfun_grad(q,dq,qbar_target,q33_target,absolute=True)
+
+     @staticmethod
+     def metroman_flowlaw(params,obs):
           d_x_area=obs['dA']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -403,15 +633,16 @@ class Integrate:
           metro_q=np.reshape(metro_q,(1,len(d_x_area)))
           return metro_q
 
-     def momma_objfun(self,params,obs,qbar_target,q33_target,aux_var): 
-          q=self.momma_flowlaw(params,obs,aux_var)
+     @staticmethod
+     def momma_objfun(params,obs,qbar_target,q33_target,aux_var): 
+          q=Integrate.momma_flowlaw(params,obs,aux_var)
           if np.all(np.isnan(q)):
               return 1e9
           qbar=np.nanmean(q)
           y=(qbar-qbar_target)**2
 
           if not np.isnan(q33_target):
-             q33_alg=np.nanquantile(q,.33)
+             q33_alg=nanquantile(q,.33)
              y+=(q33_alg-q33_target)**2 
 
           #impose a penalty if bankfull depth gets too low
@@ -428,7 +659,8 @@ class Integrate:
 
           return y
 
-     def momma_flowlaw(self,params,obs,aux_var):
+     @staticmethod
+     def momma_flowlaw(params,obs,aux_var):
           reach_height=obs['h']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -439,45 +671,48 @@ class Integrate:
           momma_r = 2
           momma_nb = 0.11 * momma_Save**0.18
 
-          momma_q=np.empty( (obs['nt'],)) 
-
           if momma_H <= momma_B+0.1:
                momma_q=np.inf
           else:
-               for t in range(obs['nt']):
-                    if momma_B > reach_height[t]:
-                        print('MOMMA flow law got B > Hobs')
-                        print('reach height=',reach_height[t])
-                    log_factor = np.log10((momma_H-momma_B)/(reach_height[t]-momma_B))
-
-                    if reach_height[t] <= momma_H:
-                         momma_n = momma_nb*(1+log_factor)
-                         log_check = log_factor > -1
-                    else:
-                         momma_n = momma_nb*(1-log_factor)
-                         log_check = log_factor < 1
+               # heights below B give nan, as in the riverobs loop
+               log_factor = np.log10((momma_H-momma_B)/(reach_height-momma_B))
+
+               momma_n = np.where(reach_height <= momma_H,
+                                  momma_nb*(1+log_factor),
+                                  momma_nb*(1-log_factor))
 
-                    momma_q[t] = (
-                         ((reach_height[t] - momma_B)*(momma_r/(1+momma_r)))**(5/3) *
-                         reach_width[t] * reach_slope[t]**(1/2)) / momma_n
+               momma_q = (
+                    ((reach_height - momma_B)*(momma_r/(1+momma_r)))**(5/3) *
+                    reach_width * reach_slope**(1/2)) / momma_n
 
                momma_q=np.reshape(momma_q,(1,len(reach_height)))
           return momma_q
 
-     def sad_objfun(self,params,obs,qbar_target,q33_target): 
-          qsad=self.sad_flowlaw(params,obs)
+     @staticmethod
+     def sad_objfun(params,obs,qbar_target,q33_target): 
+          qsad=Integrate.sad_flowlaw(params,obs)
           if np.all(np.isnan(qsad)):
               return 1e9
           qsad_bar=np.nanmean(qsad)
           y=(qsad_bar-qbar_target)**2
 
           if not np.isnan(q33_target):
-             q33_alg=np.nanquantile(qsad,.33)
+             q33_alg=nanquantile(qsad,.33)
              y+=(q33_alg-q33_target)**2 
           
           return y
 
-     def sad_flowlaw(self,params,obs):
+     @staticmethod
+     def sad_objfun_grad(params,obs,qbar_target,q33_target): 
+          """sad_objfun and its gradient with respect to (n, Abar)."""
+          qsad=Integrate.sad_flowlaw(params,obs)[0]
+          if np.all(np.isnan(qsad)):
+              return 1e9,np.zeros(2)
+          dq=np.vstack((-qsad/params[0], 5/3*qsad/(obs['dA']+params[1])))
+          return Integrate.flowlaw_objfun_grad(qsad,dq,qbar_target,q33_target)
+
+     @staticmethod
+     def sad_flowlaw(params,obs):
           d_x_area=obs['dA']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -489,13 +724,22 @@ class Integrate:
           qsad=np.reshape(qsad,(1,len(d_x_area)))
           return qsad
 
-     def sic4dvar_objfun(self,params,obs,qbar_target): 
-          qsic4dvar=self.sic4dvar_flowlaw(params,obs)
+     @staticmethod
+     def sic4dvar_objfun(params,obs,qbar_target): 
+          qsic4dvar=Integrate.sic4dvar_flowlaw(params,obs)
           qsic4dvar_bar=np.nanmean(qsic4dvar)
           y=abs(qsic4dvar_bar-qbar_target)
           return y
 
-     def sic4dvar_flowlaw(self,params,obs):
+     @staticmethod
+     def sic4dvar_objfun_grad(params,obs,qbar_target): 
+          """sic4dvar_objfun and its gradient with respect to (n, Abar)."""
+          qsic4dvar=Integrate.sic4dvar_flowlaw(params,obs)[0]
+          dq=np.vstack((-qsic4dvar/params[0], 5/3*qsic4dvar/(obs['dA']+params[1])))
+          return Integrate.flowlaw_objfun_grad(qsic4dvar,dq,qbar_target,np.nan,absolute=True)
+
+     @staticmethod
+     def sic4dvar_flowlaw(params,obs):
           d_x_area=obs['dA']
           reach_width=obs['w']
           reach_slope=obs['S']
@@ -507,179 +751,194 @@ class Integrate:
           qsic4dvar=np.reshape(qsic4dvar,(1,len(d_x_area)))
           return qsic4dvar
 
+     @staticmethod
+     def basin_flowlaw(alg,params,obs):
+          """Evaluate the flow law of alg for every reach of an ObsBuffer in one call.
+
+          params holds one array per parameter in FLP_PARAMS[alg], with one
+          value per reach of obs (MOMMA's Save is its third parameter).
+          Returns the flows of all reaches, shape (1, obs['nt']); each
+          reach's segment equals its per-reach flow law, except that MOMMA
+          reaches with H <= B+0.1 get inf in every time step.
+          """
+
+          if alg != 'momma':
+               return getattr(Integrate,FLOW_LAWS[alg]+'_flowlaw')([obs.expand(p) for p in params],obs)
+
+          reach_height=obs['h']
+          reach_width=obs['w']
+          reach_slope=obs['S']
+          momma_B=obs.expand(params[0])
+          momma_H=obs.expand(params[1])
+          momma_r = 2
+          # scalar powers, as momma_flowlaw, since numpy's array power can differ in the last bit
+          momma_nb = obs.expand([0.11 * Save**0.18 for Save in params[2]])
+
+          log_factor = np.log10((momma_H-momma_B)/(reach_height-momma_B))
+          momma_n = np.where(reach_height <= momma_H,
+                             momma_nb*(1+log_factor),
+                             momma_nb*(1-log_factor))
+          momma_q = (
+               ((reach_height - momma_B)*(momma_r/(1+momma_r)))**(5/3) *
+               reach_width * reach_slope**(1/2)) / momma_n
+          momma_q[momma_H <= momma_B+0.1]=np.inf
+          return np.reshape(momma_q,(1,len(reach_height)))
+
+     @staticmethod
+     def basin_flow_stats(alg,params,obs):
+          """Return basin_flowlaw(alg,params,obs) and the mean and q33 flow of each reach."""
+
+          q=Integrate.basin_flowlaw(alg,params,obs)
+          return q,segment_nanmean(q,obs.offsets),segment_nanquantile(q,obs.offsets,.33)
+
      def calcG(self,m,n):
-        #define G matrix
-        G=np.zeros((m,n))
-
-        for junction in self.junctions:
-            row=junction['row_num']
-            upcols=list()
-            for upflow in junction['upflows']:
-                try:
-                     kup=self.basin_dict['reach_ids_all'].index(str(upflow))
-                     upcols.append(kup)
-                except: 
-                    print('did not find reach:',upflow)
-                    print('... in junction',junction)
-
-            downcols=list()
-            for downflow in junction['downflows']:
-                try:
-                     kdn=self.basin_dict['reach_ids_all'].index(str(downflow))
-                     downcols.append(kdn)
-                except:
-                     print('did not find reach',downflow)
-                     print('... in junction',junction)
-
-            for upcol in upcols:
-                G[row,upcol]=1
-            for downcol in downcols:
-                G[row,downcol]=-1
-
-        return G
+        """Return the sparse m x n mass conservation matrix G.
+
+        G is built once per basin from the junction list and cached in
+        self.topology, so repeated calls across algorithms, iterations and
+        flow levels do not rebuild it.
+        """
+        if self.topology is None:
+            self.topology=Topology(self.junctions,self.basin_dict['reach_ids_all'])
+
+        return self.topology.G
+
+     def integration_columns(self,alg):
+         """Return the per-reach inputs of initialize_integration_vars as arrays.
+
+         The algorithm's qbar and q33, the SoS outlier check against them, the
+         gage values and facc do not change between iterations or flow levels,
+         so they are gathered once per algorithm, in the order of reach_ids_all,
+         and cached in self.reach_columns.
+         """
+
+         if alg in self.reach_columns:
+             return self.reach_columns[alg]
+
+         reaches=self.basin_dict['reach_ids_all']
+         n=len(reaches)
+         if self.sword_rows is None:
+             self.sword_rows=np.array([self.sword_index[np.int64(reach)] for reach in reaches],dtype=np.int64)
+         facc=np.ma.filled(np.ma.asarray(self.sword_dict['facc'],dtype=np.float64)[self.sword_rows],np.nan)
+
+         columns={
+             'facc':facc,
+             'in_alg':np.zeros(n,dtype=bool),
+             'gaged':np.zeros(n,dtype=bool),
+             'Mean':np.full(n,np.nan),
+             'q33':np.full(n,np.nan),
+             'gage_Mean':np.full(n,np.nan),
+             'gage_q33':np.full(n,np.nan),
+             'missing_q33':[]
+         }
+         nstdev=10.
+         for i,reach in enumerate(reaches):
+             if reach not in self.alg_dict[alg].keys():
+                 continue
+             columns['in_alg'][i]=True
+             sos=self.sos_dict[str(reach)]
+             flpe=self.alg_dict[alg][reach]
+
+             # if this reach is gaged using the mean flow in the sos, rather than the algorithm
+             nrt_gaged_reach=(sos['overwritten_indices']==1) and \
+                               (sos['overwritten_source']!='grdc') and \
+                               (sos['cal_status']==1 ) and \
+                               ('Qbar' in sos['gage'].keys()) and \
+                               ('q33' in  sos['gage'].keys())
+             if (self.Branch == 'constrained') and nrt_gaged_reach:
+                 columns['gaged'][i]=True
+                 columns['gage_Mean'][i]=sos['gage']['Qbar']
+                 columns['gage_q33'][i]=sos['gage']['q33']
+                 continue
+
+             if not np.ma.is_masked(flpe['qbar']):
+                 if not abs(flpe['qbar']-sos['Qbar']) > sos['Qbar']*self.params_dict['FLPE_Uncertainty']*nstdev:
+                     columns['Mean'][i]=flpe['qbar']
+             try:
+                 if not np.ma.is_masked(flpe['q33']):
+                     if not abs(flpe['qbar']-sos['Qbar']) > sos['Qbar']*self.params_dict['FLPE_Uncertainty']*nstdev:
+                         columns['q33'][i]=flpe['q33']
+             except:
+                 columns['missing_q33'].append(reach)
+
+         self.reach_columns[alg]=columns
+         return columns
 
      def initialize_integration_vars(self,alg,FlowLevel,PreviousResiduals,n):
 
          self.GoodFLPE[alg]=True
-         Qbar=np.empty([n,])
-         sigQ=np.empty([n,])
-         facc=np.empty([n,])
-         runoff=np.empty([n,])
-         datasource=[]
+         columns=self.integration_columns(alg)
+         facc=columns['facc']
+         in_alg=columns['in_alg']
+         gaged=columns['gaged']
+         flpe=in_alg & ~gaged
+         Previous=PreviousResiduals[alg]
+
+         for reach in columns['missing_q33']:
+             if FlowLevel == 'q33':
+                 print('did not find q33. reach=',reach)
+
+         Qbar=np.where(gaged,columns['gage_'+FlowLevel],columns[FlowLevel])
+         sigQ=np.full([n,],np.nan)
+         sigQ[gaged]=Qbar[gaged]*self.params_dict['Gage_Uncertainty']
+
+         prior=flpe & np.isnan(Previous)
+         sigQ[prior]=Qbar[prior]*self.params_dict['FLPE_Uncertainty']
+         reweight=flpe & ~np.isnan(Previous)
+         if np.any(reweight):
+             #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*self.params_dict['FLPE_Uncertainty'])
+             #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*.01)
+             # as max(): the residual is kept unless Qbar*.01 is larger, so a nan Qbar keeps it
+             a=np.abs(Previous[reweight])
+             b=Qbar[reweight]*.01
+             # scalar pow, which differs from numpy's vectorized pow in the last bit
+             exponent=-(self.params_dict['norm']-2.0)
+             sigQ[reweight]=[x**exponent for x in np.where(b > a,b,a)]
 
-         i=0
-         for reach in self.basin_dict['reach_ids_all']:
-            # assign drainage area
-            reachint=np.int64(reach)
-            k=np.argwhere(self.sword_dict['reach_id'] == reachint)
-            k=k[0,0]
-            sword_data_reach=self.pull_sword_attributes_for_reach(k) 
-            facc[i]=sword_data_reach['facc']
-
-            if reach in self.alg_dict[alg].keys():
-
-                # if this reach is gaged using the mean flow in the sos, rather than the algorithm
-                nrt_gaged_reach=(self.sos_dict[str(reach)]['overwritten_indices']==1) and \
-                                  (self.sos_dict[str(reach)]['overwritten_source']!='grdc') and \
-                                  (self.sos_dict[str(reach)]['cal_status']==1 ) and \
-                                  ('Qbar' in self.sos_dict[str(reach)]['gage'].keys()) and \
-                                  ('q33' in  self.sos_dict[str(reach)]['gage'].keys())
-
-
-                if (self.Branch == 'constrained') and nrt_gaged_reach:
-                    if FlowLevel == 'Mean':
-                        #Qbar[i]=self.sos_dict[str(reach)]['Qbar']
-                        Qbar[i]=self.sos_dict[str(reach)]['gage']['Qbar']
-                    elif FlowLevel == 'q33':
-                        #Qbar[i]=self.sos_dict[str(reach)]['q33']
-                        Qbar[i]=self.sos_dict[str(reach)]['gage']['q33']
-
-                    sigQ[i]=Qbar[i]*self.params_dict['Gage_Uncertainty']
-                    datasource.append('Gage')
-                else:
-                    if FlowLevel == 'Mean':
-                        if np.ma.is_masked(self.alg_dict[alg][reach]['qbar']):
-                            Qbar[i]=np.nan #
-                        else:
-
-                            nstdev=10.
-                            if abs(self.alg_dict[alg][reach]['qbar']-self.sos_dict[str(reach)]['Qbar']) > \
-                                    self.sos_dict[str(reach)]['Qbar']*self.params_dict['FLPE_Uncertainty']*nstdev:
-                                Qbar[i]=np.nan
-                            else:
-                                Qbar[i]=self.alg_dict[alg][reach]['qbar']
-                    elif FlowLevel == 'q33':
-                        try:
-                            if np.ma.is_masked(self.alg_dict[alg][reach]['q33']):
-                                Qbar[i]=np.nan
-                            else:
-                                nstdev=10.
-                                if abs(self.alg_dict[alg][reach]['qbar']-self.sos_dict[str(reach)]['Qbar']) > \
-                                        self.sos_dict[str(reach)]['Qbar']*self.params_dict['FLPE_Uncertainty']*nstdev:
-                                    Qbar[i]=np.nan
-                                else:
-                                    Qbar[i]=self.alg_dict[alg][reach]['q33']
-                        except:
-                            print('did not find q33. reach=',reach)
-                            Qbar[i]=np.nan
-
-                    if np.isnan(PreviousResiduals[alg][i]):
-                        sigQ[i]=Qbar[i]*self.params_dict['FLPE_Uncertainty']
-                    else:
-                        if (self.Branch == 'constrained') and nrt_gaged_reach:
-                           sigQ[i]=Qbar[i]*self.params_dict['Gage_Uncertainty']
-                        else:
-                           #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*self.params_dict['FLPE_Uncertainty'])
-                           #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*self.params_dict['FLPE_Uncertainty'])**self.params_dict['norm']
-                           #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*self.params_dict['FLPE_Uncertainty'])
-                           #sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*.01)
-                           sigQ[i]=max(abs(PreviousResiduals[alg][i]),Qbar[i]*.01)**(-(self.params_dict['norm']-2.0))
-                    datasource.append('FLPE')
-            else:
-                 Qbar[i]=np.nan
-                 sigQ[i]=np.nan
-                 datasource.append('None')
-            i+=1
- 
          # compute runoff and average runoff
-         for i in range(n):
-             if not np.isnan(Qbar[i]):
-                 runoff[i]=Qbar[i]/facc[i]/1000**2*86400*365
-             else:
-                 runoff[i]=np.nan
-
+         runoff=Qbar/facc/1000**2*86400*365
          runoff_avg=np.nanmean(runoff)
          #if self.VerboseFlag:
          #    print('average runoff=',runoff_avg,'m/yr')
 
-         # this handles accidental nans still in the flow estimates
-         #   setting to zero should let these get reset
-         #Qbar[np.isnan(Qbar)]=0.
-         #Qbar[np.isinf(Qbar)]=0.
-
          # fill initial average discharge with average runoff
-         for i in range(n):
-             if np.isnan(Qbar[i]) or np.isinf(Qbar[i]):
-                 Qbar[i]=runoff_avg*facc[i]*1000**2/86400/365
-                 sigQ[i]=Qbar[i]*self.params_dict['Fill_Uncertainty']
+         fill=np.isnan(Qbar) | np.isinf(Qbar)
+         Qbar[fill]=runoff_avg*facc[fill]*1000**2/86400/365
+         sigQ[fill]=Qbar[fill]*self.params_dict['Fill_Uncertainty']
 
          bignumber=1e9
          # for any values of zero in FLPE Qbar where we don't have residuals, set uncertainty to a big number
          #   (note - this should now be mostly obsolete)
          sigQmin=10.
-         for i in range(n):
-             if Qbar[i]==0. and np.isnan(PreviousResiduals[alg][i]) :
-                 sigQ[i]=bignumber
-             if sigQ[i] < sigQmin and not datasource[i]=='Gage':
-                sigQ[i] = sigQmin
+         sigQ[(Qbar==0.) & np.isnan(Previous)]=bignumber
+         sigQ[(sigQ < sigQmin) & ~gaged]=sigQmin
 
-         for i in range(n):
-             if np.isinf(PreviousResiduals[alg][i]):
-                 Qbar[i]=5.
-                 sigQ[i]=0.1
+         flagged=np.isinf(Previous)
+         Qbar[flagged]=5.
+         sigQ[flagged]=0.1
 
          #check for whether FLPE data are ok
-         iFLPE=np.where(np.array(datasource)=='FLPE')
-         if np.all(Qbar[iFLPE]==0):
+         if np.all(Qbar[flpe]==0):
              FLPE_Data_OK=False
              self.GoodFLPE[alg]=False
          else:
              FLPE_Data_OK=True
 
-         #i=0
-         #for reach in self.basin_dict['reach_ids_all']:
-         #    print(i,reach,'Qbar=',Qbar[i],'stdQ=',sigQ[i])
-         #    i+=1
-         #sys.exit('Stopping at dev point')
-
-         return Qbar,sigQ,FLPE_Data_OK,facc
-        
+         return Qbar,sigQ,FLPE_Data_OK,facc.copy()
 
-     def integrator_optimization_calcs(self,m,n,FlowLevel,PreviousResiduals):
+     def integrator_optimization_calcs(self,m,n,FlowLevel,PreviousResiduals,uncertainty=True):
+          # uncertainty=False leaves sbQ_rel unset and keeps what is needed to compute it
+          #   in self.deferred_uncertainty, see finalize_integrator_uncertainty. nothing is
+          #   kept for q33, whose uncertainty is not stored
 
           #0 initialize dictionary of residuals, to be returned and passed back in for next iteration
           residuals={}
           self.GoodFLPE={}
+          self.deferred_uncertainty={}
+
+          if self.params_dict['batch_algorithms'] and self.params_dict['method'] == 'linear' and \
+                  self.params_dict['solver'] == 'lowrank' and not self.params_dict['quit_before_flpe']:
+              return self.batched_optimization_calcs(m,n,FlowLevel,PreviousResiduals,uncertainty)
 
           #alg_list=['geobam']
           alg_list=self.alg_dict
@@ -693,7 +952,7 @@ class Integrate:
 
                #print('Prior Q[51]=',Qbar[51])
 
-               # compute the G matrix, which defines mass conservation points
+               # the G matrix, which defines mass conservation points, is built once per basin
                G=self.calcG(m,n)
                
                '''
@@ -710,38 +969,37 @@ class Integrate:
                if not FLPE_Data_OK or not self.junctions_valid:
                    print('FLPE data not ok for ',alg,'. setting Qintegrator = Qprior here')
                    Qintegrator=Qbar
+                   stdQc_rel=None
+                   Success=False
                    residuals[alg]=np.full((n,),np.nan)
                else:
                    UncertaintyMethod='Linear' 
                    if self.params_dict['method'] == 'nonlinear':
-                       cons_massbalance=optimize.LinearConstraint(G,np.zeros(m,),np.zeros(m,))
-                       Qmin=0.
-                       bignumber=1.0e9
-                       cons_positive=optimize.LinearConstraint(np.eye(n),np.ones(n,)*Qmin,np.ones(n,)*bignumber)
                        Q0,covQ=self.compute_linear_Qhat(alg,m,n,sigQ,Qbar,G)
-                       np.clip(Q0,1.,np.inf,out=Q0)
 
-                       res=optimize.minimize(fun=self.MOI_ObjectiveFunc,x0=Q0,args=(Qbar,sigQ),method='SLSQP',                      
-                           options={'maxiter':500},
-                           constraints=(cons_massbalance,cons_positive))
+                       # nonnegative weighted least squares. falls back to the linear solution
+                       try:
+                           Qintegrator,converged=NonnegativeAdjustment(G,sigQ).adjust(Qbar)
+                       except:
+                           converged=False
 
-                       if res.success:
-                           Qintegrator=res.x
-                           Success=True
-                       else:
+                       if not converged:
                            if self.VerboseFlag:
                                print('      Used linear solution :(...')
-                               #print(res)
-                               #sys.exit('stopping at dev point')
-    
-                           Qintegrator=Q0
-                           res.success=True
-                           Success=True
+                           Qintegrator=np.clip(Q0,1.,np.inf)
+                       Success=True
                    elif self.params_dict['method'] == 'linear': 
                        Qintegrator,covQ=self.compute_linear_Qhat(alg,m,n,sigQ,Qbar,G)
                        Success=True
 
-                   stdQc_rel=self.compute_integrator_uncertainty(alg,m,n,covQ,Qintegrator,UncertaintyMethod,G)
+                   if uncertainty:
+                       stdQc_rel=self.compute_integrator_uncertainty(alg,m,n,covQ,Qintegrator,UncertaintyMethod,G)
+                   else:
+                       if FlowLevel == 'Mean':
+                           # a dense covQ is n x n: keep sigQ instead, and rebuild covQ when it is needed
+                           prior=covQ if isinstance(covQ,LowRankAdjustment) else sigQ
+                           self.deferred_uncertainty[alg]=(prior,None,Qintegrator)
+                       stdQc_rel=None
 
                    if type(stdQc_rel) == bool:
                     if stdQc_rel == False:
@@ -756,10 +1014,7 @@ class Integrate:
 
                    #compute residuals
                    if Success:
-                       residuals[alg]= Qbar-Qintegrator
-                       for i in range(n):
-                           if Qintegrator[i]<0.:
-                               residuals[alg][i]=np.inf#this is a code to how to treat uncertainty on next iteration
+                       residuals[alg]=self.get_residuals(Qbar,Qintegrator,n)
                    else:
                        residuals[alg]=np.full((n,),np.nan)
 
@@ -781,36 +1036,154 @@ class Integrate:
 
 
                #2. save data
-               i=0
-               for reach in self.basin_dict['reach_ids_all']:
-                   if reach in self.alg_dict[alg].keys():
-                       if 'integrator' not in self.alg_dict[alg][reach]:
-                           self.alg_dict[alg][reach]['integrator']={}
-                           self.alg_dict[alg][reach]['integrator']['qbar']=np.nan
-                           self.alg_dict[alg][reach]['integrator']['sbQ_rel']=np.nan
-                       if FlowLevel == 'Mean':
-                           self.alg_dict[alg][reach]['integrator']['qbar']=Qintegrator[i]
-                           if  FLPE_Data_OK and self.junctions_valid:
-                               if Success:
-                                   self.alg_dict[alg][reach]['integrator']['sbQ_rel']=stdQc_rel[i]
-                               else:
-                                   warnings.warn('Topology probelm encountered, using prior uncertainty for sbQ_rel')
-                                   self.alg_dict[alg][reach]['integrator']['sbQ_rel']=self.params_dict['FLPE_Uncertainty']
-                           else:
-                               self.alg_dict[alg][reach]['integrator']['sbQ_rel']=self.params_dict['FLPE_Uncertainty']
-
-                       elif FlowLevel == 'q33':
-                           self.alg_dict[alg][reach]['integrator']['q33']=Qintegrator[i]
-                   #if reach == '73120000521':
-                   #    print('        reach=',reach,'i=',i)
-                   #    if FlowLevel == 'Mean':
-                   #        print('        qbar=',self.alg_dict[alg][reach]['integrator']['qbar'])
-                   i+=1
+               self.store_integrator_results(alg,FlowLevel,Qintegrator,stdQc_rel,FLPE_Data_OK,Success)
 
           # there is a for loop that goes over all algorithms
 
           return residuals
 
+     def batched_optimization_calcs(self,m,n,FlowLevel,PreviousResiduals,uncertainty=True):
+          """Run the linear integration for all algorithms with a single batched solve.
+
+          The algorithms share G and differ only in Qbar and sigQ, so their priors
+          are stacked into (n_alg x n) arrays and adjusted together. Results are
+          the same as running integrator_optimization_calcs one algorithm at a time.
+          """
+
+          residuals={}
+          self.GoodFLPE={}
+          self.deferred_uncertainty={}
+
+          priors={}
+          for alg in self.alg_dict:
+               print('    RUNNING MOI for ',alg)
+               priors[alg]=self.initialize_integration_vars(alg,FlowLevel,PreviousResiduals,n)
+
+          G=self.calcG(m,n)
+
+          batch=[alg for alg in priors if priors[alg][2] and self.junctions_valid]
+          solutions={}
+          if batch:
+               Qbar=np.vstack([priors[alg][0] for alg in batch])
+               sigQ=np.vstack([priors[alg][1] for alg in batch])
+               solutions=self.compute_linear_Qhat_batch(batch,m,n,sigQ,Qbar,G,uncertainty)
+
+          for alg in self.alg_dict:
+               Qbar,sigQ,FLPE_Data_OK,facc=priors[alg]
+               if alg in solutions:
+                   Qintegrator,stdQc_rel=solutions[alg]
+                   residuals[alg]=self.get_residuals(Qbar,Qintegrator,n)
+               else:
+                   print('FLPE data not ok for ',alg,'. setting Qintegrator = Qprior here')
+                   Qintegrator=Qbar
+                   stdQc_rel=None
+                   residuals[alg]=np.full((n,),np.nan)
+
+               self.store_integrator_results(alg,FlowLevel,Qintegrator,stdQc_rel,FLPE_Data_OK,True)
+
+          return residuals
+
+     def get_residuals(self,Qbar,Qintegrator,n):
+          residuals= Qbar-Qintegrator
+          for i in range(n):
+              if Qintegrator[i]<0.:
+                  residuals[i]=np.inf#this is a code to how to treat uncertainty on next iteration
+          return residuals
+
+     def iterate_integration(self,m,n,FlowLevel):
+          """Run the integrator for one flow level, reweighting by the residuals.
+
+          Between iterations only the prior uncertainties change, and only the
+          last iteration's sbQ_rel is kept, so the posterior uncertainty is
+          computed once, reusing the factorization of the last iteration.
+          Iteration stops before niter once the residual change (see
+          residual_change) drops below params_dict['niter_tol']. The change at
+          each iteration is printed and kept in self.convergence[FlowLevel].
+          """
+
+          residuals={}
+          for alg in self.alg_dict:
+              residuals[alg]=np.full((n,),np.nan)
+          defer=not self.params_dict['quit_before_flpe']
+
+          self.convergence[FlowLevel]=[]
+          for i in range(0,self.params_dict['niter']):
+              print('  Running iteration',i+1,'/',self.params_dict['niter'])
+              previous=residuals
+              residuals=self.integrator_optimization_calcs(m,n,FlowLevel,previous,uncertainty=not defer)
+              change=residual_change(previous,residuals)
+              self.convergence[FlowLevel].append(change)
+              print('    residual change:',change)
+              if change < self.params_dict['niter_tol']:
+                  print('  Converged after iteration',i+1)
+                  break
+
+          self.finalize_integrator_uncertainty(m,n,FlowLevel)
+          return residuals
+
+     def finalize_integrator_uncertainty(self,m,n,FlowLevel):
+          """Compute and store sbQ_rel for the solutions in self.deferred_uncertainty.
+
+          Entries are (covQ, j, Qintegrator), where j is the algorithm's row in a
+          batched LowRankAdjustment or None. For the dense solver covQ is the
+          prior sigQ, and the n x n covariance is built here one algorithm at a
+          time. The uncertainty is only stored for the mean flow level.
+          """
+
+          deferred=self.deferred_uncertainty
+          self.deferred_uncertainty={}
+          if FlowLevel != 'Mean':
+              return
+
+          G=self.calcG(m,n)
+          batches={}
+          for alg,(covQ,j,Qintegrator) in deferred.items():
+              if j is None:
+                  if not isinstance(covQ,LowRankAdjustment):
+                      covQ=self.dense_covQ(covQ,n)
+                  stdQc_rel=self.compute_integrator_uncertainty(alg,m,n,covQ,Qintegrator,'Linear',G)
+              else:
+                  # one posterior_std call for all algorithms sharing the batched solver
+                  if id(covQ) not in batches:
+                      try:
+                          batches[id(covQ)]=covQ.posterior_std()
+                      except:
+                          batches[id(covQ)]=None
+                  if batches[id(covQ)] is None:
+                      single=LowRankAdjustment(G,covQ.s[j],covQ.rho)
+                      stdQc_rel=self.compute_integrator_uncertainty(alg,m,n,single,Qintegrator,'Linear',G)
+                  else:
+                      stdQc_rel=batches[id(covQ)][j]/np.abs(Qintegrator)
+              self.store_integrator_results(alg,FlowLevel,Qintegrator,stdQc_rel,True,True)
+
+     def store_integrator_results(self,alg,FlowLevel,Qintegrator,stdQc_rel,FLPE_Data_OK,Success):
+          i=0
+          for reach in self.basin_dict['reach_ids_all']:
+              if reach in self.alg_dict[alg].keys():
+                  if 'integrator' not in self.alg_dict[alg][reach]:
+                      self.alg_dict[alg][reach]['integrator']={}
+                      self.alg_dict[alg][reach]['integrator']['qbar']=np.nan
+                      self.alg_dict[alg][reach]['integrator']['sbQ_rel']=np.nan
+                  if FlowLevel == 'Mean':
+                      self.alg_dict[alg][reach]['integrator']['qbar']=Qintegrator[i]
+                      if  FLPE_Data_OK and self.junctions_valid:
+                          if Success:
+                              if stdQc_rel is not None: # None while the uncertainty is deferred
+                                  self.alg_dict[alg][reach]['integrator']['sbQ_rel']=stdQc_rel[i]
+                          else:
+                              warnings.warn('Topology probelm encountered, using prior uncertainty for sbQ_rel')
+                              self.alg_dict[alg][reach]['integrator']['sbQ_rel']=self.params_dict['FLPE_Uncertainty']
+                      else:
+                          self.alg_dict[alg][reach]['integrator']['sbQ_rel']=self.params_dict['FLPE_Uncertainty']
+
+                  elif FlowLevel == 'q33':
+                      self.alg_dict[alg][reach]['integrator']['q33']=Qintegrator[i]
+              #if reach == '73120000521':
+              #    print('        reach=',reach,'i=',i)
+              #    if FlowLevel == 'Mean':
+              #        print('        qbar=',self.alg_dict[alg][reach]['integrator']['qbar'])
+              i+=1
+
      def compute_linear_Qhat(self,alg,m,n,sigQ,Qbar,G):
           # using the Adjustments formulation 
 
@@ -821,7 +1194,19 @@ class Integrate:
           sigQv=np.reshape(sigQ0,(n,1))
           sigQv=sigQv**(self.params_dict['norm']/2.)
           rho=self.params_dict['rho']
-          covQ = np.matmul(sigQv,  sigQv.transpose()) * (rho* np.ones((n,n)) + (np.eye(n)-rho*np.eye(n) )   )  
+
+          if self.params_dict['solver'] == 'lowrank':
+              # covQ is diagonal plus rank one: never form it, solve with sparse G instead
+              covQ=LowRankAdjustment(G,np.reshape(sigQv,(n,)),rho)
+              try:
+                  xhat=covQ.adjust(Qbar)
+              except:
+                  warnings.warn('adjustment calculation failed. returning Qhat=Qbar')
+                  return Qbar,covQ
+
+              return xhat,covQ
+
+          covQ = self.dense_covQ(sigQ0,n)
           
           try:
               xhat= (np.eye(n)-covQ @ G.T @ np.linalg.inv(G@covQ@G.T) @ G ) @ Qbar 
@@ -835,6 +1220,54 @@ class Integrate:
 
           return Q0,covQ
 
+     def dense_covQ(self,sigQ,n):
+          """Return the dense (n x n) prior covariance of compute_linear_Qhat for sigQ."""
+
+          sigQv=np.reshape(np.clip(sigQ,1.,np.inf),(n,1))**(self.params_dict['norm']/2.)
+          rho=self.params_dict['rho']
+          return np.matmul(sigQv,  sigQv.transpose()) * (rho* np.ones((n,n)) + (np.eye(n)-rho*np.eye(n) )   )
+
+     def compute_linear_Qhat_batch(self,algs,m,n,sigQ,Qbar,G,uncertainty=True):
+          """Linear adjustment and uncertainty for several algorithms at once.
+
+          sigQ and Qbar are (len(algs) x n). Returns a dict of (Qintegrator, stdQc_rel)
+          keyed by algorithm. If the batched solve fails, each algorithm is solved on
+          its own so that failures are handled exactly as in compute_linear_Qhat.
+          With uncertainty=False, stdQc_rel is None and the solver is kept in
+          self.deferred_uncertainty.
+          """
+
+          sigQmin=1.
+          np.clip(sigQ,sigQmin,np.inf,out=sigQ) #prevent any zero values in sigQ
+          sigQv=sigQ**(self.params_dict['norm']/2.)
+          covQ=LowRankAdjustment(G,sigQv,self.params_dict['rho'])
+
+          solutions={}
+          try:
+              Qhat=covQ.adjust(Qbar)
+              if uncertainty:
+                  stdQc=covQ.posterior_std()
+          except:
+              warnings.warn('batched adjustment calculation failed. solving algorithms one at a time')
+              for j,alg in enumerate(algs):
+                  Qintegrator,covQ=self.compute_linear_Qhat(alg,m,n,sigQ[j],Qbar[j],G)
+                  if uncertainty:
+                      stdQc_rel=self.compute_integrator_uncertainty(alg,m,n,covQ,Qintegrator,'Linear',G)
+                  else:
+                      self.deferred_uncertainty[alg]=(covQ,None,Qintegrator)
+                      stdQc_rel=None
+                  solutions[alg]=(Qintegrator,stdQc_rel)
+              return solutions
+
+          for j,alg in enumerate(algs):
+              if uncertainty:
+                  solutions[alg]=(Qhat[j],stdQc[j]/np.abs(Qhat[j]))
+              else:
+                  self.deferred_uncertainty[alg]=(covQ,j,Qhat[j])
+                  solutions[alg]=(Qhat[j],None)
+
+          return solutions
+
      def compute_integrator_uncertainty(self,alg,m,n,covQ,Qbar,UncertaintyMethod,G):
 
           if UncertaintyMethod == 'Ensemble':
@@ -857,6 +1290,15 @@ class Integrate:
               else:
                   stdQc_rel=np.full(n,self.params_dict['FLPE_Uncertainty'])
           elif UncertaintyMethod == 'Linear':
+              if isinstance(covQ,LowRankAdjustment):
+                  # only the diagonal is needed: reuse the factorization from compute_linear_Qhat
+                  try:
+                      stdQc=covQ.posterior_std()
+                      stdQc_rel=stdQc/np.abs(Qbar)
+                  except:
+                      warnings.warn('adjustment uncertainty calculation failed. returning prior uncertainty')
+                      return np.reshape(np.sqrt(covQ.diagonal()),(n,1))
+                  return stdQc_rel
               try:
                   σ0=np.sqrt(np.mean(covQ))
                   Q=covQ/σ0**2 #note this is the co-factor matrix from Kyle snow's book... not discharge
@@ -880,6 +1322,7 @@ class Integrate:
           #E= -2 * np.lingalg.inv(covQ)    
           #E= -2 * np.lingalg.inv(covQ)    
 
+          G=G.toarray() if hasattr(G,'toarray') else G
           F=np.transpose(G) #nxm
           H=np.zeros((m,m)) #mxm
           A=np.block([
@@ -904,401 +1347,349 @@ class Integrate:
           
 
      def compute_FLPs(self):         
-          #2.1 geobam   
-          print('CALCULATING GeoBAM FLPs')
-          for reach in self.alg_dict['neobam']:
-               #print('CALCULATING FLPs:',reach)
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
-               
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
+          """Fit each algorithm's flow law parameters to the integrator flows.
 
-               with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    nhat=np.nanmean(self.alg_dict['neobam'][reach]['n'])
+          Every (algorithm, reach) fit is independent. With
+          params_dict['workers'] > 1 the fits run in a process pool, in chunks
+          to amortize pickling the reach data. Results are written back to
+          alg_dict[alg][reach]['integrator'] in task order, so they do not
+          depend on the number of workers.
 
-               if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                    
-                    Abar_min=-min(self.obs_dict[reach]['dA'])+1
-                    
-                    with warnings.catch_warnings():
-                         warnings.simplefilter("ignore", category=RuntimeWarning)
-
-                         if not np.isnan(nhat):
-                             init_params=(nhat,np.nanmean(self.alg_dict['neobam'][reach]['a0']))
-                         else:
-                             init_params=(0.03,Abar_min+10.)
-                    #param_bounds=( (0.001,np.inf),(-min(self.obs_dict[reach]['dA'])+1,np.inf))
-                    param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
-                    qbar=self.alg_dict['neobam'][reach]['integrator']['qbar'] 
-                    if 'q33' in self.alg_dict['neobam'][reach]['integrator']:
-                        q33=self.alg_dict['neobam'][reach]['integrator']['q33']
+          With params_dict['flp_gradients'] the Manning-type fits use
+          analytic gradients instead of finite differences. The flows of the
+          fitted flow laws are then computed per algorithm by store_flows.
+          """
+
+          tasks=list()
+          for alg in FLP_NAMES:
+               print('CALCULATING',FLP_NAMES[alg],'FLPs')
+               for reach in self.alg_dict[alg]:
+                    try: 
+                        if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
+                            datagood=True
+                    except:
+                        continue
+
+                    if reach not in self.observed_reaches:
+                        # reach is not observed. do not calculate FLPs
+                        continue
+
+                    # momma uses heights, so it does not need dA
+                    if self.obs_dict[reach]['nt'] > 0 and (alg == 'momma' or self.obs_dict[reach]['dA'].size > 0):
+                         tasks.append((alg,reach))
                     else:
-                        q33=nan 
-                    res = optimize.minimize(fun=self.bam_objfun,
-                                        x0=init_params,
-                                        args=(self.obs_dict[reach],qbar,q33),
-                                        bounds=param_bounds )
-                    param_est=res.x
-
-                    #store output
-                    self.alg_dict['neobam'][reach]['integrator']['n']=param_est[0]
-                    self.alg_dict['neobam'][reach]['integrator']['a0']=param_est[1]
-                    self.alg_dict['neobam'][reach]['integrator']['q']=self.bam_flowlaw(param_est,self.obs_dict[reach])
-
-
-               else: 
-                    #print('geobam FLP calcs failed, reach',reach)
-                    self.alg_dict['neobam'][reach]['integrator']['n']=np.nan
-                    self.alg_dict['neobam'][reach]['integrator']['a0']=np.nan
-                    self.alg_dict['neobam'][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
-
-          #2.2 hivdi
-          print('CALCULATING HiVDI FLPs')
-          for reach in self.alg_dict['hivdi']:
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
+                         for param in FLP_PARAMS[alg]:
+                              self.alg_dict[alg][reach]['integrator'][param]=np.nan
+                         self.alg_dict[alg][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
+
+          jac=self.params_dict['flp_gradients']
+          payloads=[(alg,reach,self.obs_dict[reach],self.alg_dict[alg][reach],jac) for alg,reach in tasks]
+          workers=self.params_dict['workers']
+          if workers > 1 and len(tasks) > 1:
+               chunksize=max(1,len(tasks)//(4*workers))
+               with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results=list(executor.map(fit_flps,payloads,chunksize=chunksize))
+          else:
+               results=[fit_flps(payload) for payload in payloads]
+
+          #store output
+          for (alg,reach),result in zip(tasks,results):
+               self.alg_dict[alg][reach]['integrator'].update(result)
+          for alg in FLP_NAMES:
+               self.store_flows(alg,[reach for task_alg,reach in tasks if task_alg == alg])
+
+     def store_flows(self,alg,reaches):
+          """Store the flows of the fitted flow law of alg in each reach's integrator['q'].
+
+          The flow law is evaluated in one basin_flowlaw call on the basin's
+          ObsBuffer (see basin_obs), with nan parameters for the reaches not
+          in reaches, and each reach gets a (1, nt) view of its rows of the
+          result. As in momma_flowlaw, MOMMA reaches with H <= B+0.1 get a
+          scalar inf.
+          """
 
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
+          if not reaches:
+               return
+          obs=self.basin_obs()
+          rows=np.array([obs.rows[reach] for reach in reaches],dtype=np.int64)
+          fits=[self.alg_dict[alg][reach]['integrator'] for reach in reaches]
+          params=[]
+          for param in FLP_PARAMS[alg]:
+               values=np.full(len(obs.reaches),np.nan)
+               values[rows]=[np.ravel(fit[param])[0] for fit in fits]
+               params.append(values)
+          q=Integrate.basin_flowlaw(alg,params,obs)
+          for i,fit in zip(rows,fits):
+               if alg == 'momma' and params[1][i] <= params[0][i]+0.1:
+                    fit['q']=np.inf
+               else:
+                    fit['q']=q[:,obs.offsets[i]:obs.offsets[i+1]]
 
-               with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    alphaflpe=np.nanmean(self.alg_dict['hivdi'][reach]['alpha'])
+     def basin_obs(self):
+          """Return the basin's ObsBuffer, building it from obs_dict once if none was given."""
 
+          if self.obs_buffer is None:
+               self.obs_buffer=ObsBuffer(self.obs_dict)
+          return self.obs_buffer
 
-               if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                    Abar_min=-min(self.obs_dict[reach]['dA'])+1
-                    if not np.isnan(alphaflpe):
-                         with warnings.catch_warnings():
-                              warnings.simplefilter("ignore", category=RuntimeWarning)
-                              init_params=(np.nanmean(self.alg_dict['hivdi'][reach]['alpha']), \
-                                   np.nanmean(self.alg_dict['hivdi'][reach]['beta']),\
-                                   np.nanmean(self.alg_dict['hivdi'][reach]['a0']))
-                    else:
-                          init_params=(33.3,1.0,Abar_min+10.)
-                    #param_bounds=( (0.001,np.inf),(-1e2,1e2),(-min(self.obs_dict[reach]['dA'])+1,np.inf))
-                    param_bounds=( (0.001,np.inf),(-1e1,1.e1),(Abar_min,np.inf))
-                    qbar=self.alg_dict['hivdi'][reach]['integrator']['qbar']
-                    if 'q33' in self.alg_dict['hivdi'][reach]['integrator']:
-                        q33=self.alg_dict['hivdi'][reach]['integrator']['q33']
-                    else:
-                        q33=nan 
-                    res = optimize.minimize(fun=self.hivdi_objfun,
-                                        x0=init_params,
-                                        args=(self.obs_dict[reach],qbar,q33),
-                                        bounds=param_bounds )
-
-                    param_est=res.x
-
-                    #store output
-                    self.alg_dict['hivdi'][reach]['integrator']['alpha']=param_est[0]
-                    self.alg_dict['hivdi'][reach]['integrator']['beta']=param_est[1]
-                    self.alg_dict['hivdi'][reach]['integrator']['Abar']=param_est[2]
-                    self.alg_dict['hivdi'][reach]['integrator']['q']=self.hivdi_flowlaw(param_est,self.obs_dict[reach])
-               else: 
-                    self.alg_dict['hivdi'][reach]['integrator']['alpha']=np.nan
-                    self.alg_dict['hivdi'][reach]['integrator']['beta']=np.nan
-                    self.alg_dict['hivdi'][reach]['integrator']['Abar']=np.nan
-                    self.alg_dict['hivdi'][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
-
-
-          #2.3 MetroMan
-          print('CALCULATING MetroMan FLPs')
-          for reach in self.alg_dict['metroman']:
-              
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
+     @staticmethod
+     def fit_neobam(reach,obs,flpe,jac=False):
+          """Fit neoBAM (n, Abar) to the integrator flows; return the fitted parameters."""
 
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               nhat=np.nanmean(flpe['n'])
 
+          Abar_min=-min(obs['dA'])+1
+          
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+
+               if not np.isnan(nhat):
+                   init_params=(nhat,np.nanmean(flpe['a0']))
+               else:
+                   init_params=(0.03,Abar_min+10.)
+          #param_bounds=( (0.001,np.inf),(-min(obs['dA'])+1,np.inf))
+          param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
+          qbar=flpe['integrator']['qbar'] 
+          q33=flpe['integrator'].get('q33',np.nan)
+          # with jac the objective also returns its analytic gradient
+          res = optimize.minimize(fun=Integrate.bam_objfun_grad if jac else Integrate.bam_objfun,
+                              jac=jac or None,
+                              x0=init_params,
+                              args=(obs,qbar,q33),
+                              bounds=param_bounds )
+          param_est=res.x
+
+          return {
+               'n': param_est[0],
+               'a0': param_est[1]
+          }
+
+     @staticmethod
+     def fit_hivdi(reach,obs,flpe,jac=False):
+          """Fit HiVDI (alpha, beta, Abar) to the integrator flows; return the fitted parameters."""
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               alphaflpe=np.nanmean(flpe['alpha'])
+
+          Abar_min=-min(obs['dA'])+1
+          if not np.isnan(alphaflpe):
                with warnings.catch_warnings():
                     warnings.simplefilter("ignore", category=RuntimeWarning)
-                    naflpe=np.nanmean(self.alg_dict['metroman'][reach]['na'])
-
-
-               if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                    with warnings.catch_warnings():
-                         Abar_min=-min(self.obs_dict[reach]['dA'])+1
-                         if not np.isnan(naflpe):
-                             warnings.simplefilter("ignore", category=RuntimeWarning)
-                             init_params=(np.nanmean(self.alg_dict['metroman'][reach]['na']), \
-                                  np.nanmean(self.alg_dict['metroman'][reach]['x1']),\
-                                  np.nanmean(self.alg_dict['metroman'][reach]['a0']))
-                         else:
-                             init_params=(0.03,-1.,Abar_min+10.)
-                    #param_bounds=( (0.001,np.inf),(-1e2,1e2),(-min(self.obs_dict[reach]['dA'])+1,np.inf))
-                    param_bounds=( (0.001,np.inf),(-1e1,1e1),(Abar_min,np.inf))
-                    qbar=self.alg_dict['metroman'][reach]['integrator']['qbar']
-                    if 'q33' in self.alg_dict['metroman'][reach]['integrator']:
-                        q33=self.alg_dict['metroman'][reach]['integrator']['q33']
-                    else:
-                        q33=nan 
-                    res = optimize.minimize(fun=self.metroman_objfun,
-                                        x0=init_params,
-                                        args=(self.obs_dict[reach],qbar,q33),
-                                        bounds=param_bounds )
-                    param_est=res.x
-
-                    #store output
-                    self.alg_dict['metroman'][reach]['integrator']['na']=param_est[0]
-                    self.alg_dict['metroman'][reach]['integrator']['x1']=param_est[1]
-                    self.alg_dict['metroman'][reach]['integrator']['a0']=param_est[2]
-                    self.alg_dict['metroman'][reach]['integrator']['q']=self.metroman_flowlaw(param_est,self.obs_dict[reach])
-               else: 
-                    self.alg_dict['metroman'][reach]['integrator']['na']=np.nan
-                    self.alg_dict['metroman'][reach]['integrator']['x1']=np.nan
-                    self.alg_dict['metroman'][reach]['integrator']['a0']=np.nan
-                    self.alg_dict['metroman'][reach]['integrator']['q']=np.full((1,self.obs_dict[reach]['nt']),np.nan)
-
-          #2.4 MOMMA
-          print('CALCULATING MOMMA FLPs')
-          # params are (B,HB) == (river bottom elevation, bankfull elevation)
-          for reach in self.alg_dict['momma']:
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
-
-               #print('.... calculating MOMMA FLPs for reach',reach)
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
-               with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    Bflpe=np.nanmean(self.alg_dict['momma'][reach]['B'])
-               if self.obs_dict[reach]['nt'] > 0:
-                    with warnings.catch_warnings():
-                         warnings.simplefilter("ignore", category=RuntimeWarning)
+                    init_params=(np.nanmean(flpe['alpha']), \
+                         np.nanmean(flpe['beta']),\
+                         np.nanmean(flpe['a0']))
+          else:
+                init_params=(33.3,1.0,Abar_min+10.)
+          #param_bounds=( (0.001,np.inf),(-1e2,1e2),(-min(obs['dA'])+1,np.inf))
+          param_bounds=( (0.001,np.inf),(-1e1,1.e1),(Abar_min,np.inf))
+          qbar=flpe['integrator']['qbar']
+          q33=flpe['integrator'].get('q33',np.nan)
+          # with jac the objective also returns its analytic gradient
+          res = optimize.minimize(fun=Integrate.hivdi_objfun_grad if jac else Integrate.hivdi_objfun,
+                              jac=jac or None,
+                              x0=init_params,
+                              args=(obs,qbar,q33),
+                              bounds=param_bounds )
+
+          param_est=res.x
+
+          return {
+               'alpha': param_est[0],
+               'beta': param_est[1],
+               'Abar': param_est[2]
+          }
 
-                         Bmax=np.min(self.obs_dict[reach]['h'])-0.1
+     @staticmethod
+     def fit_metroman(reach,obs,flpe,jac=False):
+          """Fit MetroMan (na, x1, Abar) to the integrator flows; return the fitted parameters."""
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               naflpe=np.nanmean(flpe['na'])
+
+          with warnings.catch_warnings():
+               Abar_min=-min(obs['dA'])+1
+               if not np.isnan(naflpe):
+                   warnings.simplefilter("ignore", category=RuntimeWarning)
+                   init_params=(np.nanmean(flpe['na']), \
+                        np.nanmean(flpe['x1']),\
+                        np.nanmean(flpe['a0']))
+               else:
+                   init_params=(0.03,-1.,Abar_min+10.)
+          #param_bounds=( (0.001,np.inf),(-1e2,1e2),(-min(obs['dA'])+1,np.inf))
+          param_bounds=( (0.001,np.inf),(-1e1,1e1),(Abar_min,np.inf))
+          qbar=flpe['integrator']['qbar']
+          q33=flpe['integrator'].get('q33',np.nan)
+          # with jac the objective also returns its analytic gradient
+          res = optimize.minimize(fun=Integrate.metroman_objfun_grad if jac else Integrate.metroman_objfun,
+                              jac=jac or None,
+                              x0=init_params,
+                              args=(obs,qbar,q33),
+                              bounds=param_bounds )
+          param_est=res.x
+
+          return {
+               'na': param_est[0],
+               'x1': param_est[1],
+               'a0': param_est[2]
+          }
 
-                         if not np.isnan(Bflpe):
-                              init_params=(np.nanmean(self.alg_dict['momma'][reach]['B']), \
-                                   np.nanmean(self.alg_dict['momma'][reach]['H']))
-                         else:
-                              init_params=(Bmax-1.0,Bmax+1.0)
+     @staticmethod
+     def fit_momma(reach,obs,flpe,jac=False):
+          """Fit MOMMA (B, H) to the integrator flows; return the fitted parameters.
 
-                    #put a limit on the initial guess for depth
-                    min_H_obs=np.min(self.obs_dict[reach]['h'])
-                    max_H_obs=np.max(self.obs_dict[reach]['h'])
+          params are (B,HB) == (river bottom elevation, bankfull elevation).
+          If the fit fails it is retried with bounds around the observed
+          heights, and then reverts to the reach-scale FLPE estimates. jac
+          is accepted for a uniform interface; MOMMA always uses finite
+          differences.
+          """
 
-                    if min_H_obs - init_params[0] > 10.:
-                         B=min_H_obs - 10.
-                         init_params=(B,B+10.)
-                              
-                    #param_bounds=( (0.1,np.min(self.obs_dict[reach]['h'])-0.1),(0.1,np.inf))
-                    #param_bounds=( (0.1,Bmax),(0.1,np.inf))
-                    param_bounds=( (0.1,Bmax),(Bmax+0.1,np.inf))
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               Bflpe=np.nanmean(flpe['B'])
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
 
+               Bmax=np.min(obs['h'])-0.1
 
-                    aux_var=self.alg_dict['momma'][reach]['Save']
+               if not np.isnan(Bflpe):
+                    init_params=(np.nanmean(flpe['B']), \
+                         np.nanmean(flpe['H']))
+               else:
+                    init_params=(Bmax-1.0,Bmax+1.0)
 
-                    if np.isnan(aux_var):
-                        aux_var=20e-5
+          #put a limit on the initial guess for depth
+          min_H_obs=np.min(obs['h'])
+          max_H_obs=np.max(obs['h'])
 
-                    qbar=self.alg_dict['momma'][reach]['integrator']['qbar']
-                    if 'q33' in self.alg_dict['momma'][reach]['integrator']:
-                        q33=self.alg_dict['momma'][reach]['integrator']['q33']
-                    else:
-                        q33=nan 
-
-                    try:
-                        # the minimize is not just failing to minimize and returnning res.success=fale
-                        # it is failing to minimize and raising an error, so we implement try excepts here.
-                        res = optimize.minimize(fun=self.momma_objfun,
-                                            x0=init_params,
-                                            args=(self.obs_dict[reach],qbar,q33,aux_var ),
-                                            bounds=param_bounds )
-                    except:
-                        res.success = False
-
-                    if not res.success:
-                        try:
-                            param_bounds=( (.1,np.min(self.obs_dict[reach]['h'])-0.1),(max_H_obs-1.,max_H_obs+1.)   )
-
-
-                            res = optimize.minimize(fun=self.momma_objfun,
-                                            x0=init_params,
-                                            args=(self.obs_dict[reach],qbar,q33,aux_var ),
-                                            bounds=param_bounds )
-                        except:
-                            pass
-                    if not res.success:
-                        print('Could not estimate MOMMA flow law parameters to fit MOI flow estimates for reach ',reach,\
-                                '. Revert to reach-scale FLPE estimates')
-                        param_est= self.alg_dict['momma'][reach]['B'], self.alg_dict['momma'][reach]['H']
-                    else:
-                        param_est=res.x
-
-                    #store output
-                    self.alg_dict['momma'][reach]['integrator']['B']=param_est[0]
-                    self.alg_dict['momma'][reach]['integrator']['H']=param_est[1]
-                    self.alg_dict['momma'][reach]['integrator']['Save']=aux_var
-                    self.alg_dict['momma'][reach]['integrator']['q']=self.momma_flowlaw(param_est,self.obs_dict[reach],aux_var)
-               else: 
-                    self.alg_dict['momma'][reach]['integrator']['B']=np.nan
-                    self.alg_dict['momma'][reach]['integrator']['H']=np.nan
-                    self.alg_dict['momma'][reach]['integrator']['Save']=np.nan
-                    self.alg_dict['momma'][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
-
-          #2.5 SAD
-          print('CALCULATING SAD FLPs')
-          for reach in self.alg_dict['sad']:
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
-
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
-               with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    nflpe=np.nanmean(self.alg_dict['sad'][reach]['n'])
-               #if self.obs_dict[reach]['nt'] > 0 and (not np.isnan(nflpe)):
-
-
-               if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                    with warnings.catch_warnings():
-                         warnings.simplefilter("ignore", category=RuntimeWarning)
-                         Abar_min=-min(self.obs_dict[reach]['dA'])+1
-                         if not np.isnan(nflpe):
-                             init_params=(np.nanmean(self.alg_dict['sad'][reach]['n']), \
-                                  np.nanmean(self.alg_dict['sad'][reach]['a0']))
-                         else:
-                             init_params=(0.03,Abar_min+10.)
-
-                    #param_bounds=( (0.001,np.inf),(-min(self.obs_dict[reach]['dA'])+1,np.inf))
-                    param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
-
-                    qbar=self.alg_dict['sad'][reach]['integrator']['qbar']
-                    if 'q33' in self.alg_dict['sad'][reach]['integrator']:
-                        q33=self.alg_dict['sad'][reach]['integrator']['q33']
-                    else:
-                        q33=nan 
-
-                    res = optimize.minimize(fun=self.sad_objfun,
-                                        x0=init_params,
-                                        args=(self.obs_dict[reach],qbar,q33),
-                                        bounds=param_bounds )
-
-                    param_est=res.x
-
-                    #store output
-                    self.alg_dict['sad'][reach]['integrator']['n']=param_est[0]
-                    self.alg_dict['sad'][reach]['integrator']['a0']=param_est[1]
-                    self.alg_dict['sad'][reach]['integrator']['q']=self.sad_flowlaw(param_est,self.obs_dict[reach])
-               else: 
-                    self.alg_dict['sad'][reach]['integrator']['n']=np.nan
-                    self.alg_dict['sad'][reach]['integrator']['a0']=np.nan
-                    self.alg_dict['sad'][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
-
-          #2.6 SIC4DVar
-          print('CALCULATING SIC4DVar FLPs')
-          for reach in self.alg_dict['sic4dvar']:
-               '''
-               try:
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       print('good')
-               except:
-                   continue
-               '''
-               try: 
-                   if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                       datagood=True
-               except:
-                   continue
-
-               if reach not in self.basin_dict['reach_ids']:
-                   # reach is not observed. do not calculate FLPs
-                   continue
-               with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    nflpe=np.nanmean(self.alg_dict['sic4dvar'][reach]['n'])
-               #if self.obs_dict[reach]['nt'] > 0 and (not np.isnan(nflpe)):
+          if min_H_obs - init_params[0] > 10.:
+               B=min_H_obs - 10.
+               init_params=(B,B+10.)
+                    
+          #param_bounds=( (0.1,np.min(obs['h'])-0.1),(0.1,np.inf))
+          #param_bounds=( (0.1,Bmax),(0.1,np.inf))
+          param_bounds=( (0.1,Bmax),(Bmax+0.1,np.inf))
 
 
-               if self.obs_dict[reach]['nt'] > 0 and self.obs_dict[reach]['dA'].size > 0:
-                    with warnings.catch_warnings():
-                         warnings.simplefilter("ignore", category=RuntimeWarning)
+          aux_var=flpe['Save']
 
-                         Abar_min=-min(self.obs_dict[reach]['dA'])+1
-                         if not np.isnan(nflpe):
-                              init_params=(np.nanmean(self.alg_dict['sic4dvar'][reach]['n']), \
-                                   np.nanmean(self.alg_dict['sic4dvar'][reach]['a0']))
-                         else:
-                              init_params=(0.03,Abar_min+10.)
+          if np.isnan(aux_var):
+              aux_var=20e-5
 
-                    #param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
-                    param_bounds=( (0.001,10.),(Abar_min,np.inf))
+          qbar=flpe['integrator']['qbar']
+          q33=flpe['integrator'].get('q33',np.nan)
 
-                    res = optimize.minimize(fun=self.sic4dvar_objfun,
-                                        x0=init_params,
-                                        args=(self.obs_dict[reach],self.alg_dict['sic4dvar'][reach]['integrator']['qbar'] ),
-                                        bounds=param_bounds )
+          try:
+              # the minimize is not just failing to minimize and returnning res.success=fale
+              # it is failing to minimize and raising an error, so we implement try excepts here.
+              res = optimize.minimize(fun=Integrate.momma_objfun,
+                                  x0=init_params,
+                                  args=(obs,qbar,q33,aux_var ),
+                                  bounds=param_bounds )
+              success=res.success
+          except:
+              success=False
 
-                    param_est=res.x
+          if not success:
+              try:
+                  param_bounds=( (.1,np.min(obs['h'])-0.1),(max_H_obs-1.,max_H_obs+1.)   )
 
-                    #store output
-                    self.alg_dict['sic4dvar'][reach]['integrator']['n']=param_est[0]
-                    self.alg_dict['sic4dvar'][reach]['integrator']['a0']=param_est[1]
-                    self.alg_dict['sic4dvar'][reach]['integrator']['q']=self.sic4dvar_flowlaw(param_est,self.obs_dict[reach])
-               else: 
-                    self.alg_dict['sic4dvar'][reach]['integrator']['n']=np.nan
-                    self.alg_dict['sic4dvar'][reach]['integrator']['a0']=np.nan
-                    self.alg_dict['sic4dvar'][reach]['integrator']['q']=np.full( (1,self.obs_dict[reach]['nt']),np.nan)
+
+                  res = optimize.minimize(fun=Integrate.momma_objfun,
+                                  x0=init_params,
+                                  args=(obs,qbar,q33,aux_var ),
+                                  bounds=param_bounds )
+                  success=res.success
+              except:
+                  pass
+          if not success:
+              print('Could not estimate MOMMA flow law parameters to fit MOI flow estimates for reach ',reach,\
+                      '. Revert to reach-scale FLPE estimates')
+              param_est= flpe['B'], flpe['H']
+          else:
+              param_est=res.x
+
+          return {
+               'B': param_est[0],
+               'H': param_est[1],
+               'Save': aux_var
+          }
+
+     @staticmethod
+     def fit_sad(reach,obs,flpe,jac=False):
+          """Fit SAD (n, Abar) to the integrator flows; return the fitted parameters."""
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               nflpe=np.nanmean(flpe['n'])
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               Abar_min=-min(obs['dA'])+1
+               if not np.isnan(nflpe):
+                   init_params=(np.nanmean(flpe['n']), \
+                        np.nanmean(flpe['a0']))
+               else:
+                   init_params=(0.03,Abar_min+10.)
+
+          #param_bounds=( (0.001,np.inf),(-min(obs['dA'])+1,np.inf))
+          param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
+
+          qbar=flpe['integrator']['qbar']
+          q33=flpe['integrator'].get('q33',np.nan)
+
+          # with jac the objective also returns its analytic gradient
+          res = optimize.minimize(fun=Integrate.sad_objfun_grad if jac else Integrate.sad_objfun,
+                              jac=jac or None,
+                              x0=init_params,
+                              args=(obs,qbar,q33),
+                              bounds=param_bounds )
+
+          param_est=res.x
+
+          return {
+               'n': param_est[0],
+               'a0': param_est[1]
+          }
+
+     @staticmethod
+     def fit_sic4dvar(reach,obs,flpe,jac=False):
+          """Fit SIC4DVar (n, Abar) to the integrator mean flow; return the fitted parameters."""
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+               nflpe=np.nanmean(flpe['n'])
+
+          with warnings.catch_warnings():
+               warnings.simplefilter("ignore", category=RuntimeWarning)
+
+               Abar_min=-min(obs['dA'])+1
+               if not np.isnan(nflpe):
+                    init_params=(np.nanmean(flpe['n']), \
+                         np.nanmean(flpe['a0']))
+               else:
+                    init_params=(0.03,Abar_min+10.)
+
+          #param_bounds=( (0.001,np.inf),(Abar_min,np.inf))
+          param_bounds=( (0.001,10.),(Abar_min,np.inf))
+
+          # with jac the objective also returns its analytic gradient
+          res = optimize.minimize(fun=Integrate.sic4dvar_objfun_grad if jac else Integrate.sic4dvar_objfun,
+                              jac=jac or None,
+                              x0=init_params,
+                              args=(obs,flpe['integrator']['qbar'] ),
+                              bounds=param_bounds )
+
+          param_est=res.x
+
+          return {
+               'n': param_est[0],
+               'a0': param_est[1]
+          }
 
      def integrate_prior(self):
           """Mimic the integrate function but apply only to the prior data"""
@@ -1334,14 +1725,7 @@ class Integrate:
           for FlowLevel in FlowLevels:
               if self.VerboseFlag:
                   print('Running flow level',FlowLevel)
-              residuals={}
-              for alg in self.alg_dict:
-                  residuals[alg]=np.full((n,),np.nan)
-              #for i in range(0,niter):
-              for i in range(0,self.params_dict['niter']):
-                  if self.VerboseFlag:
-                       print('  Running iteration',i,'/',self.params_dict['niter'])
-                  residuals=self.integrator_optimization_calcs(m,n,FlowLevel,residuals)
+              residuals=self.iterate_integration(m,n,FlowLevel)
 
 
      def integrate(self):
@@ -1372,16 +1756,13 @@ class Integrate:
               print('Number of junctions = ',m)
               print('Number of reaches= ',n)
 
+          #0.5 build the mass conservation matrix once for all algorithms, iterations and flow levels
+          self.calcG(m,n)
+
           #1 integration calculations
           for FlowLevel in FlowLevels:
               print('Running flow level',FlowLevel)
-              residuals={} 
-              for alg in self.alg_dict:
-                  residuals[alg]=np.full((n,),np.nan)
-              #for i in range(0,niter):
-              for i in range(0,self.params_dict['niter']):
-                  print('  Running iteration',i+1,'/',self.params_dict['niter'])
-                  residuals=self.integrator_optimization_calcs(m,n,FlowLevel,residuals)
+              residuals=self.iterate_integration(m,n,FlowLevel)
 
           if self.params_dict['quit_before_flpe']:
               sys.exit('done with integration... exiting')
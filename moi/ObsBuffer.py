@@ -0,0 +1,75 @@
+# Third-party imports
+import numpy as np
+
+class ObsBuffer:
+    """SWOT observations of a basin in one contiguous buffer per variable.
+
+    The filtered observations of reach i are values[key][offsets[i]:offsets[i+1]]
+    for every key in FIELDS, so all variables share one offsets array. Once
+    attached, the arrays in obs_dict are views onto the buffer: flow laws
+    given an obs_dict entry read the buffer without copies, and flow laws
+    given the buffer itself, with parameters expanded to one value per
+    observation, evaluate every reach of the basin in one numpy call.
+
+    Attributes
+    ----------
+    reaches: list
+        reach identifiers (str), in buffer order
+    offsets: numpy.ndarray
+        start of each reach's observations, followed by the total count
+    values: dict
+        obs_dict key -> all observations of the basin
+
+    Methods
+    -------
+    attach(obs_dict)
+        replace the arrays in obs_dict by views onto the buffer
+    expand(per_reach)
+        repeat one value per reach once per observation
+    reach(reach)
+        return the views of one reach, keyed as in obs_dict
+    """
+
+    FIELDS = ('h', 'w', 'S', 'dA', 't')
+
+    def __init__(self, obs_dict):
+        self.reaches = list(obs_dict)
+        counts = np.array([len(obs_dict[reach]['h']) for reach in self.reaches], dtype=np.int64)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.rows = {reach: i for i, reach in enumerate(self.reaches)}
+        self.values = {}
+        for key in self.FIELDS:
+            arrays = [np.ravel(obs_dict[reach][key]) for reach in self.reaches]
+            self.values[key] = np.concatenate(arrays) if arrays else np.empty(0)
+
+    def __getitem__(self, key):
+        """Return all observations of key; 'nt' is the total count."""
+
+        if key == 'nt':
+            return int(self.offsets[-1])
+        return self.values[key]
+
+    @property
+    def counts(self):
+        """Number of observations of each reach."""
+
+        return np.diff(self.offsets)
+
+    def expand(self, per_reach):
+        """Return per_reach (one value per reach) repeated for each observation."""
+
+        return np.repeat(np.asarray(per_reach, dtype=np.float64), self.counts)
+
+    def reach(self, reach):
+        """Return the observations of a reach as views onto the buffer."""
+
+        i = self.rows[reach]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return {key: self.values[key][start:stop] for key in self.FIELDS}
+
+    def attach(self, obs_dict):
+        """Replace the arrays of every reach in obs_dict by views onto the buffer."""
+
+        for reach in self.reaches:
+            obs_dict[reach].update(self.reach(reach))
@@ -1,8 +1,10 @@
 # Standard imports
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import math
 from pathlib import Path
+import tempfile
 import time
-import random
 import os,sys
 
 # Third-party imports
@@ -10,12 +12,399 @@ from netCDF4 import Dataset
 import numpy as np
 import shutil
 
-def wait_random(min_seconds=1, max_seconds=10):
-    """Wait for a random amount of time between min_seconds and max_seconds."""
-    random_wait_time = random.uniform(min_seconds, max_seconds)
-    print(f"Waiting for {random_wait_time:.2f} seconds...")
-    time.sleep(random_wait_time)
-    print("Done waiting!")
+# Local imports
+from moi.Input import find_rows, observed_mask
+
+# fill value of the integrator output files
+FILL_VALUE=-999999999999
+
+# variables of each algorithm group in the integrator files, in file order,
+# as (variable, field, source): source 'integrator' reads
+# alg_dict[alg][reach]['integrator'][field] and 'flpe' reads
+# alg_dict[alg][reach][field]. q has dimension nt, all others are scalars.
+OUTPUT_VARIABLES={
+    'neobam': [('q','q','integrator'), ('a0','a0','integrator'), ('n','n','integrator'),
+               ('qbar_reachScale','qbar','flpe'), ('qbar_basinScale','qbar','integrator'),
+               ('sbQ_rel','sbQ_rel','integrator')],
+    'hivdi': [('q','q','integrator'), ('Abar','Abar','integrator'), ('alpha','alpha','integrator'),
+              ('beta','beta','integrator'), ('qbar_reachScale','qbar','flpe'),
+              ('qbar_basinScale','qbar','integrator'), ('sbQ_rel','sbQ_rel','integrator')],
+    'metroman': [('q','q','integrator'), ('Abar','a0','integrator'), ('na','na','integrator'),
+                 ('x1','x1','integrator'), ('qbar_reachScale','qbar','flpe'),
+                 ('qbar_basinScale','qbar','integrator'), ('q33_basinScale','q33','integrator'),
+                 ('sbQ_rel','sbQ_rel','integrator')],
+    'momma': [('q','q','integrator'), ('B','B','integrator'), ('H','H','integrator'),
+              ('Save','Save','integrator'), ('qbar_reachScale','qbar','flpe'),
+              ('qbar_basinScale','qbar','integrator'), ('sbQ_rel','sbQ_rel','integrator')],
+    'sad': [('q','q','integrator'), ('n','n','integrator'), ('a0','a0','integrator'),
+            ('qbar_reachScale','qbar','flpe'), ('qbar_basinScale','qbar','integrator'),
+            ('sbQ_rel','sbQ_rel','integrator')],
+    'sic4dvar': [('q','q','integrator'), ('n','n','integrator'), ('a0','a0','integrator'),
+                 ('qbar_reachScale','qbar','flpe'), ('qbar_basinScale','qbar','integrator'),
+                 ('sbQ_rel','sbQ_rel','integrator')]
+}
+
+# variables written for reaches without SWOT observations
+UNOBSERVED_VARIABLES=['qbar_basinScale','sbQ_rel']
+
+# FLPs written back to SWORD, by SWORD discharge model, as (SWORD variable,
+# algorithm, field of alg_dict[alg][reach]['integrator'])
+SWORD_FLP_VARIABLES={
+    'BAM': [('Abar','neobam','a0'), ('n','neobam','n'), ('sbQ_rel','neobam','sbQ_rel')],
+    'HiVDI': [('Abar','hivdi','Abar'), ('alpha','hivdi','alpha'), ('beta','hivdi','beta'),
+              ('sbQ_rel','hivdi','sbQ_rel')],
+    'MetroMan': [('Abar','metroman','a0'), ('ninf','metroman','na'), ('p','metroman','x1'),
+                 ('sbQ_rel','metroman','sbQ_rel')],
+    'MOMMA': [('B','momma','B'), ('H','momma','H'), ('Save','momma','Save')],
+    'SADS': [('Abar','sad','a0'), ('n','sad','n'), ('sbQ_rel','sad','sbQ_rel')],
+    'SIC4DVar': [('Abar','sic4dvar','a0'), ('n','sic4dvar','n'), ('sbQ_rel','sic4dvar','sbQ_rel')]
+}
+
+# (field, source) of OUTPUT_VARIABLES written as fill values with write_fill_only
+FILL_ONLY_FIELDS={('q','integrator'), ('qbar','integrator'), ('q33','integrator'), ('sbQ_rel','integrator'),
+                  ('qbar','flpe')}
+
+def cpu_allocation():
+    """Return the number of CPUs allocated to this process.
+
+    These are the CPUs the process may run on, limited by the container's
+    CPU quota (cgroup v2 cpu.max, or cgroup v1 cpu.cfs_quota_us). The quota
+    is how vCPUs are allocated to AWS Batch and other container jobs.
+    """
+
+    try:
+        cpus=len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus=os.cpu_count() or 1
+
+    quota=None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit,period=f.read().split()
+        if limit != 'max':
+            quota=int(limit)/int(period)
+    except (OSError,ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit=int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period=int(f.read())
+            if limit > 0:
+                quota=limit/period
+        except (OSError,ValueError):
+            pass
+
+    if quota is not None:
+        cpus=min(cpus,math.ceil(quota))
+    return max(cpus,1)
+
+def as_float(value):
+    """Return a scalar output value as a float, with masked or missing values as nan."""
+
+    value=np.ravel(np.ma.filled(value,np.nan))
+    return np.float64(value[0]) if value.size else np.nan
+
+def reach_outputs(alg_dict, reach, obs=None, fill_only=False):
+    """Return the contents of a reach's integrator file.
+
+    obs is the reach's obs_dict entry, or None for a reach without SWOT
+    observations, whose file only holds UNOBSERVED_VARIABLES. With
+    fill_only the FILL_ONLY_FIELDS are written as fill values. q is expanded
+    to the full time series, with FILL_VALUE at the removed observations
+    (obs['iDelete']). All scalars are converted in one np.nan_to_num call,
+    so nan becomes FILL_VALUE and infinities the largest floats, as when
+    each variable was converted separately.
+
+    Returns
+    -------
+    nt: int
+        number of time steps, None for a reach without observations
+    variables: dict
+        algorithm -> list of (variable, value), in file order
+    """
+
+    if obs is None:
+        nt=None
+        table={alg: [entry for entry in entries if entry[0] in UNOBSERVED_VARIABLES]
+               for alg,entries in OUTPUT_VARIABLES.items()}
+    else:
+        nt=obs['nt']+np.shape(obs['iDelete'])[1]
+        keep=np.ones(nt,dtype=bool)
+        keep[obs['iDelete']]=False
+        table=OUTPUT_VARIABLES
+
+    names=[]
+    scalars=[]
+    series={}
+    for alg,entries in table.items():
+        for name,field,source in entries:
+            data=alg_dict[alg][reach]
+            data=data['integrator'] if source == 'integrator' else data
+            if fill_only and (field,source) in FILL_ONLY_FIELDS:
+                data={}
+            if name == 'q':
+                q=np.full(nt,np.nan)
+                q[keep]=np.ravel(data.get(field,np.nan))
+                q[~keep]=FILL_VALUE
+                series[alg]=np.nan_to_num(q,copy=False,nan=FILL_VALUE)
+            else:
+                names.append((alg,name))
+                scalars.append(as_float(data.get(field,np.nan)))
+    scalars=np.nan_to_num(np.array(scalars),copy=False,nan=FILL_VALUE)
+
+    variables={alg: [] for alg in table}
+    for alg,entries in table.items():
+        if alg in series:
+            variables[alg].append(('q',series[alg]))
+    for (alg,name),value in zip(names,scalars):
+        variables[alg].append((name,value))
+    return nt,variables
+
+def write_integrator_file(out_file, nt, variables):
+    """Write one reach's integrator file from the output of reach_outputs.
+
+    The file is built in memory and written to disk once when it is closed,
+    so a file costs one write on network file systems instead of one per
+    HDF5 metadata update. Values are already converted, so they are written
+    without masking.
+    """
+
+    out = Dataset(out_file, 'w', format="NETCDF4", diskless=True, persist=True)
+    out.set_auto_mask(False)
+    out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+
+    if nt is not None:
+        # Dimensions and coordinate variables
+        out.createDimension("nt", nt)
+        nt_var = out.createVariable("nt", "i4", ("nt",))
+        nt_var.units = "time steps"
+        nt_var[:] = np.arange(nt)
+
+    for alg,entries in variables.items():
+        out.createGroup(alg)
+        for name,value in entries:
+            if name == 'q':
+                out.createVariable(f"{alg}/q", "f8", ("nt",), fill_value=FILL_VALUE)[:] = value
+            else:
+                out.createVariable(f"{alg}/{name}", "f8", fill_value=FILL_VALUE).assignValue(value)
+    out.close()
+
+def fill_variables(nt):
+    """Return the variables of a reach file holding only fill values, as reach_outputs."""
+
+    variables={}
+    for alg,entries in OUTPUT_VARIABLES.items():
+        names=[entry[0] for entry in entries if nt is not None or entry[0] in UNOBSERVED_VARIABLES]
+        variables[alg]=[(name,np.full(nt,float(FILL_VALUE)) if name == 'q' else np.float64(FILL_VALUE))
+                        for name in names]
+    return variables
+
+def write_templates(template_dir, nts):
+    """Write a reach file of fill values for each number of time steps in nts.
+
+    None in nts stands for the file of a reach without observations.
+    Returns {nt: template file}.
+    """
+
+    templates={}
+    for nt in nts:
+        templates[nt]=Path(template_dir) / f"template_{nt}_integrator.nc"
+        write_integrator_file(templates[nt],nt,fill_variables(nt))
+    return templates
+
+def clone_template(template, out_file, variables):
+    """Write a reach file by copying a template of fill values.
+
+    Only the variables that are not entirely fill values, typically the
+    basin-scale qbar and sbQ_rel of unobserved reaches or the FLPs of
+    fill-only runs, are written into the copy, together with a new
+    production_date. A copy that needs no values keeps the template's
+    production_date, the time the run started writing.
+    """
+
+    shutil.copyfile(template,out_file)
+    patch=[(alg,name,value) for alg,entries in variables.items() for name,value in entries
+           if np.any(value != FILL_VALUE)]
+    if not patch:
+        return
+
+    out = Dataset(out_file, 'a')
+    out.set_auto_mask(False)
+    out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+    for alg,name,value in patch:
+        if name == 'q':
+            out[alg][name][:] = value
+        else:
+            out[alg][name].assignValue(value)
+    out.close()
+
+def write_reach_files(payload):
+    """Write the integrator files of a chunk of reaches.
+
+    payload is (out_dir, reaches, alg_dict, obs_dict, fill_only, templates),
+    where alg_dict and obs_dict hold only the chunk's reaches; reaches
+    missing from obs_dict get the unobserved file. Files of unobserved
+    reaches, and all files if fill_only, are cloned from the templates made
+    by write_templates. Defined at module level so that it can run in a
+    worker process. Returns (process id, files written, seconds).
+    """
+
+    out_dir,reaches,alg_dict,obs_dict,fill_only,templates=payload
+    start=time.perf_counter()
+    for reach in reaches:
+        nt,variables=reach_outputs(alg_dict,reach,obs_dict.get(reach),fill_only)
+        out_file=out_dir / f"{reach}_integrator.nc"
+        if nt is None or fill_only:
+            clone_template(templates[nt],out_file,variables)
+        else:
+            write_integrator_file(out_file,nt,variables)
+    return os.getpid(),len(reaches),time.perf_counter()-start
+
+def write_basin_file(out_file, basin_id, reaches, outputs):
+    """Write the integrator results of a basin to one file.
+
+    The file holds the variables of the reach files, listed in
+    OUTPUT_VARIABLES, with a leading reach dimension. q is padded to the
+    longest time series with FILL_VALUE; variable nt holds the number of
+    time steps of each reach, and variable observed is 1 for reaches with
+    SWOT observations. The variables of unobserved reaches other than
+    UNOBSERVED_VARIABLES are fill values.
+
+    Parameters
+    ----------
+    out_file: Path
+        file to write
+    basin_id: str
+        basin identifier, stored as an attribute
+    reaches: list
+        reach identifiers (str)
+    outputs: list
+        (nt, variables) of each reach, as returned by reach_outputs
+    """
+
+    nr=len(reaches)
+    nts=np.array([nt or 0 for nt,variables in outputs],dtype=np.int32)
+    observed=np.array([nt is not None for nt,variables in outputs],dtype=np.int8)
+    ntmax=int(nts.max()) if nr else 0
+    data={}
+    for alg,entries in OUTPUT_VARIABLES.items():
+        for name,field,source in entries:
+            data[alg,name]=np.full((nr,ntmax) if name == 'q' else nr,FILL_VALUE,dtype=np.float64)
+    for i,(nt,variables) in enumerate(outputs):
+        for alg,entries in variables.items():
+            for name,value in entries:
+                if name == 'q':
+                    data[alg,name][i,:nt]=value
+                else:
+                    data[alg,name][i]=value
+
+    out = Dataset(out_file, 'w', format="NETCDF4", diskless=True, persist=True)
+    out.set_auto_mask(False)
+    out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+    out.basin_id = str(basin_id)
+
+    out.createDimension("reach", nr)
+    out.createDimension("nt", ntmax)
+    reach_id = out.createVariable("reach_id", "i8", ("reach",))
+    reach_id[:] = np.array([int(reach) for reach in reaches],dtype=np.int64)
+    nt_var = out.createVariable("nt", "i4", ("reach",))
+    nt_var.units = "time steps"
+    nt_var[:] = nts
+    observed_var = out.createVariable("observed", "i1", ("reach",))
+    observed_var.flag_values = np.array([0,1],dtype=np.int8)
+    observed_var.flag_meanings = "unobserved observed"
+    observed_var[:] = observed
+
+    for alg,entries in OUTPUT_VARIABLES.items():
+        out.createGroup(alg)
+        for name,field,source in entries:
+            dims=("reach","nt") if name == 'q' else ("reach",)
+            out.createVariable(f"{alg}/{name}", "f8", dims, fill_value=FILL_VALUE)[:] = data[alg,name]
+    out.close()
+
+def read_basin_file(out_file):
+    """Read a file written by write_basin_file, as the reach files would be read.
+
+    Returns {reach: {alg: {variable: value}}} with the variables of each
+    algorithm. Each variable is read once; q of a reach is a view of its
+    time steps in the basin array, and values are masked where they equal
+    FILL_VALUE, as when reading a reach file with netCDF4. Unobserved
+    reaches get UNOBSERVED_VARIABLES only; an observed reach keeps all its
+    variables even if all of its observations were removed.
+    """
+
+    out = Dataset(out_file)
+    reaches = [str(reach) for reach in out['reach_id'][:]]
+    nts = out['nt'][:]
+    observed = out['observed'][:] == 1
+    data = {(alg,name): out[alg][name][:] for alg in out.groups for name in out[alg].variables}
+    out.close()
+
+    result={}
+    for i,reach in enumerate(reaches):
+        result[reach]={}
+        for alg,entries in OUTPUT_VARIABLES.items():
+            names=[entry[0] for entry in entries] if observed[i] else UNOBSERVED_VARIABLES
+            result[reach][alg]={name: data[alg,name][i,:nts[i]] if name == 'q' else data[alg,name][i]
+                                for name in names}
+    return result
+
+def merge_sword_deltas(delta_files, sword_dir, dest_dir):
+    """Apply SWORD FLP delta files to copies of their SWORD files in one pass.
+
+    The delta files are written by Output.write_sword_output, one per basin
+    job. They are grouped by the SWORD file they update, which is copied
+    from sword_dir to dest_dir as <sword>_moi.nc if no copy exists yet.
+    Each copy is opened once, reach rows are matched in bulk, and each SWORD
+    variable is read and written back whole, so no lock is held by the
+    basin jobs and none is contended here. Masked delta values and reaches
+    that are not in SWORD are skipped. Deltas are applied in the order of
+    delta_files, so the last delta of a reach wins.
+
+    Parameters
+    ----------
+    delta_files: list
+        paths of the delta files
+    sword_dir: Path
+        directory of the SWORD files
+    dest_dir: Path
+        directory of the SWORD copies
+    """
+
+    deltas={}
+    for delta_file in delta_files:
+        delta=Dataset(delta_file)
+        deltas.setdefault(delta.sword,[]).append(delta_file)
+        delta.close()
+
+    for sword,files in deltas.items():
+        sword_dest_file=Path(dest_dir).joinpath(sword.replace('.nc', '_moi.nc'))
+        if not os.path.exists(sword_dest_file):
+            shutil.copy(Path(sword_dir).joinpath(sword),sword_dest_file)
+
+        sword_dataset = Dataset(sword_dest_file,'a')
+        reach_ids = sword_dataset['reaches']['reach_id'][:]
+
+        # (branch, model, variable) -> list of (rows, values)
+        updates={}
+        for delta_file in files:
+            delta=Dataset(delta_file)
+            rows=find_rows(reach_ids,[str(reach) for reach in delta['reach_id'][:]])
+            for model in delta.groups:
+                for name in delta[model].variables:
+                    values=delta[model][name][:]
+                    keep=(rows >= 0) & ~np.ma.getmaskarray(values)
+                    updates.setdefault((delta.branch,model,name),[]).append((rows[keep],np.ma.getdata(values)[keep]))
+            delta.close()
+
+        for (branch,model,name),changes in updates.items():
+            variable=sword_dataset['reaches']['discharge_models'][branch][model][name]
+            variable.set_auto_mask(False)
+            data=variable[:]
+            for rows,values in changes:
+                data[rows]=values
+            variable[:]=data
+        sword_dataset.close()
 
 class Output:
     """Writes integration results stored in integ_dict to NetCDF file.
@@ -24,19 +413,27 @@ class Output:
     ----------
     basin_dict: dict
         dict of reach_ids and SoS file needed to process entire basin of data
-    FILL_VALUE: float
-        Float fill value for missing data
+    FILL_VALUE: int
+        fill value for missing data
     out_dir: Path
         path to output dir
     stage_estimate: dict
         dict of integrator estimate data
+    workers: int
+        number of processes writing reach files
 
     Methods
     -------
     write_output()
-        Write data stored to NetCDF file labelled with basin id
+        Write data stored to NetCDF files, per reach or per basin
+    write_reach_files(reaches, obs_dict, fill_only)
+        Write the reach files, in a process pool if workers > 1
+    write_sword_output(branch)
+        Write the basin's FLPs to a SWORD delta file
     """
 
+    FILL_VALUE = FILL_VALUE
+
     def __init__(self, basin_dict, out_dir, integ_dict, alg_dict, obs_dict, sword_dir,params_dict):
         """
         Parameters
@@ -47,6 +444,9 @@ class Output:
             path to output dir
         integ_dict: dict
             dict of integrator estimate data
+        params_dict: dict
+            dict of MOI parameters; params_dict['output_workers'] processes
+            write the reach files, by default the CPUs allocated to the job
         """
 
         self.basin_dict = basin_dict
@@ -56,390 +456,118 @@ class Output:
         self.obs_dict = obs_dict
         self.sword_dir = sword_dir
         self.params_dict=params_dict
-        
+        self.workers=params_dict.get('output_workers') or cpu_allocation()
+
     def write_output(self):
-        """Write data stored to NetCDF files for each reach
-        
-        TODO: 
-        - Add optional attribute metadata like valid
-        - Should variable output be (nr, nt)?
-        - Storage of FLPE algorithms
-        - Storage of actual Integrator processing
-        """
+        """Write data stored to NetCDF files for each reach, or for the basin.
 
-        fillvalue = -999999999999
+        The variables of each file are listed in OUTPUT_VARIABLES; the
+        values are gathered by reach_outputs and written by
+        write_integrator_file, one file per reach. With
+        params_dict['output_mode'] == 'basin' all reaches are written to
+        one file, <basin_id>_basin_integrator.nc, by write_basin_file.
+        """
 
         if self.out_dir == Path('/mnt/data/output'):
             # normal confluence runs in AWS, just write out reaches we have swot data for
             reaches_to_write=self.basin_dict['reach_ids']
+            observed=np.ones(len(reaches_to_write),dtype=bool)
         else:
             # offline runs,  it's nice to have the integrator values for reaches we do not have swot data for
             print('debug mode: writing out all reach ids')
             reaches_to_write=self.basin_dict['reach_ids_all']
+            observed=observed_mask(self.basin_dict)
 
+        fill_only=self.params_dict['write_fill_only']
+        if fill_only:
+            print('writing fill values only')
 
-        for reach in reaches_to_write:
-             # this first block  sets everything to nan, allowing "blank" output files to be written
-             if self.params_dict['write_fill_only']:
-                 print('writing fill values only')
-                 for algo in self.alg_dict.keys():
-                     print('... setting ',algo,'to fill')
-                     if 'q' in self.alg_dict[algo][reach]['integrator'].keys():
-                         self.alg_dict[algo][reach]['integrator']['q'][:]=np.nan
-                     self.alg_dict[algo][reach]['integrator']['qbar']=np.nan
-                     self.alg_dict[algo][reach]['integrator']['q33']=np.nan
-                     self.alg_dict[algo][reach]['integrator']['sbQ_rel']=np.nan
-                     if 'qbar' in self.alg_dict[algo][reach].keys():
-                         self.alg_dict[algo][reach]['qbar']=np.nan
-
-             not_obs = False
-             # just write out the steady flow discharge values if this was an unobserved reach
-             try:
-                #print(self.obs_dict[reach])
-                tmpdata=self.obs_dict[reach]
-                print('tmpdata found')
-             except:
-                print('reach not in obs_dict... filling with default')
-                not_obs = True
-             if reach not in self.basin_dict['reach_ids']: 
-                #print(reach)
-                #print(type(reach))
-                #print(self.basin_dict['reach_ids'][0])
-                #print(type(self.basin_dict['reach_ids'][0]))
-                #print('second condition...')
-                not_obs = True
-             if not_obs:
-                print('not obs found... doing regular')
-                # NetCDF file creation
-                out_file = self.out_dir / f"{reach}_integrator.nc"
-                out = Dataset(out_file, 'w', format="NETCDF4")
-                out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
-
-                #1 neobam
-                gb = out.createGroup("neobam")
-                gb_qbar_stage2  = out.createVariable("neobam/qbar_basinScale", "f8", fill_value=fillvalue)
-                gb_qbar_stage2[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                gb_sbQ_rel = out.createVariable("neobam/sbQ_rel", "f8", fill_value=fillvalue)
-                gb_sbQ_rel[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-                #2 hivdi
-                hv = out.createGroup("hivdi")
-                hv_qbar_stage2  = out.createVariable("hivdi/qbar_basinScale", "f8", fill_value=fillvalue)
-                hv_qbar_stage2[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                hv_sbQ_rel = out.createVariable("hivdi/sbQ_rel", "f8", fill_value=fillvalue)
-                hv_sbQ_rel[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-                #3 metroman
-                mm = out.createGroup("metroman")
-                mm_qbar_stage2  = out.createVariable("metroman/qbar_basinScale", "f8", fill_value=fillvalue)
-                mm_qbar_stage2[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                mm_sbQ_rel = out.createVariable("metroman/sbQ_rel", "f8", fill_value=fillvalue)
-                mm_sbQ_rel[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-                #4 momma
-                mo = out.createGroup("momma")
-                mo_qbar_stage2  = out.createVariable("momma/qbar_basinScale", "f8", fill_value=fillvalue)
-                mo_qbar_stage2[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                mo_sbQ_rel = out.createVariable("momma/sbQ_rel", "f8", fill_value=fillvalue)
-                mo_sbQ_rel[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-                #5 sad
-                sad = out.createGroup("sad")
-                sad_qbar_stage2  = out.createVariable("sad/qbar_basinScale", "f8", fill_value=fillvalue)
-                sad_qbar_stage2[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                sad_sbQ_rel = out.createVariable("sad/sbQ_rel", "f8", fill_value=fillvalue)
-                sad_sbQ_rel[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-                #6 sic
-                sic = out.createGroup("sic4dvar")
-                sic_qbar_stage2  = out.createVariable("sic4dvar/qbar_basinScale", "f8", fill_value=fillvalue)
-                sic_qbar_stage2[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-                sic_sbQ_rel = out.createVariable("sic4dvar/sbQ_rel", "f8", fill_value=fillvalue)
-                sic_sbQ_rel[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-                out.close()
-                continue
-             iDelete=self.obs_dict[reach]['iDelete']
-             shape_iDelete=np.shape(iDelete)
-             nDelete=shape_iDelete[1]
-             iInsert=iDelete-np.arange(nDelete)
-             iInsert=np.reshape(iInsert,[nDelete,]) 
-             self.obs_dict[reach]['nt'] += nDelete
-             #print(self.alg_dict['neobam'])
-             #print(self.alg_dict['neobam'][reach]['integrator'])
-             #print(self.alg_dict['neobam'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['neobam'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['neobam'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['hivdi'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['hivdi'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['metroman'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['metroman'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['momma'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['momma'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['sad'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['sad'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             self.alg_dict['sic4dvar'][reach]['integrator']['q']=np.insert( \
-                   self.alg_dict['sic4dvar'][reach]['integrator']['q'],iInsert,fillvalue,1)
-
-             # NetCDF file creation
-             out_file = self.out_dir / f"{reach}_integrator.nc"
-             out = Dataset(out_file, 'w', format="NETCDF4")
-             out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
-
-             # Dimensions and coordinate variables
-             out.createDimension("nt", self.obs_dict[reach]['nt'] )
-             nt = out.createVariable("nt", "i4", ("nt",))
-             nt.units = "time steps"
-             nt[:] = range(self.obs_dict[reach]['nt'])
-
-             # neobam
-             gb = out.createGroup("neobam")
-             gbq  = out.createVariable("neobam/q", "f8", ("nt",), fill_value=fillvalue)
-             gbq[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-             
-             gb_a0  = out.createVariable("neobam/a0", "f8", fill_value=fillvalue)
-             gb_a0[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['a0'], copy=True, nan=fillvalue)
-             
-             gb_n  = out.createVariable("neobam/n", "f8", fill_value=fillvalue)
-             gb_n[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['n'], copy=True, nan=fillvalue)
-             
-             gb_qbar_stage1  = out.createVariable("neobam/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 gb_qbar_stage1[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 gb_qbar_stage1[:]=np.nan
-             
-             gb_qbar_stage2  = out.createVariable("neobam/qbar_basinScale", "f8", fill_value=fillvalue)
-             gb_qbar_stage2[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             gb_sbQ_rel = out.createVariable("neobam/sbQ_rel", "f8", fill_value=fillvalue)
-             gb_sbQ_rel[:] = np.nan_to_num(self.alg_dict['neobam'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             # hivdi
-             hv = out.createGroup("hivdi")
-             hvq  = out.createVariable("hivdi/q", "f8", ("nt",), fill_value=fillvalue)
-             hvq[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-
-             hv_Abar = out.createVariable("hivdi/Abar", "f8", fill_value=fillvalue)
-             hv_Abar[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['Abar'], copy=True, nan=fillvalue)
-
-             hv_alpha = out.createVariable("hivdi/alpha", "f8", fill_value=fillvalue)
-             hv_alpha[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['alpha'], copy=True, nan=fillvalue)
-
-             hv_beta = out.createVariable("hivdi/beta", "f8", fill_value=fillvalue)
-             hv_beta[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['beta'], copy=True, nan=fillvalue)
-
-             hv_qbar_stage1  = out.createVariable("hivdi/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 hv_qbar_stage1[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 hv_qbar_stage1 = np.nan
-             
-             hv_qbar_stage2  = out.createVariable("hivdi/qbar_basinScale", "f8", fill_value=fillvalue)
-             hv_qbar_stage2[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             hv_sbQ_rel = out.createVariable("hivdi/sbQ_rel", "f8", fill_value=fillvalue)
-             hv_sbQ_rel[:] = np.nan_to_num(self.alg_dict['hivdi'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             # metroman
-             mm = out.createGroup("metroman")
-             mmq  = out.createVariable("metroman/q", "f8", ("nt",), fill_value=fillvalue)
-             mmq[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-
-             mm_Abar = out.createVariable("metroman/Abar", "f8", fill_value=fillvalue)
-             mm_Abar[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['a0'], copy=True, nan=fillvalue)
-
-             mm_na = out.createVariable("metroman/na", "f8", fill_value=fillvalue)
-             mm_na[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['na'], copy=True, nan=fillvalue)
-
-             mm_x1 = out.createVariable("metroman/x1", "f8", fill_value=fillvalue)
-             mm_x1[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['x1'], copy=True, nan=fillvalue)
-
-             mm_qbar_stage1  = out.createVariable("metroman/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 mm_qbar_stage1[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 mm_qbar_stage1[:]=np.nan
-             
-             mm_qbar_stage2  = out.createVariable("metroman/qbar_basinScale", "f8", fill_value=fillvalue)
-             mm_qbar_stage2[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             mm_q33_stage2  = out.createVariable("metroman/q33_basinScale", "f8", fill_value=fillvalue)
-             mm_q33_stage2[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['q33'], copy=True, nan=fillvalue)
-
-             mm_sbQ_rel = out.createVariable("metroman/sbQ_rel", "f8", fill_value=fillvalue)
-             mm_sbQ_rel[:] = np.nan_to_num(self.alg_dict['metroman'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             # momma
-             mo = out.createGroup("momma")
-             moq  = out.createVariable("momma/q", "f8", ("nt",), fill_value=fillvalue)
-             moq[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-
-             mo_B = out.createVariable("momma/B", "f8", fill_value=fillvalue)
-             mo_B[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['B'], copy=True, nan=fillvalue)
-
-             mo_H = out.createVariable("momma/H", "f8", fill_value=fillvalue)
-             mo_H[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['H'], copy=True, nan=fillvalue)
-
-             mo_Save = out.createVariable("momma/Save", "f8", fill_value=fillvalue)
-             mo_Save[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['Save'], copy=True, nan=fillvalue)
-
-             mo_qbar_stage1  = out.createVariable("momma/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 mo_qbar_stage1[:] = np.nan_to_num(self.alg_dict['momma'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 mo_qbar_stage1[:] = np.nan
-             
-             mo_qbar_stage2  = out.createVariable("momma/qbar_basinScale", "f8", fill_value=fillvalue)
-             mo_qbar_stage2[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             mo_sbQ_rel = out.createVariable("momma/sbQ_rel", "f8", fill_value=fillvalue)
-             mo_sbQ_rel[:] = np.nan_to_num(self.alg_dict['momma'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             #sad
-             sad=out.createGroup("sad")
-             sadq = out.createVariable("sad/q", "f8", ("nt",), fill_value=fillvalue)
-             sadq[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-
-             sad_n = out.createVariable("sad/n", "f8", fill_value=fillvalue)
-             sad_n[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['n'], copy=True, nan=fillvalue)
-
-             sad_a0 = out.createVariable("sad/a0", "f8", fill_value=fillvalue)
-             sad_a0[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['a0'], copy=True, nan=fillvalue)
-
-             sad_qbar_stage1  = out.createVariable("sad/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 sad_qbar_stage1[:] = np.nan_to_num(self.alg_dict['sad'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 sad_qbar_stage1[:] = np.nan
-             
-             sad_qbar_stage2  = out.createVariable("sad/qbar_basinScale", "f8", fill_value=fillvalue)
-             sad_qbar_stage2[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             sad_sbQ_rel = out.createVariable("sad/sbQ_rel", "f8", fill_value=fillvalue)
-             sad_sbQ_rel[:] = np.nan_to_num(self.alg_dict['sad'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             #sic4dvar
-             sic4dvar=out.createGroup("sic4dvar")
-             sic4dvarq = out.createVariable("sic4dvar/q", "f8", ("nt",), fill_value=fillvalue)
-             sic4dvarq[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['q'], copy=True, nan=fillvalue)
-
-             sic4dvar_n = out.createVariable("sic4dvar/n", "f8", fill_value=fillvalue)
-             sic4dvar_n[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['n'], copy=True, nan=fillvalue)
-
-             sic4dvar_a0 = out.createVariable("sic4dvar/a0", "f8", fill_value=fillvalue)
-             sic4dvar_a0[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['a0'], copy=True, nan=fillvalue)
-
-             sic4dvar_qbar_stage1  = out.createVariable("sic4dvar/qbar_reachScale", "f8", fill_value=fillvalue)
-             try:
-                 sic4dvar_qbar_stage1[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['qbar'], copy=True, nan=fillvalue)
-             except:
-                 sic4dvar_qbar_stage1[:] = np.nan
-             
-             sic4dvar_qbar_stage2  = out.createVariable("sic4dvar/qbar_basinScale", "f8", fill_value=fillvalue)
-             sic4dvar_qbar_stage2[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['qbar'], copy=True, nan=fillvalue)
-
-             sic4dvar_sbQ_rel = out.createVariable("sic4dvar/sbQ_rel", "f8", fill_value=fillvalue)
-             sic4dvar_sbQ_rel[:] = np.nan_to_num(self.alg_dict['sic4dvar'][reach]['integrator']['sbQ_rel'], copy=True, nan=fillvalue)
-
-             out.close()
-
-    def write_sword_output(self,branch):
-        """Make a new copy of the SWORD file, and write the Confluence estimates of the FLPs into the file.
-           by Mike, September 2022
-           """
-
-        sword_src_file=self.sword_dir.joinpath(self.basin_dict['sword'])
+        # just write out the steady flow discharge values if this was an unobserved reach
+        obs_dict={reach: self.obs_dict[reach] for reach,is_observed in zip(reaches_to_write,observed)
+                  if is_observed and reach in self.obs_dict}
 
-        if self.out_dir == Path('/mnt/data/output'):
-            #during normal operations, write this out to the sword directory
-            sword_dest_file=self.sword_dir.joinpath(self.basin_dict['sword'].replace('.nc', '_moi.nc'))
+        if self.params_dict['output_mode'] == 'basin':
+            outputs=[reach_outputs(self.alg_dict,reach,obs_dict.get(reach),fill_only) for reach in reaches_to_write]
+            basin_id=self.basin_dict['basin_id']
+            write_basin_file(self.out_dir / f"{basin_id}_basin_integrator.nc",basin_id,
+                             [str(reach) for reach in reaches_to_write],outputs)
         else:
-            print('for debugging purposes, write FLPs to the output directory rather than sword directory')
-            sword_dest_file=self.out_dir.joinpath(self.basin_dict['sword'].replace('.nc', '_moi.nc'))
+            self.write_reach_files(reaches_to_write,obs_dict,fill_only)
 
+    def write_reach_files(self,reaches,obs_dict,fill_only=False):
+        """Write the integrator file of each reach, in a process pool if workers > 1.
 
-        if not os.path.exists(sword_dest_file):
-            shutil.copy(sword_src_file,sword_dest_file)
-        try_cnt = 0
-        while try_cnt < 20:
-            try:
-                sword_dataset = Dataset(sword_dest_file,'a')
-                try_cnt = 999
-            except Exception as e:
-                print(e, 'waiting...')
-
-                wait_random(2,30)
-                try_cnt += 1
-    
-        try:
-
-            reaches = sword_dataset['reaches']['reach_id'][:]
-            
-            for reach in self.basin_dict['reach_ids']:
-                reach_ind = np.where(reaches == reach)
-                print(self.alg_dict['neobam'][reach]['integrator']['a0'])
-                
-                try:
-    
-                    #1 bam 
-                    sword_dataset['reaches']['discharge_models'][branch]['BAM']['Abar'][reach_ind]= \
-                        self.alg_dict['neobam'][reach]['integrator']['a0']
-                    sword_dataset['reaches']['discharge_models'][branch]['BAM']['n'][reach_ind]= \
-                        self.alg_dict['neobam'][reach]['integrator']['n']
-                    sword_dataset['reaches']['discharge_models'][branch]['BAM']['sbQ_rel'][reach_ind]= \
-                        self.alg_dict['neobam'][reach]['integrator']['sbQ_rel']
-                    #2 hivdi
-                    sword_dataset['reaches']['discharge_models'][branch]['HiVDI']['Abar'][reach_ind]=\
-                        self.alg_dict['hivdi'][reach]['integrator']['Abar']
-                    sword_dataset['reaches']['discharge_models'][branch]['HiVDI']['alpha'][reach_ind]=\
-                        self.alg_dict['hivdi'][reach]['integrator']['alpha']
-                    sword_dataset['reaches']['discharge_models'][branch]['HiVDI']['beta'][reach_ind]=\
-                        self.alg_dict['hivdi'][reach]['integrator']['beta']
-                    sword_dataset['reaches']['discharge_models'][branch]['HiVDI']['sbQ_rel'][reach_ind]= \
-                        self.alg_dict['hivdi'][reach]['integrator']['sbQ_rel']
-                    #3 metroman
-                    sword_dataset['reaches']['discharge_models'][branch]['MetroMan']['Abar'][reach_ind]= \
-                        self.alg_dict['metroman'][reach]['integrator']['a0']
-                    sword_dataset['reaches']['discharge_models'][branch]['MetroMan']['ninf'][reach_ind]= \
-                        self.alg_dict['metroman'][reach]['integrator']['na']
-                    sword_dataset['reaches']['discharge_models'][branch]['MetroMan']['p'][reach_ind]= \
-                        self.alg_dict['metroman'][reach]['integrator']['x1']
-                    sword_dataset['reaches']['discharge_models'][branch]['MetroMan']['sbQ_rel'][reach_ind]= \
-                        self.alg_dict['metroman'][reach]['integrator']['sbQ_rel']
-                    #4 momma
-                    sword_dataset['reaches']['discharge_models'][branch]['MOMMA']['B'][reach_ind]= \
-                        self.alg_dict['momma'][reach]['integrator']['B']
-                    sword_dataset['reaches']['discharge_models'][branch]['MOMMA']['H'][reach_ind]= \
-                        self.alg_dict['momma'][reach]['integrator']['H']
-                    sword_dataset['reaches']['discharge_models'][branch]['MOMMA']['Save'][reach_ind]= \
-                        self.alg_dict['momma'][reach]['integrator']['Save']
-                    #sword_dataset['reaches']['discharge_models'][branch]['MOMMA']['sbQ_rel'][reach_ind]= \
-                    #    self.alg_dict['momma'][reach]['integrator']['sbQ_rel']
-                    #5 sads
-                    sword_dataset['reaches']['discharge_models'][branch]['SADS']['Abar'][reach_ind]= \
-                        self.alg_dict['sad'][reach]['integrator']['a0']
-                    sword_dataset['reaches']['discharge_models'][branch]['SADS']['n'][reach_ind]= \
-                        self.alg_dict['sad'][reach]['integrator']['n']
-                    sword_dataset['reaches']['discharge_models'][branch]['SADS']['sbQ_rel'][reach_ind]= \
-                        self.alg_dict['sad'][reach]['integrator']['sbQ_rel']
-                    #6 sicvdvar  
-                    sword_dataset['reaches']['discharge_models'][branch]['SIC4DVar']['Abar'][reach_ind]= \
-                        self.alg_dict['sic4dvar'][reach]['integrator']['a0']
-                    sword_dataset['reaches']['discharge_models'][branch]['SIC4DVar']['n'][reach_ind]= \
-                        self.alg_dict['sic4dvar'][reach]['integrator']['n']
-                    sword_dataset['reaches']['discharge_models'][branch]['SIC4DVar']['sbQ_rel'][reach_ind]= \
-                        self.alg_dict['sic4dvar'][reach]['integrator']['sbQ_rel']
-                except Exception as e:
-                    print(reach, 'data not found for sword...', e)
-        except Exception as e:
-            print('outside...', e)
+        Files of unobserved reaches, and with fill_only all files, are
+        copies of fill value templates made once per call, with only their
+        non-fill values written. reaches are split into chunks, several per
+        worker to balance the load, and each chunk is sent with only its
+        slices of alg_dict and obs_dict. The files written and the
+        throughput of each worker are reported.
+        """
 
+        nts={None} if len(obs_dict) < len(reaches) else set()
+        if fill_only:
+            nts.update(obs['nt']+np.shape(obs['iDelete'])[1] for obs in obs_dict.values())
+
+        with tempfile.TemporaryDirectory() as template_dir:
+            templates=write_templates(template_dir,nts)
+
+            workers=min(self.workers,len(reaches))
+            if workers <= 1:
+                write_reach_files((self.out_dir,reaches,self.alg_dict,obs_dict,fill_only,templates))
+                return
+
+            nchunk=min(4*workers,len(reaches))
+            bounds=np.linspace(0,len(reaches),nchunk+1).astype(int)
+            payloads=[]
+            for start,stop in zip(bounds[:-1],bounds[1:]):
+                chunk=reaches[start:stop]
+                payloads.append((self.out_dir,chunk,
+                                 {alg: {reach: self.alg_dict[alg][reach] for reach in chunk} for alg in self.alg_dict},
+                                 {reach: obs_dict[reach] for reach in chunk if reach in obs_dict},
+                                 fill_only,templates))
+
+            stats={}
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for pid,files,seconds in executor.map(write_reach_files,payloads):
+                    total=stats.setdefault(pid,[0,0.])
+                    total[0]+=files
+                    total[1]+=seconds
+        for i,(files,seconds) in enumerate(stats.values()):
+            print(f'output worker {i}: {files} files in {seconds:.2f} s ({files/max(seconds,1e-9):.1f} files/s)')
 
+    def write_sword_output(self,branch):
+        """Write the Confluence estimates of the basin's FLPs to a SWORD delta file.
+
+        The delta file, <basin_id>_<branch>_sword_flps.nc in out_dir, holds
+        the SWORD_FLP_VARIABLES of each observed reach, masked where an
+        estimate is missing. The deltas of all basins are applied to a copy
+        of SWORD afterwards by merge_sword_deltas (run_MOI.py --mergesword),
+        so basin jobs never open SWORD for writing. With write_fill_only
+        sbQ_rel is written as nan, as it is blanked in the output files.
+        """
 
-        sword_dataset.close()
+        reaches=self.basin_dict['reach_ids']
+        fill_only=self.params_dict['write_fill_only']
+        out_file=self.out_dir / f"{self.basin_dict['basin_id']}_{branch}_sword_flps.nc"
+
+        out = Dataset(out_file, 'w', format="NETCDF4", diskless=True, persist=True)
+        out.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+        out.sword = self.basin_dict['sword']
+        out.branch = branch
+        out.createDimension("reach", len(reaches))
+        reach_id = out.createVariable("reach_id", "i8", ("reach",))
+        reach_id[:] = np.array([int(reach) for reach in reaches],dtype=np.int64)
+
+        for model,entries in SWORD_FLP_VARIABLES.items():
+            out.createGroup(model)
+            for name,alg,field in entries:
+                values=np.ma.masked_all(len(reaches))
+                for i,reach in enumerate(reaches):
+                    integrator=self.alg_dict[alg][reach].get('integrator',{})
+                    if fill_only and (field,'integrator') in FILL_ONLY_FIELDS:
+                        values[i]=np.nan
+                    elif field in integrator:
+                        values[i]=np.ma.ravel(np.ma.asarray(integrator[field],dtype=np.float64))[0]
+                out.createVariable(f"{model}/{name}", "f8", ("reach",), fill_value=FILL_VALUE)[:] = values
+        out.close()
@@ -0,0 +1,414 @@
+# Standard imports
+from collections.abc import MutableMapping
+
+# Third-party imports
+import numpy as np
+
+class ScalarColumn:
+    """One float64 or bool value per row, with presence and mask flags.
+
+    Attributes
+    ----------
+    values: numpy.ndarray
+        value of each row
+    present: numpy.ndarray
+        True for rows that hold a value
+    masked: numpy.ndarray
+        True for rows that hold np.ma.masked
+    """
+
+    def __init__(self, capacity, dtype):
+        self.values = np.zeros(capacity, dtype=dtype)
+        self.present = np.zeros(capacity, dtype=bool)
+        self.masked = np.zeros(capacity, dtype=bool)
+
+    def resize(self, capacity):
+        """Grow the column to capacity rows."""
+
+        for name in ('values', 'present', 'masked'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def has(self, row):
+        return self.present[row]
+
+    def get(self, row):
+        return np.ma.masked if self.masked[row] else self.values[row]
+
+    def set(self, row, value):
+        self.present[row] = True
+        self.masked[row] = value is np.ma.masked
+        if not self.masked[row]:
+            self.values[row] = value
+
+    def nbytes(self):
+        return self.values.nbytes + self.present.nbytes + self.masked.nbytes
+
+class RaggedColumn:
+    """Arrays of varying shape, one per row, stored in one flat buffer.
+
+    A row's array is a slice of the buffer reshaped to the row's shape, so
+    reading returns a view and writing into it (q[:] = nan) updates the
+    store. Assigning a row appends the new array to the buffer, so, as when
+    a dict value is rebound, arrays read earlier keep their old contents.
+    A view stays attached to the store until the buffer next grows, i.e.
+    until the next assignment to this column. The space of replaced arrays
+    is reclaimed by compact().
+
+    Attributes
+    ----------
+    buffer: numpy.ndarray
+        flat float64 storage of every row's array
+    used: int
+        number of elements of buffer in use
+    start: numpy.ndarray
+        offset of each row's array in buffer
+    shape: numpy.ndarray
+        shape of each row's array, (capacity, 2)
+    ndim: numpy.ndarray
+        number of dimensions of each row's array, -1 for rows without one
+    """
+
+    MAXDIM = 2
+
+    def __init__(self, capacity):
+        self.buffer = np.empty(0)
+        self.used = 0
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.shape = np.zeros((capacity, self.MAXDIM), dtype=np.int64)
+        self.ndim = np.full(capacity, -1, dtype=np.int8)
+
+    @property
+    def present(self):
+        return self.ndim >= 0
+
+    def resize(self, capacity):
+        """Grow the column to capacity rows."""
+
+        n = len(self.ndim)
+        start, shape, ndim = self.start, self.shape, self.ndim
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.shape = np.zeros((capacity, self.MAXDIM), dtype=np.int64)
+        self.ndim = np.full(capacity, -1, dtype=np.int8)
+        self.start[:n], self.shape[:n], self.ndim[:n] = start, shape, ndim
+
+    def has(self, row):
+        return self.ndim[row] >= 0
+
+    def get(self, row):
+        shape = tuple(self.shape[row, :self.ndim[row]])
+        start = self.start[row]
+        return self.buffer[start:start + int(np.prod(shape))].reshape(shape)
+
+    def set(self, row, value):
+        size = value.size
+        if self.used + size > len(self.buffer):
+            buffer = np.empty(max(2 * len(self.buffer), self.used + size, 64))
+            buffer[:self.used] = self.buffer[:self.used]
+            self.buffer = buffer
+        self.buffer[self.used:self.used + size] = value.ravel()
+        self.start[row] = self.used
+        self.shape[row, :value.ndim] = value.shape
+        self.ndim[row] = value.ndim
+        self.used += size
+
+    def compact(self):
+        """Copy the arrays of all rows into a buffer without unused space."""
+
+        rows = np.flatnonzero(self.present)
+        sizes = np.array([int(np.prod(self.shape[row, :self.ndim[row]])) for row in rows], dtype=np.int64)
+        buffer = np.empty(int(sizes.sum()))
+        starts = np.cumsum(sizes) - sizes
+        for row, start, size in zip(rows, starts, sizes):
+            buffer[start:start + size] = self.buffer[self.start[row]:self.start[row] + size]
+        self.buffer = buffer
+        self.used = len(buffer)
+        self.start[rows] = starts
+
+    def nbytes(self):
+        return self.buffer.nbytes + self.start.nbytes + self.shape.nbytes + self.ndim.nbytes
+
+class Table:
+    """Columnar storage of records that share field names, indexed by row.
+
+    Every field is kept in at most three columns, chosen by the value
+    assigned to it: a ScalarColumn for floats, a ScalarColumn for bools and
+    a RaggedColumn for float64 arrays of up to two dimensions. Dict values
+    are stored in a nested Table with the same rows. Anything else (ints,
+    strings, masked or integer arrays) is kept as is in a per-row dict, so
+    every value can be stored, and every value except Python floats and
+    bools, which come back as their numpy types, is returned as stored.
+
+    Attributes
+    ----------
+    capacity: int
+        number of rows allocated
+    fields: dict
+        field name -> {kind: column}, kind in 'float', 'bool', 'array'
+    nested: dict
+        field name -> (Table, present), for fields holding dicts
+    objects: dict
+        row -> {field: value} for values without a column
+    """
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.fields = {}
+        self.nested = {}
+        self.objects = {}
+
+    def resize(self, capacity):
+        """Grow every column to capacity rows."""
+
+        self.capacity = capacity
+        for columns in self.fields.values():
+            for column in columns.values():
+                column.resize(capacity)
+        for name, (table, present) in self.nested.items():
+            table.resize(capacity)
+            grown = np.zeros(capacity, dtype=bool)
+            grown[:len(present)] = present
+            self.nested[name] = (table, grown)
+
+    def kind(self, value):
+        """Return the column kind for value, or None to keep it as an object."""
+
+        if isinstance(value, (bool, np.bool_)):
+            return 'bool'
+        if value is np.ma.masked or isinstance(value, (float, np.floating)):
+            return 'float'
+        if type(value) is np.ndarray and value.dtype == np.float64 and value.ndim <= RaggedColumn.MAXDIM:
+            return 'array'
+        return None
+
+    def column(self, name, kind):
+        """Return the column of the given kind for field name, creating it."""
+
+        columns = self.fields.setdefault(name, {})
+        if kind not in columns:
+            if kind == 'array':
+                columns[kind] = RaggedColumn(self.capacity)
+            else:
+                columns[kind] = ScalarColumn(self.capacity, np.float64 if kind == 'float' else bool)
+        return columns[kind]
+
+    def get(self, row, name):
+        for column in self.fields.get(name, {}).values():
+            if column.has(row):
+                return column.get(row)
+        if name in self.nested and self.nested[name][1][row]:
+            return Record(self.nested[name][0], row)
+        try:
+            return self.objects[row][name]
+        except KeyError:
+            raise KeyError(name) from None
+
+    def set(self, row, name, value):
+        if isinstance(value, Record):
+            value = value.to_dict()
+        self.delete(row, name, missing_ok=True)
+        if isinstance(value, dict):
+            if name not in self.nested:
+                self.nested[name] = (Table(self.capacity), np.zeros(self.capacity, dtype=bool))
+            table, present = self.nested[name]
+            present[row] = True
+            for key, item in list(value.items()):
+                table.set(row, key, item)
+            return
+        kind = self.kind(value)
+        if kind is None:
+            self.objects.setdefault(row, {})[name] = value
+        else:
+            self.column(name, kind).set(row, value)
+
+    def delete(self, row, name, missing_ok=False):
+        found = False
+        for column in self.fields.get(name, {}).values():
+            if column.has(row):
+                found = True
+                if isinstance(column, RaggedColumn):
+                    column.ndim[row] = -1
+                else:
+                    column.present[row] = False
+        if name in self.nested and self.nested[name][1][row]:
+            found = True
+            table, present = self.nested[name]
+            present[row] = False
+            for key in list(table.keys(row)):
+                table.delete(row, key)
+        if name in self.objects.get(row, {}):
+            found = True
+            del self.objects[row][name]
+        if not found and not missing_ok:
+            raise KeyError(name)
+
+    def has(self, row, name):
+        if any(column.has(row) for column in self.fields.get(name, {}).values()):
+            return True
+        if name in self.nested and self.nested[name][1][row]:
+            return True
+        return name in self.objects.get(row, {})
+
+    def keys(self, row):
+        """Return the fields of a row, in the order the fields were created."""
+
+        names = [name for name in self.fields if self.has(row, name)]
+        names += [name for name in self.nested if self.nested[name][1][row] and name not in names]
+        names += [name for name in self.objects.get(row, {}) if name not in names]
+        return names
+
+    def compact(self):
+        """Reclaim the space of replaced arrays."""
+
+        for columns in self.fields.values():
+            if 'array' in columns:
+                columns['array'].compact()
+        for table, present in self.nested.values():
+            table.compact()
+
+    def nbytes(self):
+        """Return the bytes held by the column arrays (objects not included)."""
+
+        total = sum(column.nbytes() for columns in self.fields.values() for column in columns.values())
+        return total + sum(table.nbytes() + present.nbytes for table, present in self.nested.values())
+
+class Record(MutableMapping):
+    """Dict-compatible view of one row of a Table.
+
+    Records pickle as plain dicts, so they can be sent to worker processes.
+    """
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name):
+        return self.table.get(self.row, name)
+
+    def __setitem__(self, name, value):
+        self.table.set(self.row, name, value)
+
+    def __delitem__(self, name):
+        self.table.delete(self.row, name)
+
+    def __contains__(self, name):
+        return self.table.has(self.row, name)
+
+    def __iter__(self):
+        return iter(self.table.keys(self.row))
+
+    def __len__(self):
+        return len(self.table.keys(self.row))
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+    def to_dict(self):
+        """Return the row as a dict of copies, with nested records as dicts."""
+
+        result = {}
+        for name in self:
+            value = self[name]
+            if isinstance(value, Record):
+                value = value.to_dict()
+            elif isinstance(value, np.ndarray):
+                value = value.copy()
+            result[name] = value
+        return result
+
+class ReachStore(MutableMapping):
+    """Columnar replacement for one algorithm's alg_dict[alg].
+
+    Maps reach identifiers to Records, so alg_dict[alg][reach][field] and
+    alg_dict[alg][reach]['integrator'][field] read and write as with nested
+    dicts, while the values of all reaches live in a few numpy arrays: one
+    per scalar field and one flat buffer per time series field.
+
+    Attributes
+    ----------
+    index: dict
+        reach identifier -> row of the table
+    table: Table
+        the reach data
+
+    Methods
+    -------
+    from_dict(reaches)
+        build a store from a dict of reach dicts
+    to_dict()
+        return the store as a dict of reach dicts
+    compact()
+        reclaim the space of replaced arrays
+    nbytes()
+        return the bytes held by the columns
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.table = Table()
+
+    @classmethod
+    def from_dict(cls, reaches):
+        """Return a store holding a copy of a {reach: dict} mapping."""
+
+        store = cls()
+        store.table.resize(len(reaches))
+        for reach, data in reaches.items():
+            store[reach] = data
+        return store
+
+    def to_dict(self):
+        """Return the data as {reach: dict}, as read by Input."""
+
+        return {reach: self[reach].to_dict() for reach in self.index}
+
+    def __getitem__(self, reach):
+        return Record(self.table, self.index[reach])
+
+    def __setitem__(self, reach, data):
+        if reach not in self.index:
+            if len(self.index) == self.table.capacity:
+                self.table.resize(max(2 * self.table.capacity, 16))
+            self.index[reach] = len(self.index)
+        row = self.index[reach]
+        for name in list(self.table.keys(row)):
+            self.table.delete(row, name)
+        for name, value in list(data.items()):
+            self.table.set(row, name, value)
+
+    def __delitem__(self, reach):
+        raise TypeError('reaches cannot be removed from a ReachStore')
+
+    def __contains__(self, reach):
+        return reach in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def compact(self):
+        """Reclaim the space of replaced arrays."""
+
+        self.table.compact()
+
+    def nbytes(self):
+        """Return the bytes held by the columns (object values not included)."""
+
+        return self.table.nbytes()
+
+def to_reach_stores(alg_dict):
+    """Return alg_dict with each algorithm's reaches moved into a ReachStore."""
+
+    return {alg: ReachStore.from_dict(reaches) for alg, reaches in alg_dict.items()}
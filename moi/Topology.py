@@ -0,0 +1,83 @@
+# Third-party imports
+import numpy as np
+from scipy import sparse
+
+class Topology:
+    """Mass-balance topology of a basin, built once and reused by every solve.
+
+    Attributes
+    ----------
+    G: scipy.sparse.csr_array
+        m x n mass conservation matrix (+1 for upflows, -1 for downflows)
+    m: int
+        number of junctions (rows of G)
+    n: int
+        number of reaches (columns of G)
+    reach_index: dict
+        maps reach identifier (str) to column of G
+
+    Methods
+    -------
+    column(reach)
+        return the column of G for a reach identifier
+    """
+
+    def __init__(self, junctions, reach_ids_all):
+        """
+        Parameters
+        ----------
+        junctions: list
+            list of junction dicts with 'row_num', 'upflows' and 'downflows'
+        reach_ids_all: list
+            list of all reach identifiers in the basin, defining the columns of G
+        """
+
+        self.m = len(junctions)
+        self.n = len(reach_ids_all)
+        self.reach_index = {str(reach): i for i, reach in enumerate(reach_ids_all)}
+        self.G = self.__build_G(junctions)
+
+    def column(self, reach):
+        """Return the column of G for reach, or None if reach is not in the basin."""
+
+        return self.reach_index.get(str(reach))
+
+    def __build_G(self, junctions):
+        """Assemble G in COO form and convert to CSR.
+
+        Duplicate entries are not summed: as in the dense construction, a
+        reach that is listed twice in a junction keeps a single +/-1 and a
+        downflow entry overrides an upflow entry for the same reach.
+        """
+
+        entries = {}
+        for junction in junctions:
+            row = junction['row_num']
+            upcols = list()
+            for upflow in junction['upflows']:
+                kup = self.column(upflow)
+                if kup is None:
+                    print('did not find reach:', upflow)
+                    print('... in junction', junction)
+                else:
+                    upcols.append(kup)
+
+            downcols = list()
+            for downflow in junction['downflows']:
+                kdn = self.column(downflow)
+                if kdn is None:
+                    print('did not find reach', downflow)
+                    print('... in junction', junction)
+                else:
+                    downcols.append(kdn)
+
+            for upcol in upcols:
+                entries[(row, upcol)] = 1.
+            for downcol in downcols:
+                entries[(row, downcol)] = -1.
+
+        rows = np.fromiter((key[0] for key in entries), dtype=np.int64, count=len(entries))
+        cols = np.fromiter((key[1] for key in entries), dtype=np.int64, count=len(entries))
+        vals = np.fromiter(entries.values(), dtype=np.float64, count=len(entries))
+
+        return sparse.csr_array((vals, (rows, cols)), shape=(self.m, self.n))
@@ -12,9 +12,10 @@ import sys
 import numpy as np
 
 # Local imports
-from moi.Input import Input
+from moi.Input import IO_WORKERS_MAX, Input, basin_rows, observed_mask
 from moi.Integrate import Integrate
-from moi.Output import Output
+from moi.Output import Output, cpu_allocation, merge_sword_deltas
+from moi.ReachStore import to_reach_stores
 
 
 def get_basin_data(basin_json,index_to_run,tmp_dir,sos_bucket):
@@ -69,32 +70,28 @@ def get_basin_data(basin_json,index_to_run,tmp_dir,sos_bucket):
         }
 
 def get_all_sword_reach_in_basin(input,Verbose):
+    """Set reach_ids_all to every SWORD reach in the basin, and the observed mask.
+
+    basin_dict['observed'] is True for the reaches of reach_ids_all that are
+    in reach_ids, i.e. that are in the basin json file.
+    """
 
     # find all those that match the basin id 
-    BasinLevel=len(str(input.basin_dict['basin_id']))
+    rows=basin_rows(input.sword_dict['reach_id'],input.basin_dict['basin_id'])
 
     # basin_reach_list_all includes all reaches in SWORD that match the current basin id
-    basin_reach_list_all=[]
-    for reachid in input.sword_dict['reach_id']:
-        reachidstr=str(reachid)
-        if reachidstr[0:BasinLevel] == str(input.basin_dict['basin_id']):
-            basin_reach_list_all.append(reachidstr)
+    reach_ids=np.ma.getdata(input.sword_dict['reach_id'])[rows]
+    input.basin_dict['reach_ids_all']=[str(reachid) for reachid in reach_ids.tolist()]
 
     if Verbose:
-        print('There are a total of',len(basin_reach_list_all),'reaches in SWORD for this basin')
-
-    # create reach_ids_all list
-    nadd=0
-    input.basin_dict['reach_ids_all']=[]
-    for reachid in basin_reach_list_all:
-        if str(reachid) not in input.basin_dict['reach_ids']:
-            #if Verbose:
-            #   print('reachid',reachid,'is not in basin json file, but is in SWORD.')
-            nadd+=1
-        input.basin_dict['reach_ids_all'].append(str(reachid))
+        print('There are a total of',len(input.basin_dict['reach_ids_all']),'reaches in SWORD for this basin')
+
+    # reaches in SWORD that were not in basin json are unobserved
+    input.basin_dict.pop('observed',None)
+    input.basin_dict['observed']=observed_mask(input.basin_dict)
 
     #if Verbose:
-    #   print('Total of ',nadd, 'reaches in SWORD that were not in basin json')
+    #   print('Total of ',np.sum(~input.basin_dict['observed']), 'reaches in SWORD that were not in basin json')
 
     return input 
 
@@ -115,8 +112,7 @@ def apply_sword_patches(input,Verbose):
     for reachid in reaches_to_patch:
        
         try:
-            k=np.argwhere(input.sword_dict['reach_id'][:]==np.int64(reachid))
-            k=k[0,0]
+            k=input.sword_dict['reach_index'][int(reachid)]
         except: 
             if Verbose:
                 print(reachid , 'is not in this domain. not patching')
@@ -168,10 +164,20 @@ def set_moi_params():
         'norm': 0.5,              #default: 0.5
         'rho': 0.7,               #default: 0.7
         'niter': 4,               #default: 4
+        'niter_tol': 0.,          #default: 0. stop iterating once the relative change in the residuals is below this
         'method':'linear',        #default: 'linear'
+        'solver':'lowrank',       #default: 'lowrank'. 'dense' forms the full n x n covariance
+        'batch_algorithms': True, #default: True. solve all algorithms together (linear, lowrank only)
         'quit_before_flpe':False, #default: False
+        'reach_store': False,     #default: False. keep alg_dict in columnar ReachStores (moi/ReachStore.py)
         'apply_patches': False, #default: False
-        'write_fill_only': True #default: False
+        'write_fill_only': True, #default: False
+        'output_mode': 'reach',   #default: 'reach'. 'basin' writes one <basin_id>_basin_integrator.nc (see Output.read_basin_file)
+        'output_workers': None,   #default: None. processes writing reach files; None uses the CPUs allocated to the job
+        'write_sword_flps': False, #default: False. write the basin's FLPs to a SWORD delta file, applied by --mergesword
+        'io_workers': None,       #default: None. concurrent reach file reader processes; None uses the CPUs allocated to the job, at most IO_WORKERS_MAX; set with --ioworkers
+        'workers': 1,             #default: 1. processes fitting FLPs; set with --workers
+        'flp_gradients': False    #default: False. fit FLPs with analytic gradients rather than finite differences
     }
 
     return moi_params
@@ -205,6 +211,25 @@ def create_args():
                             type=str,
                             help='Name of the SoS bucket and key to download from',
                             default='')
+    arg_parser.add_argument('-w',
+                            '--workers',
+                            type=int,
+                            help='Number of processes used to fit flow law parameters',
+                            default=1)
+    arg_parser.add_argument('-r',
+                            '--ioworkers',
+                            type=int,
+                            help=f'Number of processes reading reach files; by default the CPUs allocated to the job, at most {IO_WORKERS_MAX}',
+                            default=None)
+    arg_parser.add_argument('-c',
+                            '--swordcache',
+                            type=str,
+                            help='Directory of per-basin SWORD subset files, reused across runs',
+                            default='')
+    arg_parser.add_argument('-m',
+                            '--mergesword',
+                            help='Apply the SWORD FLP delta files of all basins to SWORD copies, instead of running a basin',
+                            action='store_true')
     return arg_parser
 
 
@@ -219,6 +244,9 @@ def main():
     print('verbose flag: ', args.verbose)
     print('branch: ', args.branch)
     print('sosbucket: ', args.sosbucket)
+    print('sword cache: ', args.swordcache)
+    print('workers: ', args.workers)
+    print('io workers: ', args.ioworkers)
     
     try:
         print('index:',sys.argv[4])
@@ -255,6 +283,14 @@ def main():
         OUTPUT_DIR = basedir.joinpath("moi")
         TMP_DIR = basedir.joinpath("tmp")
 
+    if args.mergesword:
+        # during normal operations the SWORD copies go to the sword directory, offline to the output directory
+        dest_dir = INPUT_DIR / "sword" if OUTPUT_DIR == Path("/mnt/data/output") else OUTPUT_DIR
+        delta_files = sorted(OUTPUT_DIR.glob("*_sword_flps.nc"))
+        print('merging',len(delta_files),'SWORD FLP delta files into',dest_dir)
+        merge_sword_deltas(delta_files, INPUT_DIR / "sword", dest_dir)
+        return
+
     #basin data
     basin_json = INPUT_DIR.joinpath(args.basinjson) #turn this on for standard operations: AWS or running default basin file
     #basin_json = Path("/home/mdurand_umass_edu/dev-confluence/mnt/").joinpath(args.basinjson) #turn this on to use a local basin file
@@ -266,12 +302,21 @@ def main():
 
     print('setting moi params')
     params_dict=set_moi_params()
+    params_dict['workers']=args.workers
+    if args.ioworkers:
+        params_dict['io_workers']=args.ioworkers
+    io_workers=params_dict['io_workers'] or min(IO_WORKERS_MAX,cpu_allocation())
 
     if args.sosbucket:
         sos_dir = TMP_DIR
     else:
         sos_dir = INPUT_DIR.joinpath("sos")
-    input = Input(FLPE_DIR, sos_dir, INPUT_DIR / "swot", INPUT_DIR / "sword", basin_data,Branch,Verbose)
+    if args.swordcache:
+        sword_cache_dir = Path(args.swordcache)
+    else:
+        sword_cache_dir = None
+    input = Input(FLPE_DIR, sos_dir, INPUT_DIR / "swot", INPUT_DIR / "sword", basin_data,Branch,Verbose,sword_cache_dir,
+                  io_workers)
     print('Exctracting sword...')
     input.extract_sword()
 
@@ -287,14 +332,18 @@ def main():
     input.extract_sos()
     print('extracting alg')
     input.extract_alg()
+    if params_dict['reach_store']:
+        input.alg_dict=to_reach_stores(input.alg_dict)
     
     print('integrating')
-    integrate = Integrate(input.alg_dict, input.basin_dict, input.sos_dict, input.sword_dict,input.obs_dict,params_dict,Branch,Verbose)
+    integrate = Integrate(input.alg_dict, input.basin_dict, input.sos_dict, input.sword_dict,input.obs_dict,params_dict,Branch,Verbose,
+                          input.obs_buffer)
     integrate.integrate()
 
     output = Output(input.basin_dict, OUTPUT_DIR, integrate.integ_dict, integrate.alg_dict, integrate.obs_dict, input.sword_dir,params_dict)
     output.write_output()
-    # output.write_sword_output(Branch)
+    if params_dict['write_sword_flps']:
+        output.write_sword_output(Branch)
 
 if __name__ == "__main__":
     from datetime import datetime
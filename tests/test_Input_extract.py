@@ -0,0 +1,396 @@
+# Standard imports
+import contextlib
+import io
+import os
+from pathlib import Path
+import tempfile
+from types import SimpleNamespace
+import unittest
+
+# Third-party imports
+from netCDF4 import Dataset, chartostring
+import numpy as np
+
+# Local imports
+from moi.Input import FLPE_FILES, FLPE_MISSING, SWORD_FIELDS, SWOT_FIELDS, Input, basin_rows, observed_mask
+from moi.ObsBuffer import ObsBuffer
+from run_MOI import get_all_sword_reach_in_basin
+
+BASIN = '7423'
+AGENCIES = ('usgs', 'wsc')
+
+def write_sos(sos_file, reach_ids, sources, gages, nt=5, seed=0):
+    """Write a SoS file with the model and gage variables read by extract_sos.
+
+    sources is the overwritten_source of each reach ('' if not overwritten)
+    and gages maps each agency to the (reach_id, CAL) of its gages.
+    """
+
+    rng = np.random.default_rng(seed)
+    sos = Dataset(sos_file, 'w', format="NETCDF4")
+    sos.Gage_Agency = ';'.join(AGENCIES)
+    reaches = sos.createGroup('reaches')
+    reaches.createDimension('num_reaches', len(reach_ids))
+    reaches.createVariable('reach_id', 'i8', ('num_reaches',))[:] = reach_ids
+    model = sos.createGroup('model')
+    model.createDimension('num_reaches', len(reach_ids))
+    model.createDimension('probability', 20)
+    model.createDimension('nchars', 16)
+    model.createVariable('mean_q', 'f8', ('num_reaches',))[:] = rng.uniform(1., 100., len(reach_ids))
+    model.createVariable('flow_duration_q', 'f8', ('num_reaches', 'probability'))[:] = \
+        rng.uniform(1., 100., (len(reach_ids), 20))
+    model.createVariable('overwritten_indexes', 'i4', ('num_reaches',))[:] = [int(bool(s)) for s in sources]
+    model.createVariable('overwritten_source', 'S1', ('num_reaches', 'nchars'))[:] = \
+        np.array([list(source.ljust(16, '\0')) for source in sources], dtype='S1')
+    for agency in AGENCIES:
+        group = sos.createGroup(agency)
+        ngages = len(gages.get(agency, []))
+        group.createDimension(f'num_{agency}_reaches', ngages)
+        group.createDimension('nt', nt)
+        dims = (f'num_{agency}_reaches',)
+        group.createVariable(f'{agency}_reach_id', 'i8', dims)[:] = [reach for reach, cal in gages.get(agency, [])]
+        group.createVariable('CAL', 'i4', dims)[:] = [cal for reach, cal in gages.get(agency, [])]
+        group.createVariable(f'{agency}_qt', 'f8', dims + ('nt',))[:] = rng.uniform(0., 1e5, (ngages, nt))
+        group.createVariable(f'{agency}_q', 'f8', dims + ('nt',))[:] = rng.uniform(1., 100., (ngages, nt))
+    sos.close()
+
+def write_swot(swot_dir, reach, nt, seed=0):
+    """Write the SWOT file of a reach, with fill values, bad flags and low slopes."""
+
+    rng = np.random.default_rng(seed)
+    swot = Dataset(swot_dir / f"{reach}_SWOT.nc", 'w', format="NETCDF4")
+    swot.createDimension('nt', nt)
+    group = swot.createGroup('reach')
+    for key, field in SWOT_FIELDS.items():
+        if key in ('reach_q', 'xovr_cal_q'):
+            values = rng.choice([0, 1, 2], nt, p=[0.7, 0.2, 0.1]).astype(np.float64)
+        elif key == 'S':
+            values = rng.uniform(0., 1e-4, nt)
+        else:
+            values = rng.uniform(1., 100., nt)
+        variable = group.createVariable(field, 'f8', ('nt',), fill_value=-999999999999.)
+        variable[:] = np.ma.masked_array(values, mask=rng.uniform(size=nt) < 0.1)
+    swot.close()
+
+def write_flpe(alg_dir, alg, reach, nt=6, seed=0):
+    """Write the FLPE result file of alg for a reach, in the layout read by Input."""
+
+    rng = np.random.default_rng(seed)
+    name = FLPE_FILES[alg][0]
+    (alg_dir / name).mkdir(exist_ok=True)
+    flpe = Dataset(alg_dir / name / f"{reach}_{name}.nc", 'w', format="NETCDF4")
+    flpe.createDimension('nt', nt)
+    if alg == 'hivdi':
+        group = flpe.createGroup('reach')
+        group.createVariable('Q', 'f8', ('nt',))[:] = rng.uniform(1., 100., nt)
+        for variable in ('alpha', 'beta', 'A0'):
+            group.createVariable(variable, 'f8')[:] = rng.uniform(1., 100.)
+    elif alg == 'momma':
+        flpe.createVariable('Q', 'f8', ('nt',))[:] = rng.uniform(1., 100., nt)
+        flpe.createVariable('slope', 'f8', ('nt',))[:] = rng.uniform(1e-5, 1e-3, nt)
+        for variable in ('zero_flow_stage', 'bankfull_stage'):
+            flpe.createVariable(variable, 'f8')[:] = rng.uniform(1., 100.)
+    elif alg == 'sad':
+        flpe.createVariable('Qa', 'f8', ('nt',))[:] = rng.uniform(1., 100., nt)
+        for variable in ('n', 'A0'):
+            flpe.createVariable(variable, 'f8')[:] = rng.uniform(1., 100.)
+    flpe.close()
+
+def write_sword(sword_file, downstream, seed=0):
+    """Write a SWORD file of the reaches in downstream, in a shuffled order.
+
+    downstream maps each reach id (int) to the id of the reach it drains to,
+    or 0 for an outlet; rch_id_up is filled in from it.
+    """
+
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(list(downstream))
+    upstream = {reach: [up for up, down in downstream.items() if down == reach] for reach in ids}
+    rch_id_up = np.zeros((4, len(ids)), dtype=np.int64)
+    rch_id_dn = np.zeros((4, len(ids)), dtype=np.int64)
+    for k, reach in enumerate(ids):
+        rch_id_up[:len(upstream[reach]), k] = upstream[reach]
+        rch_id_dn[0, k] = downstream[reach]
+
+    sword = Dataset(sword_file, 'w', format="NETCDF4")
+    reaches = sword.createGroup('reaches')
+    reaches.createDimension('orbits', 75)
+    reaches.createDimension('num_domains', 4)
+    reaches.createDimension('num_reaches', len(ids))
+    reaches.createVariable('reach_id', 'i8', ('num_reaches',))[:] = ids
+    reaches.createVariable('facc', 'f8', ('num_reaches',))[:] = rng.uniform(1., 1e4, len(ids))
+    reaches.createVariable('n_rch_up', 'i4', ('num_reaches',))[:] = [len(upstream[reach]) for reach in ids]
+    reaches.createVariable('n_rch_down', 'i4', ('num_reaches',))[:] = [int(downstream[reach] > 0) for reach in ids]
+    reaches.createVariable('rch_id_up', 'i8', ('num_domains', 'num_reaches'))[:] = rch_id_up
+    reaches.createVariable('rch_id_dn', 'i8', ('num_domains', 'num_reaches'))[:] = rch_id_dn
+    reaches.createVariable('swot_obs', 'i4', ('num_reaches',))[:] = rng.integers(0, 3, len(ids))
+    reaches.createVariable('swot_orbits', 'i8', ('orbits', 'num_reaches'))[:] = rng.integers(0, 600, (75, len(ids)))
+    sword.close()
+
+def baseline_sos(sos_file, reaches, branch):
+    """Return sos_dict as built by the original extract_sos, one reach at a time."""
+
+    sos = Dataset(sos_file)
+    sos_dict = {}
+    for reach in reaches:
+        sos_dict[reach] = {}
+        k = np.argwhere(sos['reaches/reach_id'][:] == np.int64(reach))
+        if len(k) == 0:
+            continue
+        k = k[0, 0]
+        sos_dict[reach]['Qbar'] = sos['model/mean_q'][k]
+        sos_dict[reach]['q33'] = sos['model/flow_duration_q'][k, 13]
+        sos_dict[reach]['cal_status'] = -1
+        if branch != 'constrained':
+            sos_dict[reach]['overwritten_indices'] = np.nan
+            continue
+        sos_dict[reach]['overwritten_indices'] = sos['model/overwritten_indexes'][k]
+        source = str(chartostring(sos['model/overwritten_source'][k, :])).strip('x')
+        sos_dict[reach]['overwritten_source'] = source
+        if sos_dict[reach]['overwritten_indices'] != 1 or source == 'grdc':
+            continue
+        igage = np.nan
+        for i, gage_reach in enumerate(sos[source][source + '_reach_id'][:]):
+            if str(gage_reach) == reach:
+                igage = i
+        if np.isnan(igage):
+            continue
+        sos_dict[reach]['cal_status'] = sos[source]['CAL'][igage]
+        if sos_dict[reach]['cal_status'] == 1:
+            sos_dict[reach]['gage'] = {'source': source, 't': sos[source][source + '_qt'][igage, :],
+                                       'Q': sos[source][source + '_q'][igage, :]}
+    sos.close()
+    return sos_dict
+
+def assert_nested_equal(test, actual, expected, path=()):
+    """Assert two nested dicts of scalars, strings and arrays are equal."""
+
+    if isinstance(expected, dict):
+        test.assertEqual(sorted(actual), sorted(expected), path)
+        for key in expected:
+            assert_nested_equal(test, actual[key], expected[key], path + (key,))
+    elif isinstance(expected, str):
+        test.assertEqual(actual, expected, path)
+    else:
+        np.testing.assert_array_equal(np.ma.filled(actual, np.nan), np.ma.filled(expected, np.nan), str(path))
+
+class TestInputExtract(unittest.TestCase):
+    """Tests the Input extract methods on synthetic files."""
+
+    def test_basin_rows(self):
+        """Tests basin_rows against the string prefix rule for 1 to 6 digit basins."""
+
+        rng = np.random.default_rng(0)
+        ids = np.concatenate((rng.integers(10**10, 10**11, 2000),
+                              [10**10, 10**11 - 1, 10**10 - 1, 10**9, 74230900011, 74239999999, 74240000000,
+                               99999999999, 7423090001, 742309000111]))
+        basins = [1, 7, 9, 10, 74, 99, 100, 742, 999, 1000, 7423, 9999, 10000, 74230, 99999, 100000,
+                  742309, 999999]
+        basins += [int(str(reach)[:level]) for reach in ids[:50] for level in range(1, 7)]
+        sword_ids = np.ma.masked_array(ids, mask=False)
+        for basin in basins:
+            expected = [k for k, reach in enumerate(ids) if str(reach)[:len(str(basin))] == str(basin)]
+            np.testing.assert_array_equal(basin_rows(sword_ids, basin), expected, str(basin))
+            np.testing.assert_array_equal(basin_rows(sword_ids, str(basin)), expected, str(basin))
+
+        # reach_ids_all and observed of a basin, as set by run_MOI
+        reach_ids = [str(reach) for reach in ids[basin_rows(sword_ids, 7423)]]
+        basin_dict = {'basin_id': '7423', 'reach_ids': reach_ids[::3] + ['74230000000']}
+        input = SimpleNamespace(sword_dict={'reach_id': sword_ids}, basin_dict=basin_dict)
+        get_all_sword_reach_in_basin(input, False)
+        self.assertEqual(basin_dict['reach_ids_all'], reach_ids)
+        np.testing.assert_array_equal(basin_dict['observed'],
+                                      [reach in basin_dict['reach_ids'] for reach in reach_ids])
+
+    def test_observed_mask(self):
+        """Tests observed_mask against list membership, with and without a stored mask."""
+
+        reach_ids_all = [str(74230900011 + 10 * i) for i in range(20)]
+        reach_ids = reach_ids_all[1::3] + reach_ids_all[::7] + ['74230900999']
+        expected = [reach in reach_ids for reach in reach_ids_all]
+        basin_dict = {'reach_ids': reach_ids, 'reach_ids_all': reach_ids_all}
+        np.testing.assert_array_equal(observed_mask(basin_dict), expected)
+        np.testing.assert_array_equal(observed_mask(dict(basin_dict, reach_ids_all=[])), np.zeros(0, dtype=bool))
+        np.testing.assert_array_equal(observed_mask(dict(basin_dict, reach_ids=[])), np.zeros(20, dtype=bool))
+
+        # a stored mask is reused, unless it belongs to another reach_ids_all
+        stored = np.arange(20) % 2 == 0
+        self.assertIs(observed_mask(dict(basin_dict, observed=stored)), stored)
+        np.testing.assert_array_equal(observed_mask(dict(basin_dict, observed=stored[:5])), expected)
+
+    def test_extract_sos(self):
+        """Tests extract_sos matches the per-reach baseline on both branches."""
+
+        ids = [74230900011 + 10 * i for i in range(10)]
+        # a USGS calibration gage, a WSC calibration gage, a validation gage,
+        # a GRDC reach, an overwritten reach without a gage, a repeated gage
+        # and a gage whose time series are read for two reaches
+        sources = ['', 'usgs', 'wsc', 'usgs', 'grdc', 'usgs', 'wsc', 'usgs', '', 'usgs']
+        gages = {'usgs': [(ids[9], 1), (ids[1], 1), (ids[3], 0), (ids[7], 0), (ids[7], 1)],
+                 'wsc': [(ids[6], 1), (ids[2], 1)]}
+        # the last basin reach is not in SoS
+        reaches = [str(reach) for reach in ids] + ['74230900999']
+
+        with tempfile.TemporaryDirectory() as sos_dir:
+            sos_dir = Path(sos_dir)
+            write_sos(sos_dir / 'na_sos.nc', ids, sources, gages)
+            for branch in ('constrained', 'unconstrained'):
+                basin_dict = {'basin_id': BASIN, 'sos': 'na_sos.nc', 'reach_ids': reaches, 'reach_ids_all': reaches}
+                input = Input(None, sos_dir, None, None, basin_dict, branch, False)
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    input.extract_sos()
+                self.assertEqual(stdout.getvalue(), 'reach data not found for 74230900999\n')
+
+                expected = baseline_sos(sos_dir / 'na_sos.nc', reaches, branch)
+                assert_nested_equal(self, input.sos_dict, expected)
+                self.assertEqual(input.sos_dict['74230900999'], {})
+                if branch == 'constrained':
+                    gaged = [reach for reach in reaches if 'gage' in input.sos_dict[reach]]
+                    self.assertEqual(gaged, [reaches[i] for i in (1, 2, 6, 7, 9)])
+                    self.assertEqual(input.sos_dict[reaches[3]]['cal_status'], 0)
+                    self.assertEqual(input.sos_dict[reaches[5]]['cal_status'], -1)
+                else:
+                    self.assertTrue(all('gage' not in data for data in input.sos_dict.values()))
+
+    def test_extract_sword(self):
+        """Tests the SWORD subset, its cache and the reaches three links downstream."""
+
+        # a chain of basin reaches fed by one reach of another basin, whose
+        # outlet drains through two dams to a reach three links downstream
+        basin = [74230900011 + 10 * i for i in range(5)]
+        downstream = dict(zip(basin, basin[1:] + [74240000014]))
+        downstream.update({74220000011: basin[0], 74240000014: 74240000024, 74240000024: 74240000031,
+                           74240000031: 74240000041, 74240000041: 0, 75000000011: 0, 74320000011: 0})
+        subset = basin + [74220000011, 74240000014, 74240000024, 74240000031]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            write_sword(tmp / 'na_sword.nc', downstream)
+            full = Input(None, None, None, tmp, {'sword': 'na_sword.nc'}, 'unconstrained', False)
+            full.extract_sword()
+
+            def extract(verbose=True):
+                basin_dict = {'basin_id': BASIN, 'sword': 'na_sword.nc'}
+                input = Input(None, None, None, tmp, basin_dict, 'unconstrained', verbose, tmp / 'cache')
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    input.extract_sword()
+                return input.sword_dict, stdout.getvalue()
+
+            sword_dict, stdout = extract()
+            self.assertNotIn('cache', stdout)
+            self.assertEqual(sorted(np.ma.getdata(sword_dict['reach_id']).tolist()), sorted(subset))
+            self.assertEqual(sword_dict['num_reaches'], len(subset))
+            rows = [full.sword_dict['reach_index'][reach] for reach in sword_dict['reach_id'].tolist()]
+            for field in SWORD_FIELDS:
+                np.testing.assert_array_equal(sword_dict[field], full.sword_dict[field][..., rows])
+
+            # dam removal follows rch_id_dn three links from the basin outlet
+            reach = basin[-1]
+            for hop in range(3):
+                reach = int(sword_dict['rch_id_dn'][0, sword_dict['reach_index'][reach]])
+            self.assertEqual(reach, 74240000031)
+            self.assertIn(reach, sword_dict['reach_index'])
+
+            cached, stdout = extract()
+            self.assertIn('reading SWORD subset from cache', stdout)
+            for field in SWORD_FIELDS + ['orbits', 'num_domains', 'num_reaches', 'reach_index']:
+                np.testing.assert_array_equal(cached[field], sword_dict[field])
+
+            # a SWORD file replaced under the same name invalidates the cache
+            write_sword(tmp / 'na_sword.nc', downstream, seed=1)
+            stat = os.stat(tmp / 'na_sword.nc')
+            os.utime(tmp / 'na_sword.nc', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            rebuilt, stdout = extract()
+            self.assertIn('out of date', stdout)
+            self.assertNotIn('reading SWORD subset from cache', stdout)
+            self.assertFalse(np.array_equal(rebuilt['facc'], sword_dict['facc']))
+            cached, stdout = extract()
+            self.assertIn('reading SWORD subset from cache', stdout)
+            for field in SWORD_FIELDS:
+                np.testing.assert_array_equal(cached[field], rebuilt[field])
+
+    def test_extract_swot(self):
+        """Tests SWOT files read in a pool give the same obs_dict and ObsBuffer as read serially."""
+
+        reaches = [str(74230900011 + 10 * i) for i in range(12)]
+        with tempfile.TemporaryDirectory() as swot_dir:
+            swot_dir = Path(swot_dir)
+            # the last reach has no SWOT file
+            for seed, reach in enumerate(reaches[:-1]):
+                write_swot(swot_dir, reach, 20 + seed, seed)
+            inputs = []
+            for workers in (1, 3):
+                basin_dict = {'basin_id': BASIN, 'reach_ids': reaches}
+                input = Input(None, None, swot_dir, None, basin_dict, 'unconstrained', False, workers=workers)
+                input.extract_swot()
+                inputs.append(input)
+
+            serial, pooled = inputs
+            self.assertEqual(list(serial.obs_dict), reaches[:-1])
+            assert_nested_equal(self, pooled.obs_dict, serial.obs_dict)
+            self.assertEqual(pooled.obs_buffer.reaches, serial.obs_buffer.reaches)
+            np.testing.assert_array_equal(pooled.obs_buffer.offsets, serial.obs_buffer.offsets)
+            assert_nested_equal(self, pooled.obs_buffer.values, serial.obs_buffer.values)
+
+            for seed, reach in enumerate(reaches[:-1]):
+                swot = Dataset(swot_dir / f"{reach}_SWOT.nc")
+                raw = {key: swot['reach'][field][:].filled(np.nan) for key, field in SWOT_FIELDS.items()}
+                swot.close()
+                delete = (np.isnan(raw['h']) | np.isnan(raw['w']) | np.isnan(raw['S']) | np.isnan(raw['dA']) |
+                          (raw['reach_q'] > 1) | (raw['xovr_cal_q'] > 1))
+                obs = pooled.obs_dict[reach]
+                np.testing.assert_array_equal(obs['iDelete'][0], np.flatnonzero(delete))
+                self.assertEqual(obs['nt'], 20 + seed - delete.sum())
+                np.testing.assert_array_equal(obs['S'], np.maximum(raw['S'][~delete], 1.7e-5))
+                np.testing.assert_array_equal(obs['h'], raw['h'][~delete])
+                for key in ObsBuffer.FIELDS:
+                    self.assertIs(obs[key].base, pooled.obs_buffer[key])
+            self.assertTrue(np.any(np.concatenate([obs['iDelete'][0] for obs in pooled.obs_dict.values()])))
+            self.assertEqual(pooled.obs_buffer['S'].min(), 1.7e-5)
+
+    def test_extract_alg(self):
+        """Tests reaches with missing FLPE files fall back to the SoS prior, serially and in a pool."""
+
+        ids = [74230900011 + 10 * i for i in range(5)]
+        reaches = [str(reach) for reach in ids]
+        # reach 0 has SAD and MOMMA results, reach 1 HiVDI, reach 2 none, reach 3 all
+        # three and reach 4 is unobserved
+        files = {reaches[0]: ['sad', 'momma'], reaches[1]: ['hivdi'], reaches[3]: ['hivdi', 'momma', 'sad']}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            write_sos(tmp / 'na_sos.nc', ids, [''] * len(ids), {})
+            for seed, (reach, algs) in enumerate(files.items()):
+                for alg in algs:
+                    write_flpe(tmp, alg, reach, seed=seed)
+            alg_dicts = []
+            for workers in (1, 2):
+                basin_dict = {'basin_id': BASIN, 'sos': 'na_sos.nc', 'reach_ids': reaches[:4],
+                              'reach_ids_all': reaches}
+                input = Input(tmp, tmp, None, None, basin_dict, 'unconstrained', False, workers=workers)
+                input.extract_sos()
+                input.extract_alg()
+                alg_dicts.append(input.alg_dict)
+            assert_nested_equal(self, alg_dicts[1], alg_dicts[0])
+
+        alg_dict, sos_dict = alg_dicts[0], input.sos_dict
+        for alg in FLPE_FILES:
+            self.assertEqual(list(alg_dict[alg]), reaches)
+            for reach in reaches[:4]:
+                data = alg_dict[alg][reach]
+                if alg in files.get(reach, []):
+                    self.assertTrue(data['s1-flpe-exists'], (alg, reach))
+                    self.assertNotIn('q33', data)
+                    self.assertFalse(np.any(np.isnan(data['q'])))
+                else:
+                    self.assertFalse(data['s1-flpe-exists'], (alg, reach))
+                    self.assertEqual(data['qbar'], sos_dict[reach]['Qbar'])
+                    self.assertEqual(data['q33'], sos_dict[reach]['q33'])
+                    for field in FLPE_MISSING[alg]:
+                        self.assertTrue(np.isnan(data[field]), (alg, reach, field))
+            self.assertEqual(alg_dict[alg][reaches[4]]['s1-flpe-exists'], False)
+            self.assertTrue(np.isnan(alg_dict[alg][reaches[4]]['qbar']))
+        self.assertEqual(alg_dict['momma'][reaches[0]]['Save'].shape, ())
+
+if __name__ == '__main__':
+    unittest.main()
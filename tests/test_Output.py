@@ -0,0 +1,231 @@
+# Standard imports
+from pathlib import Path
+import tempfile
+import unittest
+
+# Third-party imports
+from netCDF4 import Dataset
+import numpy as np
+
+# Local imports
+from moi.Output import (FILL_VALUE, OUTPUT_VARIABLES, SWORD_FLP_VARIABLES, UNOBSERVED_VARIABLES, Output, cpu_allocation,
+                        merge_sword_deltas, read_basin_file, reach_outputs, write_basin_file, write_integrator_file)
+
+REACH = '74230900151'
+
+def integrator_results(nt, seed=0):
+    """Return an alg_dict with integrator results for one reach."""
+
+    rng = np.random.default_rng(seed)
+    alg_dict = {}
+    for alg, entries in OUTPUT_VARIABLES.items():
+        integrator = {field: rng.uniform(1., 100.) for name, field, source in entries if source == 'integrator'}
+        integrator['q'] = rng.uniform(1., 100., (1, nt))
+        alg_dict[alg] = {REACH: {'s1-flpe-exists': True, 'qbar': rng.uniform(1., 100.), 'integrator': integrator}}
+    return alg_dict
+
+def basin_results(nreach):
+    """Return basin_dict, alg_dict and obs_dict of a basin with one unobserved reach."""
+
+    reaches = [str(74230900011 + 10 * i) for i in range(nreach)]
+    alg_dict = {alg: {} for alg in OUTPUT_VARIABLES}
+    obs_dict = {}
+    for i, reach in enumerate(reaches):
+        for alg, data in integrator_results(3 + i % 4, i).items():
+            alg_dict[alg][reach] = data[REACH]
+        obs_dict[reach] = {'nt': 3 + i % 4, 'iDelete': (np.array([i % 2]),)}
+    del obs_dict[reaches[-1]]
+    basin_dict = {'basin_id': '7423', 'reach_ids': reaches[:-1], 'reach_ids_all': reaches}
+    return basin_dict, alg_dict, obs_dict
+
+def read_files(out_dir):
+    """Return the variables of every file in out_dir, without production_date."""
+
+    contents = {}
+    for out_file in sorted(Path(out_dir).iterdir()):
+        out = Dataset(out_file)
+        contents[out_file.name] = {f"{alg}/{name}": out[alg][name][...].tolist()
+                                   for alg in out.groups for name in out[alg].variables}
+        out.close()
+    return contents
+
+def write_sword(sword_file, reach_ids):
+    """Write a SWORD file with the discharge model variables written back by MOI."""
+
+    sword = Dataset(sword_file, 'w', format="NETCDF4")
+    reaches = sword.createGroup('reaches')
+    reaches.createDimension('num_reaches', len(reach_ids))
+    reaches.createVariable('reach_id', 'i8', ('num_reaches',))[:] = reach_ids
+    for branch in ('constrained', 'unconstrained'):
+        for model, entries in SWORD_FLP_VARIABLES.items():
+            group = reaches.createGroup(f'discharge_models/{branch}/{model}')
+            for name, alg, field in entries:
+                group.createVariable(name, 'f8', ('num_reaches',), fill_value=-9999.)[:] = -9999.
+    sword.close()
+
+class TestOutput(unittest.TestCase):
+    """Tests Output functions."""
+
+    def test_reach_outputs(self):
+        """Tests removed observations and nan become fill values."""
+
+        alg_dict = integrator_results(6)
+        alg_dict['sad'][REACH]['integrator']['q'][0, 1] = np.nan
+        alg_dict['hivdi'][REACH]['integrator']['beta'] = np.nan
+        alg_dict['momma'][REACH]['integrator']['B'] = np.ma.masked
+        del alg_dict['neobam'][REACH]['qbar']
+        obs = {'nt': 6, 'iDelete': (np.array([0, 3]),)}
+
+        nt, variables = reach_outputs(alg_dict, REACH, obs)
+        self.assertEqual(nt, 8)
+        for alg, entries in OUTPUT_VARIABLES.items():
+            self.assertEqual([name for name, value in variables[alg]], [entry[0] for entry in entries])
+            q = dict(variables[alg])['q']
+            expected = np.insert(alg_dict[alg][REACH]['integrator']['q'], [0, 2], FILL_VALUE, 1)[0]
+            np.testing.assert_array_equal(q, np.nan_to_num(expected, nan=FILL_VALUE))
+        self.assertEqual(dict(variables['sad'])['q'][2], FILL_VALUE)
+        self.assertEqual(dict(variables['hivdi'])['beta'], FILL_VALUE)
+        self.assertEqual(dict(variables['momma'])['B'], FILL_VALUE)
+        self.assertEqual(dict(variables['neobam'])['qbar_reachScale'], FILL_VALUE)
+        self.assertEqual(dict(variables['metroman'])['Abar'], alg_dict['metroman'][REACH]['integrator']['a0'])
+
+        nt, variables = reach_outputs(alg_dict, REACH, obs, fill_only=True)
+        for alg, entries in variables.items():
+            values = dict(entries)
+            np.testing.assert_array_equal(values['q'], FILL_VALUE)
+            for name in ('qbar_reachScale', 'qbar_basinScale', 'sbQ_rel'):
+                self.assertEqual(values[name], FILL_VALUE)
+        self.assertEqual(dict(variables['sad'])['a0'], alg_dict['sad'][REACH]['integrator']['a0'])
+
+        nt, variables = reach_outputs(alg_dict, REACH)
+        self.assertIsNone(nt)
+        for alg in OUTPUT_VARIABLES:
+            self.assertEqual([name for name, value in variables[alg]], UNOBSERVED_VARIABLES)
+
+    def test_write_integrator_file(self):
+        """Tests the file layout, fill values and values written."""
+
+        alg_dict = integrator_results(5)
+        obs = {'nt': 5, 'iDelete': (np.array([2]),)}
+        nt, variables = reach_outputs(alg_dict, REACH, obs)
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_file = Path(out_dir) / f"{REACH}_integrator.nc"
+            write_integrator_file(out_file, nt, variables)
+            out = Dataset(out_file)
+            self.assertEqual(len(out.dimensions['nt']), 6)
+            np.testing.assert_array_equal(out['nt'][:], np.arange(6))
+            self.assertEqual(list(out.groups), list(OUTPUT_VARIABLES))
+            for alg, entries in variables.items():
+                self.assertEqual(list(out[alg].variables), [name for name, value in entries])
+                for name, value in entries:
+                    self.assertEqual(out[alg][name]._FillValue, FILL_VALUE)
+                    np.testing.assert_array_equal(out[alg][name][...].filled(FILL_VALUE), value)
+            self.assertTrue(out['neobam']['q'][:].mask[2])
+            out.close()
+
+    def test_basin_file(self):
+        """Tests the basin file reads back as the reach files."""
+
+        reaches = [REACH, '74230900161', '74230900171', '74230900181']
+        alg_dict = integrator_results(7)
+        for seed, reach in enumerate(reaches[1:], 1):
+            for alg, data in integrator_results(4 if seed < 3 else 0, seed).items():
+                alg_dict[alg][reach] = data[REACH]
+        # the last reach is observed, but without time steps
+        obs = [{'nt': 7, 'iDelete': (np.array([1]),)}, None, {'nt': 4, 'iDelete': (np.array([], dtype=np.int64),)},
+               {'nt': 0, 'iDelete': (np.array([], dtype=np.int64),)}]
+        outputs = [reach_outputs(alg_dict, reach, reach_obs) for reach, reach_obs in zip(reaches, obs)]
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            basin_file = Path(out_dir) / "7423_basin_integrator.nc"
+            write_basin_file(basin_file, '7423', reaches, outputs)
+            actual = read_basin_file(basin_file)
+            self.assertEqual(list(actual), reaches)
+            self.assertEqual([nt for nt, variables in outputs], [8, None, 4, 0])
+            self.assertEqual(list(actual[reaches[3]]['sad']), [entry[0] for entry in OUTPUT_VARIABLES['sad']])
+            for reach, (nt, variables) in zip(reaches, outputs):
+                out_file = Path(out_dir) / f"{reach}_integrator.nc"
+                write_integrator_file(out_file, nt, variables)
+                out = Dataset(out_file)
+                for alg in OUTPUT_VARIABLES:
+                    self.assertEqual(list(actual[reach][alg]), list(out[alg].variables))
+                    for name, value in actual[reach][alg].items():
+                        expected = out[alg][name][...]
+                        self.assertEqual(np.shape(value), expected.shape)
+                        np.testing.assert_array_equal(np.ma.getmaskarray(value), np.ma.getmaskarray(expected))
+                        np.testing.assert_array_equal(np.ma.filled(value, 0.), np.ma.filled(expected, 0.))
+                out.close()
+
+    def test_write_output_workers(self):
+        """Tests the reach files written by a process pool match the serial ones."""
+
+        self.assertGreaterEqual(cpu_allocation(), 1)
+        basin_dict, alg_dict, obs_dict = basin_results(9)
+        contents = []
+        for workers in (1, 2):
+            params = {'write_fill_only': False, 'output_mode': 'reach', 'output_workers': workers}
+            with tempfile.TemporaryDirectory() as out_dir:
+                Output(basin_dict, Path(out_dir), {}, alg_dict, obs_dict, None, params).write_output()
+                contents.append(read_files(out_dir))
+        self.assertEqual(len(contents[0]), 9)
+        self.assertEqual(contents[0], contents[1])
+
+    def test_templates(self):
+        """Tests files cloned from templates match files written in full."""
+
+        basin_dict, alg_dict, obs_dict = basin_results(6)
+        q = alg_dict['sad'][basin_dict['reach_ids'][0]]['integrator']['q'].copy()
+        for fill_only in (False, True):
+            params = {'write_fill_only': fill_only, 'output_mode': 'reach', 'output_workers': 1}
+            with tempfile.TemporaryDirectory() as out_dir, tempfile.TemporaryDirectory() as expected_dir:
+                Output(basin_dict, Path(out_dir), {}, alg_dict, obs_dict, None, params).write_output()
+                for reach in basin_dict['reach_ids_all']:
+                    nt, variables = reach_outputs(alg_dict, reach, obs_dict.get(reach), fill_only)
+                    write_integrator_file(Path(expected_dir) / f"{reach}_integrator.nc", nt, variables)
+                self.assertEqual(read_files(out_dir), read_files(expected_dir))
+        np.testing.assert_array_equal(alg_dict['sad'][basin_dict['reach_ids'][0]]['integrator']['q'], q)
+
+    def test_sword_deltas(self):
+        """Tests per-basin FLP deltas merged into a SWORD copy."""
+
+        basin_dict, alg_dict, obs_dict = basin_results(5)
+        reaches = basin_dict['reach_ids']
+        alg_dict['hivdi'][reaches[1]]['integrator']['alpha'] = np.ma.masked
+        del alg_dict['momma'][reaches[2]]['integrator']['H']
+        other = {'basin_id': '7424', 'reach_ids': reaches[3:], 'reach_ids_all': reaches[3:]}
+        other_algs = {alg: {reach: {'integrator': {field: 7. for name, model_alg, field in entries}}
+                            for reach in reaches[3:]} for model, entries in SWORD_FLP_VARIABLES.items()
+                      for alg in {entry[1] for entry in entries}}
+        params = {'write_fill_only': False, 'output_mode': 'reach', 'output_workers': 1}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            ids = [74230900001] + [int(reach) for reach in reaches] + [74230900999]
+            write_sword(tmp / 'na_sword.nc', ids)
+            for basin, algs in ((basin_dict, alg_dict), (other, other_algs)):
+                basin['sword'] = 'na_sword.nc'
+                Output(basin, tmp, {}, algs, obs_dict, tmp, params).write_sword_output('unconstrained')
+            deltas = sorted(tmp.glob('*_sword_flps.nc'))
+            self.assertEqual([delta.name for delta in deltas],
+                             ['7423_unconstrained_sword_flps.nc', '7424_unconstrained_sword_flps.nc'])
+            merge_sword_deltas(deltas, tmp, tmp)
+
+            sword = Dataset(tmp / 'na_sword_moi.nc')
+            models = sword['reaches']['discharge_models']
+            for model, entries in SWORD_FLP_VARIABLES.items():
+                for name, alg, field in entries:
+                    actual = models['unconstrained'][model][name][:]
+                    self.assertTrue(np.all(actual.mask[[0, -1]]))
+                    self.assertTrue(np.all(models['constrained'][model][name][:].mask))
+                    for i, reach in enumerate(reaches, 1):
+                        value = alg_dict[alg][reach]['integrator'].get(field, np.ma.masked)
+                        if i > 3:
+                            self.assertEqual(actual[i], 7.)
+                        elif value is np.ma.masked:
+                            self.assertIs(actual[i], np.ma.masked, (model, name, reach))
+                        else:
+                            self.assertEqual(actual[i], value, (model, name, reach))
+            sword.close()
+
+if __name__ == '__main__':
+    unittest.main()